@@ -0,0 +1,302 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from langchain_core.tools import BaseTool, tool
+from ai.agent.ai_config.config import (
+    ARTIFACT_DIR,
+    ARTIFACT_HEAD_CHARS,
+    ARTIFACT_INLINE_CHARS,
+    ARTIFACT_KEY_LINES,
+    ARTIFACT_MAX_BYTES,
+    ARTIFACT_PAGE_MAX_LINES,
+    ARTIFACT_TAIL_CHARS
+)
+
+HANDLE_LEN = 16
+HASH_BLOCK = 1024 * 1024
+# byte offset of every this many lines, to seek to a page quickly
+INDEX_STEP = 1024
+MAX_LINE_CHARS = 400
+# run the size based pruning once every this many new artifacts
+PRUNE_EVERY = 32
+
+KEY_LINE_PATTERN = re.compile(
+    r"^.*\b(?:error|fatal|fail(?:ed|ure|s)?|exception|traceback|warning|"
+    r"violations?|abort(?:ed)?|denied|not found)\b.*$",
+    re.IGNORECASE | re.MULTILINE
+)
+HANDLE_PATTERN = re.compile(r"[0-9a-f]{%d}" % HANDLE_LEN)
+# name of the tool made by gen_read_artifact_tool()
+READ_ARTIFACT_TOOL = "read_artifact"
+
+
+def _clip_line(line: str) -> str:
+    line = line.rstrip("\r\n")
+    if len(line) <= MAX_LINE_CHARS:
+        return line
+    return line[:MAX_LINE_CHARS] + " ..."
+
+
+class KeyLineScanner:
+    """
+    Collect the first `max_lines` lines that look like errors or warnings,
+    together with their line numbers, from text fed chunk by chunk.
+    """
+
+    def __init__(self, max_lines: int = ARTIFACT_KEY_LINES):
+        self.max_lines = max_lines
+        self.n_lines = 0
+        self.partial = ""
+        self.key_lines: list[tuple[int, str]] = []
+
+    def _scan(self, text: str) -> None:
+        line_no, pos = self.n_lines, 0
+        for match in KEY_LINE_PATTERN.finditer(text):
+            if len(self.key_lines) >= self.max_lines:
+                break
+            line_no += text.count("\n", pos, match.start())
+            pos = match.start()
+            self.key_lines.append((line_no + 1, _clip_line(match.group())))
+        self.n_lines += text.count("\n")
+
+    def feed(self, text: str) -> None:
+        text = self.partial + text
+        cut = text.rfind("\n") + 1
+        self.partial = text[cut:]
+        # keep a runaway line without newline bounded
+        if len(self.partial) > 64 * 1024:
+            self.partial = self.partial[-64 * 1024:]
+        if cut:
+            self._scan(text[:cut])
+
+    def close(self) -> None:
+        if self.partial:
+            self._scan(self.partial)
+            self.n_lines += 1
+            self.partial = ""
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of the large tool results. A result is saved
+    once under the sha256 of its content, the conversation only carries a
+    reference to it: handle, size, head, tail and the key lines. The
+    `read_artifact` tool pages through the full content on demand.
+    """
+
+    def __init__(
+            self,
+            root: str | Path = ARTIFACT_DIR,
+            inline_chars: int = ARTIFACT_INLINE_CHARS,
+            head_chars: int = ARTIFACT_HEAD_CHARS,
+            tail_chars: int = ARTIFACT_TAIL_CHARS,
+            max_bytes: int = ARTIFACT_MAX_BYTES
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.inline_chars = inline_chars
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.n_puts = 0
+        # handle -> byte offsets of every INDEX_STEP-th line
+        self.line_index: OrderedDict[str, list[int]] = OrderedDict()
+
+    def path(self, handle: str) -> Path:
+        if not HANDLE_PATTERN.fullmatch(handle):
+            raise ValueError(f"invalid artifact handle `{handle}`")
+        return self.root / handle[:2] / handle
+
+    def exists(self, handle: str) -> bool:
+        try:
+            return self.path(handle).is_file()
+        except ValueError:
+            return False
+
+    def _added(self) -> None:
+        with self.lock:
+            self.n_puts += 1
+            if self.n_puts % PRUNE_EVERY:
+                return
+        self.prune()
+
+    def put_text(self, text: str) -> str:
+        data = text.encode("utf-8")
+        handle = hashlib.sha256(data).hexdigest()[:HANDLE_LEN]
+        target = self.path(handle)
+        if target.exists():
+            os.utime(target)
+            return handle
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{handle}.{uuid.uuid4().hex}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, target)
+        self._added()
+        return handle
+
+    def put_file(self, file_path: str | Path) -> str:
+        """
+        Move a finished file (e.g. a tool output spool) into the store.
+        """
+        file_path = Path(file_path)
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                digest.update(block)
+        handle = digest.hexdigest()[:HANDLE_LEN]
+        target = self.path(handle)
+        if target.exists():
+            os.utime(target)
+            file_path.unlink(missing_ok=True)
+            return handle
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(file_path), str(target))
+        self._added()
+        return handle
+
+    def reference(
+            self,
+            handle: str,
+            head: str,
+            tail: str,
+            n_lines: int,
+            key_lines: list[tuple[int, str]]
+    ) -> str:
+        size = self.path(handle).stat().st_size
+        parts = [
+            f"[artifact {handle}] {size} bytes, {n_lines} lines. Only an "
+            f"excerpt is shown, page through the full content with the "
+            f"`read_artifact` tool.",
+            "--- head ---",
+            head[:self.head_chars]
+        ]
+        if key_lines:
+            parts.append("--- key lines ---")
+            parts.extend(f"L{line_no}: {line}" for line_no, line in key_lines)
+        parts.append("--- tail ---")
+        parts.append(tail[-self.tail_chars:] if self.tail_chars else "")
+        return "\n".join(parts)
+
+    def compact(self, text: str) -> str:
+        """
+        Return text itself when it is short, otherwise store it and return
+        its reference.
+        """
+        if len(text) <= self.inline_chars:
+            return text
+        handle = self.put_text(text)
+        scanner = KeyLineScanner()
+        scanner.feed(text)
+        scanner.close()
+        return self.reference(
+            handle,
+            head=text[:self.head_chars],
+            tail=text[-self.tail_chars:],
+            n_lines=scanner.n_lines,
+            key_lines=scanner.key_lines
+        )
+
+    def _build_index(self, handle: str) -> list[int]:
+        with self.lock:
+            if handle in self.line_index:
+                self.line_index.move_to_end(handle)
+                return self.line_index[handle]
+        offsets = [0]
+        with open(self.path(handle), "rb") as f:
+            for line_no, _ in enumerate(iter(f.readline, b""), start=1):
+                if line_no % INDEX_STEP == 0:
+                    offsets.append(f.tell())
+        with self.lock:
+            self.line_index[handle] = offsets
+            while len(self.line_index) > 64:
+                self.line_index.popitem(last=False)
+        return offsets
+
+    def read_lines(
+            self,
+            handle: str,
+            start_line: int = 1,
+            n_lines: int = 200,
+            pattern: str | None = None
+    ) -> str:
+        """
+        Lines of an artifact, numbered from 1. With a pattern, only the
+        matching lines from start_line on are returned.
+        """
+        if not self.exists(handle):
+            return f"Error: artifact `{handle}` does not exist."
+        start_line = max(1, start_line)
+        n_lines = max(1, min(n_lines, ARTIFACT_PAGE_MAX_LINES))
+        regex = re.compile(pattern, re.IGNORECASE) if pattern else None
+
+        offsets = self._build_index(handle)
+        block = min((start_line - 1) // INDEX_STEP, len(offsets) - 1)
+        line_no = block * INDEX_STEP
+        out = []
+        with open(self.path(handle), "rb") as f:
+            f.seek(offsets[block])
+            for raw in iter(f.readline, b""):
+                line_no += 1
+                if line_no < start_line:
+                    continue
+                line = raw.decode("utf-8", errors="replace")
+                if regex is not None and not regex.search(line):
+                    continue
+                out.append(f"L{line_no}: {_clip_line(line)}")
+                if len(out) >= n_lines:
+                    break
+        if not out:
+            return (f"No {'matching ' if regex else ''}lines in artifact "
+                    f"`{handle}` from line {start_line} on.")
+        return "\n".join(out)
+
+    def prune(self) -> None:
+        """
+        Drop the least recently used artifacts past max_bytes.
+        """
+        files = []
+        for one_file in self.root.glob("??/*"):
+            if one_file.name.startswith("."):
+                continue
+            stat_res = one_file.stat()
+            files.append((stat_res.st_mtime, stat_res.st_size, one_file))
+        total = sum(size for _, size, _ in files)
+        for _, size, one_file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            one_file.unlink(missing_ok=True)
+            total -= size
+
+
+def gen_read_artifact_tool(store: ArtifactStore) -> BaseTool:
+
+    @tool
+    def read_artifact(
+            handle: str,
+            start_line: int = 1,
+            n_lines: int = 200,
+            pattern: str | None = None
+    ) -> str:
+        """
+        Page through a large tool result stored as an artifact. Tool results
+        that are too long are replaced by a reference like
+        `[artifact <handle>] ...` showing only the head, the tail and the
+        key lines, use this tool when more of the content is needed.
+        :param handle: The artifact handle given in the reference.
+        :param start_line: The first line to return, numbered from 1.
+        :param n_lines: The number of lines to return, at most 500.
+        :param pattern: Optional regular expression, only the matching lines
+            from start_line on are returned, e.g. "error|violation".
+        """
+        try:
+            return store.read_lines(handle, start_line, n_lines, pattern)
+        except (OSError, ValueError, re.error) as e:
+            return f"Error: Failed to read artifact `{handle}`: {str(e)}"
+
+    return read_artifact
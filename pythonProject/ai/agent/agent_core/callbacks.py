@@ -1,6 +1,27 @@
-from typing import Any
+import asyncio
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
 from PyQt5.QtCore import pyqtSignal
-from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
+from langchain_core.messages import BaseMessage, convert_to_openai_messages
+from langchain_core.outputs import LLMResult
+from ai.cad_agent_release.agent_core.json_stream import JsonFieldStream
+from ai.cad_agent_release.agent_core.warmup import LazyComponent, resolve
+
+# word-sized pieces used to replay an answer which was not streamed
+REPLAY_TOKEN_PATTERN = re.compile(r"\s*\S+|\s+")
+
+# set while the answers streamed in the context are held back, see
+# JsonFieldGUICallbackHandler.holding()
+_holding: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "json_field_holding", default=False
+)
 
 
 class GUICallbackHandler(BaseCallbackHandler):
@@ -9,6 +30,350 @@ class GUICallbackHandler(BaseCallbackHandler):
             new_text_sig: pyqtSignal(str)
     ):
         self.new_text_sig = new_text_sig
+        self.streamed_runs = set()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.streamed_runs.add(kwargs.get("run_id"))
+        self.new_text_sig.emit(token)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        if run_id in self.streamed_runs:
+            self.streamed_runs.discard(run_id)
+            return
+        # nothing was streamed, the answer came from the LLM cache
+        for generations in response.generations:
+            for generation in generations:
+                for token in REPLAY_TOKEN_PATTERN.findall(generation.text):
+                    self.new_text_sig.emit(token)
+
+
+class TokenBuffer:
+    """
+    Coalesces the streamed tokens of each LLM run into chunks: a run's text
+    is emitted once it is `interval` seconds old or `max_chars` long, or
+    when flush() is called. emit() runs under the lock so the chunks of a
+    run keep their order whoever flushes them, and in the context of the
+    first buffered token, emit may depend on context variables.
+    """
+
+    def __init__(
+            self,
+            emit: Callable[[str], Any],
+            interval: float = 0.03,
+            max_chars: int = 64
+    ):
+        self.emit = emit
+        self.interval = interval
+        self.max_chars = max_chars
+        self.lock = threading.RLock()
+        # run id -> (pieces, chars, first buffered at, context)
+        self.pending: dict[Any, tuple[list[str], int, float,
+                                      contextvars.Context]] = {}
+        self.stats = {"tokens": 0, "emits": 0}
+
+    def push(self, run_id: Any, token: str) -> float | None:
+        """
+        Buffer a token, return the time its chunk is due when it wasn't
+        emitted right away.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.stats["tokens"] += 1
+            pieces, chars, since, ctx = self.pending.get(run_id) or (
+                [], 0, now, contextvars.copy_context())
+            pieces.append(token)
+            chars += len(token)
+            self.pending[run_id] = (pieces, chars, since, ctx)
+            if chars >= self.max_chars or now - since >= self.interval:
+                self.flush(run_id)
+                return None
+            return since + self.interval
+
+    def flush(self, run_id: Any) -> None:
+        with self.lock:
+            pending = self.pending.pop(run_id, None)
+            if pending is None:
+                return
+            pieces, _, _, ctx = pending
+            self.stats["emits"] += 1
+            ctx.run(self.emit, "".join(pieces))
+
+    def flush_due(self) -> float | None:
+        """
+        Flush every run whose chunk is due, return when the next one is.
+        """
+        now = time.monotonic()
+        next_due = None
+        with self.lock:
+            for run_id, (_, _, since, _) in list(self.pending.items()):
+                due = since + self.interval
+                if due <= now:
+                    self.flush(run_id)
+                elif next_due is None or due < next_due:
+                    next_due = due
+        return next_due
+
+
+class BufferedGUICallbackHandler(GUICallbackHandler):
+    """
+    GUICallbackHandler which sends the tokens to the GUI in chunks of at
+    most `interval` seconds or `max_chars` characters instead of one signal
+    per token. A run is always flushed when it ends or fails, text left in
+    a stalled stream is sent by a flusher thread once it is due.
+    """
+
+    # appending a token is cheap, don't hop to an executor per token
+    run_inline = True
+
+    def __init__(
+            self,
+            new_text_sig: pyqtSignal(str),
+            interval: float = 0.03,
+            max_chars: int = 64
+    ):
+        super().__init__(new_text_sig)
+        self.buffer = TokenBuffer(new_text_sig.emit, interval, max_chars)
+        self.wakeup = threading.Condition(self.buffer.lock)
+        self.flusher: threading.Thread | None = None
+
+    def _flush_loop(self) -> None:
+        with self.wakeup:
+            while True:
+                next_due = self.buffer.flush_due()
+                timeout = None if next_due is None else max(
+                    0.0, next_due - time.monotonic())
+                self.wakeup.wait(timeout)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        with self.wakeup:
+            self.streamed_runs.add(run_id)
+            if self.buffer.push(run_id, token) is None:
+                return
+            if self.flusher is None:
+                self.flusher = threading.Thread(
+                    target=self._flush_loop,
+                    name="cad-agent-gui-flush",
+                    daemon=True
+                )
+                self.flusher.start()
+            self.wakeup.notify()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        if run_id in self.streamed_runs:
+            self.streamed_runs.discard(run_id)
+            self.buffer.flush(run_id)
+            return
+        # nothing was streamed, the answer came from the LLM cache
+        for generations in response.generations:
+            for generation in generations:
+                for token in REPLAY_TOKEN_PATTERN.findall(generation.text):
+                    self.buffer.push(run_id, token)
+        self.buffer.flush(run_id)
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        self.streamed_runs.discard(run_id)
+        self.buffer.flush(run_id)
+
+
+class JsonFieldGUICallbackHandler(BufferedGUICallbackHandler):
+    """
+    Streams to the GUI only the string value of `field` of an LLM answering
+    in JSON, e.g. the flow_plan of the plan node, while the rest of the
+    answer is being generated.
+    """
+
+    def __init__(
+            self,
+            new_text_sig: pyqtSignal(str),
+            field: str,
+            interval: float = 0.03,
+            max_chars: int = 64
+    ):
+        super().__init__(new_text_sig, interval, max_chars)
+        self.field = field
+        self.fields: dict[Any, JsonFieldStream] = {}
+
+    @contextmanager
+    def holding(self) -> Iterator[None]:
+        """
+        Don't show the answers of the LLM calls made in the context, e.g.
+        an attempt which may be redone, release() shows the kept result.
+        """
+        token = _holding.set(True)
+        try:
+            yield
+        finally:
+            _holding.reset(token)
+
+    def release(self, result: Any) -> None:
+        text = result.get(self.field) if isinstance(result, dict) else None
+        if not isinstance(text, str) or not text:
+            return
+        key = object()
+        self.buffer.push(key, text)
+        self.buffer.flush(key)
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        self.new_text_sig.emit(token)
\ No newline at end of file
+        if _holding.get():
+            return
+        run_id = kwargs.get("run_id")
+        field_stream = self.fields.get(run_id)
+        if field_stream is None:
+            field_stream = self.fields[run_id] = JsonFieldStream(self.field)
+        delta = field_stream.feed(token)
+        if delta:
+            super().on_llm_new_token(delta, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if _holding.get():
+            return
+        run_id = kwargs.get("run_id")
+        self.streamed_runs.discard(run_id)
+        if self.fields.pop(run_id, None) is None:
+            # nothing was streamed, the answer came from the LLM cache
+            for generations in response.generations:
+                for generation in generations:
+                    text = JsonFieldStream(self.field).feed(generation.text)
+                    if text:
+                        self.buffer.push(run_id, text)
+        self.buffer.flush(run_id)
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        self.fields.pop(kwargs.get("run_id"), None)
+        super().on_llm_error(error, **kwargs)
+
+
+class AsyncBufferedGUICallbackHandler(AsyncCallbackHandler):
+    """
+    Async variant of BufferedGUICallbackHandler for graphs only run with
+    ainvoke / astream, the due chunks are flushed by the event loop.
+    """
+
+    def __init__(
+            self,
+            new_text_sig: pyqtSignal(str),
+            interval: float = 0.03,
+            max_chars: int = 64
+    ):
+        self.buffer = TokenBuffer(new_text_sig.emit, interval, max_chars)
+        self.streamed_runs = set()
+        self.scheduled: set[Any] = set()
+
+    def _flush_later(self, run_id: Any) -> None:
+        self.scheduled.discard(run_id)
+        self.buffer.flush(run_id)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        self.streamed_runs.add(run_id)
+        due = self.buffer.push(run_id, token)
+        if due is not None and run_id not in self.scheduled:
+            self.scheduled.add(run_id)
+            asyncio.get_running_loop().call_later(
+                max(0.0, due - time.monotonic()), self._flush_later, run_id)
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        if run_id in self.streamed_runs:
+            self.streamed_runs.discard(run_id)
+            self.buffer.flush(run_id)
+            return
+        for generations in response.generations:
+            for generation in generations:
+                for token in REPLAY_TOKEN_PATTERN.findall(generation.text):
+                    self.buffer.push(run_id, token)
+        self.buffer.flush(run_id)
+
+    async def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        run_id = kwargs.get("run_id")
+        self.streamed_runs.discard(run_id)
+        self.buffer.flush(run_id)
+
+
+class PrefixCacheProbe(BaseCallbackHandler):
+    """
+    Diagnostic for the automatic prefix caching of the LLM server: renders
+    every chat prompt with the model chat template and reports how many of
+    its leading tokens match one of the last `history_size` prompts, rounded
+    down to whole KV blocks, i.e. the prefill the server can skip.
+    """
+
+    def __init__(
+            self,
+            tokenizer: LazyComponent | Any,
+            block_size: int = 16,
+            history_size: int = 64,
+            verbose: bool = True
+    ):
+        # may still be loading, resolved by the first prompt
+        self.tokenizer_ref = tokenizer
+        self.block_size = block_size
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.prompts: deque[list[int]] = deque(maxlen=history_size)
+        # node -> [calls, prompt tokens, cacheable tokens]
+        self.stats: dict[str, list[int]] = {}
+
+    @property
+    def tokenizer(self):
+        return resolve(self.tokenizer_ref)
+
+    def _encode(
+            self,
+            messages: list[BaseMessage],
+            tools: list | None
+    ) -> list[int]:
+        try:
+            return list(self.tokenizer.apply_chat_template(
+                convert_to_openai_messages(messages),
+                tools=tools,
+                tokenize=True,
+                add_generation_prompt=True
+            ))
+        except Exception:
+            text = "".join(f"{msg.type}:{msg.content}" for msg in messages)
+            return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def on_chat_model_start(
+            self,
+            serialized: dict[str, Any],
+            messages: list[list[BaseMessage]],
+            **kwargs: Any
+    ) -> None:
+        node = (kwargs.get("metadata") or {}).get("langgraph_node", "-")
+        tools = (kwargs.get("invocation_params") or {}).get("tools")
+        for one_prompt in messages:
+            token_ids = self._encode(one_prompt, tools)
+            with self.lock:
+                shared = max(
+                    (len(os.path.commonprefix([token_ids, prev]))
+                     for prev in self.prompts),
+                    default=0
+                )
+                self.prompts.append(token_ids)
+                # the last token is always recomputed by the server
+                shared = max(0, min(shared, len(token_ids) - 1))
+                cached = shared // self.block_size * self.block_size
+                node_stats = self.stats.setdefault(node, [0, 0, 0])
+                node_stats[0] += 1
+                node_stats[1] += len(token_ids)
+                node_stats[2] += cached
+            if self.verbose:
+                print(f"[prefix cache] {node}: {cached}/{len(token_ids)} "
+                      f"prompt tokens cacheable")
+
+    def report(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            return {
+                node: {
+                    "calls": calls,
+                    "prompt_tokens": total,
+                    "cached_tokens": cached,
+                    "hit_ratio": cached / total if total else 0.0
+                }
+                for node, (calls, total, cached) in self.stats.items()
+            }
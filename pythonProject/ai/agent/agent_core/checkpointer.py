@@ -0,0 +1,399 @@
+import json
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Sequence
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+
+# payloads smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = 512
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    channel_versions TEXT NOT NULL,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    type TEXT NOT NULL,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    blob BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    blob BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+class CompactSqliteSaver(BaseCheckpointSaver):
+    """
+    A local on-disk checkpointer for the CAD agent graph.
+
+    - Channel values are stored once per channel version, so a new
+      checkpoint only writes the channels that changed in that step.
+    - Only the last `keep_last` checkpoints of each thread are kept, blobs
+      no longer referenced by any of them are dropped.
+    - Large payloads (chat_history, tool_run_history) are zlib compressed.
+    - Everything lives in one SQLite file, so a session can be resumed with
+      the same thread_id after the process restarts.
+    """
+
+    def __init__(
+            self,
+            db_path: str | Path,
+            keep_last: int = 20,
+            compress_level: int = 6
+    ):
+        super().__init__()
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.keep_last = keep_last
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    # ------------ payload helpers --------------------
+    def _dump(self, value: Any) -> tuple[str, int, bytes]:
+        type_str, data = self.serde.dumps_typed(value)
+        if len(data) >= COMPRESS_MIN_BYTES:
+            return type_str, 1, zlib.compress(data, self.compress_level)
+        return type_str, 0, data
+
+    def _load(self, type_str: str, compressed: int, data: bytes) -> Any:
+        if compressed:
+            data = zlib.decompress(data)
+        return self.serde.loads_typed((type_str, data))
+
+    def _load_blobs(
+            self,
+            thread_id: str,
+            checkpoint_ns: str,
+            channel_versions: ChannelVersions
+    ) -> dict[str, Any]:
+        channel_values = {}
+        for channel, version in channel_versions.items():
+            row = self.conn.execute(
+                "SELECT type, compressed, blob FROM blobs WHERE thread_id=? "
+                "AND checkpoint_ns=? AND channel=? AND version=?",
+                (thread_id, checkpoint_ns, channel, str(version))
+            ).fetchone()
+            if row and row[0] != "empty":
+                channel_values[channel] = self._load(*row)
+        return channel_values
+
+    def _build_tuple(self, row: tuple) -> CheckpointTuple:
+        (thread_id, checkpoint_ns, checkpoint_id, parent_id,
+         channel_versions, type_str, checkpoint_data, metadata_type,
+         metadata_data) = row
+        checkpoint = self.serde.loads_typed((type_str, checkpoint_data))
+        checkpoint["channel_values"] = self._load_blobs(
+            thread_id, checkpoint_ns, json.loads(channel_versions)
+        )
+        metadata = self.serde.loads_typed((metadata_type, metadata_data))
+        writes = self.conn.execute(
+            "SELECT task_id, channel, type, compressed, blob FROM writes "
+            "WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=? "
+            "ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id)
+        ).fetchall()
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint=checkpoint,
+            metadata=metadata,
+            parent_config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": parent_id,
+                }
+            } if parent_id else None,
+            pending_writes=[
+                (task_id, channel, self._load(w_type, compressed, blob))
+                for task_id, channel, w_type, compressed, blob in writes
+            ]
+        )
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        keep_rows = self.conn.execute(
+            "SELECT checkpoint_id, channel_versions FROM checkpoints "
+            "WHERE thread_id=? AND checkpoint_ns=? "
+            "ORDER BY checkpoint_id DESC LIMIT ?",
+            (thread_id, checkpoint_ns, self.keep_last)
+        ).fetchall()
+        if len(keep_rows) < self.keep_last:
+            return
+        oldest_kept = keep_rows[-1][0]
+        removed = self.conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? "
+            "AND checkpoint_id<?",
+            (thread_id, checkpoint_ns, oldest_kept)
+        ).rowcount
+        if not removed:
+            return
+        self.conn.execute(
+            "DELETE FROM writes WHERE thread_id=? AND checkpoint_ns=? "
+            "AND checkpoint_id<?",
+            (thread_id, checkpoint_ns, oldest_kept)
+        )
+        referenced = set()
+        for _, channel_versions in keep_rows:
+            referenced.update(
+                (channel, str(version))
+                for channel, version in json.loads(channel_versions).items()
+            )
+        stored = self.conn.execute(
+            "SELECT channel, version FROM blobs WHERE thread_id=? "
+            "AND checkpoint_ns=?",
+            (thread_id, checkpoint_ns)
+        ).fetchall()
+        self.conn.executemany(
+            "DELETE FROM blobs WHERE thread_id=? AND checkpoint_ns=? "
+            "AND channel=? AND version=?",
+            [(thread_id, checkpoint_ns, channel, version)
+             for channel, version in stored
+             if (channel, version) not in referenced]
+        )
+
+    # ------------ BaseCheckpointSaver interface --------------------
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, "
+                 "parent_checkpoint_id, channel_versions, type, checkpoint, "
+                 "metadata_type, metadata FROM checkpoints WHERE thread_id=? "
+                 "AND checkpoint_ns=?")
+        with self.lock:
+            if checkpoint_id:
+                row = self.conn.execute(
+                    f"{query} AND checkpoint_id=?",
+                    (thread_id, checkpoint_ns, checkpoint_id)
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    f"{query} ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns)
+                ).fetchone()
+            return self._build_tuple(row) if row else None
+
+    def list(
+            self,
+            config: RunnableConfig | None,
+            *,
+            filter: dict[str, Any] | None = None,
+            before: RunnableConfig | None = None,
+            limit: int | None = None
+    ) -> Iterator[CheckpointTuple]:
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, "
+                 "parent_checkpoint_id, channel_versions, type, checkpoint, "
+                 "metadata_type, metadata FROM checkpoints")
+        where, params = [], []
+        if config:
+            where.append("thread_id=?")
+            params.append(config["configurable"]["thread_id"])
+            checkpoint_ns = config["configurable"].get("checkpoint_ns")
+            if checkpoint_ns is not None:
+                where.append("checkpoint_ns=?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append("checkpoint_id=?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append("checkpoint_id<?")
+            params.append(before_id)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+            results = []
+            for row in rows:
+                if limit is not None and len(results) >= limit:
+                    break
+                ckpt_tuple = self._build_tuple(row)
+                if filter and not all(
+                        ckpt_tuple.metadata.get(key) == value
+                        for key, value in filter.items()):
+                    continue
+                results.append(ckpt_tuple)
+        yield from results
+
+    def put(
+            self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        ckpt_copy = checkpoint.copy()
+        values = ckpt_copy.pop("channel_values")
+
+        # only the channels bumped in this step are written
+        blob_rows = []
+        for channel, version in new_versions.items():
+            if channel in values:
+                blob_rows.append(
+                    (thread_id, checkpoint_ns, channel, str(version),
+                     *self._dump(values[channel]))
+                )
+            else:
+                blob_rows.append(
+                    (thread_id, checkpoint_ns, channel, str(version),
+                     "empty", 0, b"")
+                )
+        type_str, checkpoint_data = self.serde.dumps_typed(ckpt_copy)
+        metadata_type, metadata_data = self.serde.dumps_typed(metadata)
+
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, "
+                "channel, version, type, compressed, blob) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                blob_rows
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns,"
+                " checkpoint_id, parent_checkpoint_id, channel_versions, type,"
+                " checkpoint, metadata_type, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"],
+                 config["configurable"].get("checkpoint_id"),
+                 json.dumps(checkpoint["channel_versions"]),
+                 type_str, checkpoint_data, metadata_type, metadata_data)
+            )
+            self._prune(thread_id, checkpoint_ns)
+            self.conn.commit()
+
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+            self,
+            config: RunnableConfig,
+            writes: Sequence[tuple[str, Any]],
+            task_id: str,
+            task_path: str = ""
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # special channels (errors, interrupts) overwrite, others are kept
+        verb = ("INSERT OR REPLACE"
+                if all(channel in WRITES_IDX_MAP for channel, _ in writes)
+                else "INSERT OR IGNORE")
+        rows = [
+            (thread_id, checkpoint_ns, checkpoint_id, task_id,
+             WRITES_IDX_MAP.get(channel, idx), channel,
+             *self._dump(value), task_path)
+            for idx, (channel, value) in enumerate(writes)
+        ]
+        with self.lock:
+            self.conn.executemany(
+                f"{verb} INTO writes (thread_id, checkpoint_ns, "
+                f"checkpoint_id, task_id, idx, channel, type, compressed, "
+                f"blob, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            for table in ("checkpoints", "blobs", "writes"):
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE thread_id=?", (thread_id,)
+                )
+            self.conn.commit()
+
+    # the SQLite calls are short, the async API shares the sync path
+    async def aget_tuple(
+            self,
+            config: RunnableConfig
+    ) -> CheckpointTuple | None:
+        return self.get_tuple(config)
+
+    async def alist(
+            self,
+            config: RunnableConfig | None,
+            *,
+            filter: dict[str, Any] | None = None,
+            before: RunnableConfig | None = None,
+            limit: int | None = None
+    ) -> AsyncIterator[CheckpointTuple]:
+        for ckpt_tuple in self.list(
+                config, filter=filter, before=before, limit=limit):
+            yield ckpt_tuple
+
+    async def aput(
+            self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions
+    ) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+            self,
+            config: RunnableConfig,
+            writes: Sequence[tuple[str, Any]],
+            task_id: str,
+            task_path: str = ""
+    ) -> None:
+        return self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return self.delete_thread(thread_id)
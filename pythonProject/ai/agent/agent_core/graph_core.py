@@ -1,18 +1,63 @@
+import asyncio
+import uuid
 import orjson
 from pydantic import BaseModel, Field
-from typing import TypedDict, Any, Annotated, Literal, Sequence, Callable
+from typing import TypedDict, Any, Annotated, Literal, Callable
 from ai.agent.ai_config.config import *
-from ai.cad_agent_release.tools.auto_reg import auto_reg_tools
 from ai.cad_agent_release.agent_core.prompt import *
 from ai.cad_agent_release.agent_core.rag import *
 from ai.cad_agent_release.agent_core.callbacks import *
-from langchain_core.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.tools import BaseTool
+from ai.cad_agent_release.agent_core.tool_exec import (
+    MAX_TOOL_WORKERS,
+    arun_tool_calls,
+    find_unresolved_args,
+    ready_tool_calls,
+    run_tool_calls,
+    validate_tool_call
+)
+from ai.cad_agent_release.agent_core.artifact_store import (
+    READ_ARTIFACT_TOOL,
+    ArtifactStore,
+    gen_read_artifact_tool
+)
+from ai.cad_agent_release.agent_core.checkpointer import CompactSqliteSaver
+from ai.cad_agent_release.agent_core.history import HistoryManager
+from ai.cad_agent_release.agent_core.tool_registry import ToolRegistry
+from ai.cad_agent_release.agent_core.tool_index import ToolIndex
+from ai.cad_agent_release.agent_core.llm_cache import SqliteLLMCache
+from ai.cad_agent_release.agent_core.intent import ConfirmIntentClassifier
+from ai.cad_agent_release.agent_core.output_budget import OutputBudget
+from ai.cad_agent_release.agent_core.warmup import Warmup
+from ai.cad_agent_release.agent_core.replay import ReplaySession
+from ai.cad_agent_release.agent_core.model_tier import (
+    escalating,
+    gen_escalation_llm,
+    gen_node_llm,
+    schema_check,
+    tool_calls_check
+)
+from ai.cad_agent_release.tools.auto_reg import auto_reg_tools
+from ai.cad_agent_release.agent_core.speculation import (
+    Speculator,
+    config_thread_id,
+    speculation_key
+)
+from ai.cad_agent_release.agent_core.tracing import (
+    TraceRecorder,
+    TracingCallbackHandler,
+    set_recorder
+)
+from ai.cad_agent_release.agent_core.prompt_layout import (
+    JUDGE_CONTEXT_PROMPT,
+    RAG_CONTEXT_PROMPT,
+    layout_prompt
+)
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.messages import HumanMessage, ToolMessage
+from langchain_core.tools import BaseTool
+from langchain_core.messages import AIMessage, HumanMessage
 from langgraph.graph import StateGraph, START
 from langgraph.graph.message import add_messages
-from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.types import interrupt
 
 
@@ -31,6 +76,7 @@ class AgentState(TypedDict):
     display_output: str | None
     rag_info: str | None
     tool_call_list: list | None
+    planned_tool_calls: list | None
     tool_run_history: Annotated[list, add_messages]
 
 
@@ -77,6 +123,21 @@ class PlanClassify(BaseModel):
     )
 
 
+class PlannedToolCall(BaseModel):
+    name: str = Field(description="The name of the tool.")
+    args: dict[str, Any] = Field(
+        description="The tool parameters and their values."
+    )
+
+
+class PlanWithToolCalls(PlanClassify):
+    tool_calls: list[PlannedToolCall] | None = Field(
+        description="The calls executing the automated steps of flow_plan, "
+                    "in order. Null unless flow_results is success or "
+                    "partial_success."
+    )
+
+
 class ReceptionIntent(BaseModel):
     routing_result: Literal['cad_run', 'cad_rag', 'general_chat'] = Field(
         description="""
@@ -111,8 +172,23 @@ def begin_input_node(state: AgentState) -> dict[str, Any]:
     }
 
 
-def post_plan_input(state: AgentState) -> dict[str, Any]:
-    user_input = interrupt("post_plan_input")
+def gen_begin_input(
+        refresh_tools: Callable[[], bool] | None = None
+) -> Callable:
+
+    def begin_input(state: AgentState) -> dict[str, Any]:
+        update = begin_input_node(state)
+        # pick up the tools added or changed since the last run, the chains
+        # bound to the old tool set are rebuilt on first use
+        if (refresh_tools is not None and update["agent_type"] == "cad_run"
+                and refresh_tools()):
+            print("Tool set changed, rebuilding the tool chains")
+        return update
+
+    return begin_input
+
+
+def post_plan_update(user_input: dict[str, Any]) -> dict[str, Any]:
     rag_choose = user_input["assert_rag"]
     flow_choose = user_input["assert_flow"]
     query_str = user_input["query_str"]
@@ -130,170 +206,333 @@ def post_plan_input(state: AgentState) -> dict[str, Any]:
     }
 
 
+def gen_post_plan_input(
+        speculate: Callable[[AgentState, RunnableConfig], None] | None = None
+) -> Callable:
+
+    def post_plan_input(
+            state: AgentState,
+            config: RunnableConfig
+    ) -> dict[str, Any]:
+        # prepare the tool calls while the user reads the plan
+        if speculate is not None:
+            speculate(state, config)
+        return post_plan_update(interrupt("post_plan_input"))
+
+    return post_plan_input
+
+
 def gen_chat_node(
         chat_llm: ChatOpenAI,
+        history_mgr: HistoryManager,
         qt_tool_status: pyqtSignal
-) -> Callable:
+) -> RunnableLambda:
 
-    general_chat_prompt_template = ChatPromptTemplate.from_messages(
-        [
-            ("system", gnrl_chat_sys_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{agent_input}")
-        ]
-    )
+    general_chat_prompt_template = layout_prompt(gnrl_chat_sys_prompt)
+    gnrl_chain = general_chat_prompt_template | chat_llm
 
     def general_chat_node(state: AgentState) -> dict[str, Any]:
         qt_tool_status.emit("generating answer...")
-        gnrl_chain = general_chat_prompt_template | chat_llm
         response = gnrl_chain.invoke(
             {
                 "agent_input": state['agent_input'],
-                "chat_history": state['chat_history'][:-1]
+                "chat_history": history_mgr.window(
+                    state['chat_history'][:-1], "chat")
             }
         )
         return {
             "chat_history": [response]
         }
 
-    return general_chat_node
+    async def ageneral_chat_node(state: AgentState) -> dict[str, Any]:
+        qt_tool_status.emit("generating answer...")
+        response = await gnrl_chain.ainvoke(
+            {
+                "agent_input": state['agent_input'],
+                "chat_history": await history_mgr.awindow(
+                    state['chat_history'][:-1], "chat")
+            }
+        )
+        return {
+            "chat_history": [response]
+        }
+
+    return RunnableLambda(general_chat_node, afunc=ageneral_chat_node)
 
 
 def gen_cad_run_plan(
-        run_tools: Sequence[BaseTool],
+        tool_reg: ToolRegistry,
         tool_llm: ChatOpenAI,
-        qt_tool_status: pyqtSignal
-) -> Callable:
+        history_mgr: HistoryManager,
+        qt_tool_status: pyqtSignal,
+        single_pass: bool = False,
+        escalate_llm: ChatOpenAI | None = None,
+        tool_index: ToolIndex | None = None,
+        plan_stream: JsonFieldGUICallbackHandler | None = None
+) -> RunnableLambda:
+    """
+    With single_pass the plan answer also carries the tool calls of the
+    plan, toolcall_plan then only calls the LLM when they are invalid.
+    With a tool_index the plan only sees the tools relevant to the request,
+    a failed plan is made again with all of them. plan_stream is the
+    handler streaming the plan of tool_llm, the plan of the tool subset is
+    only shown once it is kept.
+    """
+    plan_schema = PlanWithToolCalls if single_pass else PlanClassify
+    plan_schema_check = schema_check(plan_schema)
+
+    def plan_check(result: Any) -> str | None:
+        reason = plan_schema_check(result)
+        if reason is None and not result.get("flow_plan"):
+            reason = "empty flow_plan"
+        return reason
+
+    def subset_plan_check(result: Any) -> str | None:
+        reason = plan_check(result)
+        if reason is None and result["flow_results"] == "failed":
+            reason = "no plan with the tool subset"
+        return reason
+
+    def build_plan_chain(tools: list[BaseTool], escalate: bool = True):
+        cad_run_plan_prompt_template = layout_prompt(
+            cad_plan_tool_call_sys_prompt if single_pass
+            else cad_plan_sys_prompt_2,
+            tools_description=tool_reg.tools_desc(tools)
+        )
 
-    def cad_run_plan(state: AgentState) -> dict[str, Any]:
-        qt_tool_status.emit("generating execution plan...")
-        tools_desc = []
-        for tool in run_tools:
-            desc = tool.description or "No Definition."
-            tools_desc.append(f"- `{tool.name}`: {desc}")
-        tool_desc_str = "\n".join(tools_desc)
-        cad_run_plan_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", cad_plan_sys_prompt_2),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("human", "{agent_input}")
-            ]
-        ).partial(tools_description=tool_desc_str)
-
-        tool_plan_chain = cad_run_plan_prompt_template | tool_llm.bind(
-            response_format={"type": "json_object"}) | JsonOutputParser(
-            pydantic_object=PlanClassify
-            )
-        result = tool_plan_chain.invoke(
+        def plan_llm_chain(llm: ChatOpenAI):
+            return cad_run_plan_prompt_template | llm.bind(
+                response_format={"type": "json_object"}) | JsonOutputParser(
+                pydantic_object=plan_schema
+                )
+
+        return escalating(
+            plan_llm_chain(tool_llm),
+            plan_llm_chain(escalate_llm) if escalate and escalate_llm
+            else None,
+            "plan_run",
+            plan_check
+        )
+
+    routed_chain = None
+    if tool_index is not None:
+        routed_chain = tool_index.routed(
+            "plan_run", build_plan_chain, subset_plan_check, plan_stream)
+
+    def plan_chain():
+        return routed_chain or tool_reg.cached(
+            "plan_run", lambda: build_plan_chain(tool_reg.tools))
+
+    def planned_tool_calls(result: dict) -> list | None:
+        if not single_pass or result["flow_results"] not in (
+                'success', 'partial_success'):
+            return None
+        planned = result.get("tool_calls")
+        if not planned or not isinstance(planned, list):
+            return None
+        errors = []
+        for one_call in planned:
+            if not isinstance(one_call, dict):
+                errors.append(f"malformed tool call {one_call!r}")
+            else:
+                errors.extend(validate_tool_call(one_call, tool_reg.tools_map))
+        if errors:
+            print(f"Tool calls of the plan rejected: {'; '.join(errors)}")
+            return None
+        return [
             {
-                "agent_input": state['agent_input'],
-                "chat_history": state['chat_history'][:-1]
+                "name": one_call["name"],
+                "args": one_call["args"],
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "tool_call"
             }
-        )
+            for one_call in planned
+        ]
+
+    def plan_update(result: dict) -> dict[str, Any]:
         return {
             "display_output": result["flow_plan"],
             "chat_history": [result["flow_plan"]],
-            "clsfy_result": result["flow_results"]
+            "clsfy_result": result["flow_results"],
+            "planned_tool_calls": planned_tool_calls(result)
         }
-    return cad_run_plan
+
+    def cad_run_plan(state: AgentState) -> dict[str, Any]:
+        qt_tool_status.emit("generating execution plan...")
+        result = plan_chain().invoke(
+            {
+                "agent_input": state['agent_input'],
+                "chat_history": history_mgr.window(
+                    state['chat_history'][:-1], "plan_run")
+            }
+        )
+        return plan_update(result)
+
+    async def acad_run_plan(state: AgentState) -> dict[str, Any]:
+        qt_tool_status.emit("generating execution plan...")
+        result = await plan_chain().ainvoke(
+            {
+                "agent_input": state['agent_input'],
+                "chat_history": await history_mgr.awindow(
+                    state['chat_history'][:-1], "plan_run")
+            }
+        )
+        return plan_update(result)
+
+    return RunnableLambda(cad_run_plan, afunc=acad_run_plan)
+
+
+RTRV_NO_RESULT_MSG = (
+    f"Sorry, I couldn't find any relevant information in my "
+    f"Knowledge base that directly addresses your query,"
+    f"It's possible that the topic is not covered or the "
+    f"keywords used did not yield a match."
+    f"Please try rephrasing your question with different "
+    f"keywords, or provide more specific details about what "
+    f"you're looking for. This might help me find a more "
+    f"accurate answer for you.")
 
 
 def gen_retrieve_node(
         retrvr,
         tools_name: list[str],
         retrieve_llm: ChatOpenAI,
-        qt_tool_status: pyqtSignal
-) -> Callable:
-
+        history_mgr: HistoryManager,
+        qt_tool_status: pyqtSignal,
+        wrap_tool: Callable[[BaseTool], BaseTool] | None = None,
+        escalate_llm: ChatOpenAI | None = None
+) -> RunnableLambda:
+
+    # the LLM calls retrieve_rag_info once per aspect of the question, the
+    # calls are run together by the multi-query tool
     search_sop_tool = gen_retrieve_rag_info(retrvr, tools_name)
+    multi_search_tool = gen_multi_retrieve_rag_info(MultiQuerySearch(
+        retrvr,
+        count_tokens=history_mgr.count_text_tokens,
+        token_budget=RAG_CONTEXT_TOKEN_BUDGET,
+        top_n=RAG_TOP_N,
+        max_workers=RAG_SEARCH_WORKERS
+    ))
+    if wrap_tool is not None:
+        multi_search_tool = wrap_tool(multi_search_tool)
+
+    retrieve_prompt_template = layout_prompt(retrieve_sys_prompt)
+    tool_call_chain = escalating(
+        retrieve_prompt_template | retrieve_llm.bind_tools([search_sop_tool]),
+        retrieve_prompt_template | escalate_llm.bind_tools(
+            [search_sop_tool]) if escalate_llm else None,
+        "rtrv",
+        tool_calls_check({search_sop_tool.name: search_sop_tool})
+    )
 
     def retrieve_node(state: AgentState) -> dict[str, Any]:
         qt_tool_status.emit("retrieving information...")
-        retrieve_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", retrieve_sys_prompt),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("human", "{agent_input}"),
-            ]
-        )
-
-        tool_llm = retrieve_llm.bind_tools([search_sop_tool])
-        tool_call_chain = retrieve_prompt_template | tool_llm
         tool_call_msg = tool_call_chain.invoke({
             "agent_input": state['agent_input'],
-            "chat_history": state['chat_history'][:-1],
+            "chat_history": history_mgr.window(
+                state['chat_history'][:-1], "rtrv"),
         })
 
-        rtrv_msg_l = []
         if not tool_call_msg.tool_calls:
-            rtrv_msg = (
-                f"Sorry, I couldn't find any relevant information in my "
-                f"Knowledge base that directly addresses your query,"
-                f"It's possible that the topic is not covered or the "
-                f"keywords used did not yield a match."
-                f"Please try rephrasing your question with different "
-                f"keywords, or provide more specific details about what "
-                f"you're looking for. This might help me find a more "
-                f"accurate answer for you.")
-            rtrv_msg_l.append(rtrv_msg)
-        else:
-            for tool_call in tool_call_msg.tool_calls:
-                rtrv_msg = search_sop_tool.invoke(
-                    tool_call["args"]
-                )
-                rtrv_msg_l.append(rtrv_msg)
+            return {"rag_info": RTRV_NO_RESULT_MSG}
+        return {
+            "rag_info": multi_search_tool.invoke({
+                "query_strs": [tool_call["args"]["query_str"]
+                               for tool_call in tool_call_msg.tool_calls]
+            })
+        }
+
+    async def aretrieve_node(state: AgentState) -> dict[str, Any]:
+        qt_tool_status.emit("retrieving information...")
+        tool_call_msg = await tool_call_chain.ainvoke({
+            "agent_input": state['agent_input'],
+            "chat_history": await history_mgr.awindow(
+                state['chat_history'][:-1], "rtrv"),
+        })
 
+        if not tool_call_msg.tool_calls:
+            return {"rag_info": RTRV_NO_RESULT_MSG}
         return {
-            "rag_info": "\n".join(rtrv_msg_l)
+            "rag_info": await multi_search_tool.ainvoke({
+                "query_strs": [tool_call["args"]["query_str"]
+                               for tool_call in tool_call_msg.tool_calls]
+            })
         }
-    return retrieve_node
+
+    return RunnableLambda(retrieve_node, afunc=aretrieve_node)
 
 
 def gen_rag_node(
         rag_llm: ChatOpenAI,
+        history_mgr: HistoryManager,
         qt_tool_status: pyqtSignal
-) -> Callable:
+) -> RunnableLambda:
+
+    rag_prompt_template = layout_prompt(
+        rag_answer_sys_prompt,
+        context_prompt=RAG_CONTEXT_PROMPT
+    )
+    rag_chain = rag_prompt_template | rag_llm
+
     def rag_node(state: AgentState) -> dict[str: Any]:
         qt_tool_status.emit("augmented generating answer...")
-        rag_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", rag_answer_sys_prompt),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("human", "{agent_input}"),
-            ]
-        ).partial(rag_info=state['rag_info'])
-        rag_chain = rag_prompt_template | rag_llm
         result = rag_chain.invoke(
             {
+                "rag_info": state['rag_info'],
+                "agent_input": state['agent_input'],
+                "chat_history": history_mgr.window(
+                    state['chat_history'][:-1], "rag"),
+            }
+        )
+        return {
+            "chat_history": [result],
+            "rag_info": None
+        }
+
+    async def arag_node(state: AgentState) -> dict[str: Any]:
+        qt_tool_status.emit("augmented generating answer...")
+        result = await rag_chain.ainvoke(
+            {
+                "rag_info": state['rag_info'],
                 "agent_input": state['agent_input'],
-                "chat_history": state['chat_history'][:-1],
+                "chat_history": await history_mgr.awindow(
+                    state['chat_history'][:-1], "rag"),
             }
         )
         return {
             "chat_history": [result],
             "rag_info": None
         }
-    return rag_node
 
+    return RunnableLambda(rag_node, afunc=arag_node)
 
-def gen_reception_node(reception_llm) -> Callable:
-    reception_prompt_template = ChatPromptTemplate.from_messages(
-        [
-            ("system", cad_reception_sys_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{agent_input}")
-        ]
-    )
 
-    def reception_node(state: AgentState) -> dict[str, Any]:
-        reception_chain = reception_prompt_template | reception_llm.bind(
+def gen_reception_node(
+        reception_llm: ChatOpenAI,
+        history_mgr: HistoryManager,
+        escalate_llm: ChatOpenAI | None = None
+) -> RunnableLambda:
+    reception_prompt_template = layout_prompt(cad_reception_sys_prompt)
+
+    def reception_llm_chain(llm: ChatOpenAI):
+        return reception_prompt_template | llm.bind(
             response_format={"type": "json_object"}) | JsonOutputParser(
             pydantic_object=ReceptionIntent
         )
+
+    reception_chain = escalating(
+        reception_llm_chain(reception_llm),
+        reception_llm_chain(escalate_llm) if escalate_llm else None,
+        "reception",
+        schema_check(ReceptionIntent)
+    )
+
+    def reception_node(state: AgentState) -> dict[str, Any]:
         result = reception_chain.invoke(
             {
                 "agent_input": state['agent_input'],
-                "chat_history": state['chat_history'][:-1],
+                "chat_history": history_mgr.window(
+                    state['chat_history'][:-1], "reception"),
             }
         )
         agent_type = result.get("routing_result", "general_chat")
@@ -301,102 +540,310 @@ def gen_reception_node(reception_llm) -> Callable:
             "agent_type": agent_type
         }
 
-    return reception_node
+    async def areception_node(state: AgentState) -> dict[str, Any]:
+        result = await reception_chain.ainvoke(
+            {
+                "agent_input": state['agent_input'],
+                "chat_history": await history_mgr.awindow(
+                    state['chat_history'][:-1], "reception"),
+            }
+        )
+        agent_type = result.get("routing_result", "general_chat")
+        return {
+            "agent_type": agent_type
+        }
+
+    return RunnableLambda(reception_node, afunc=areception_node)
 
 
 def process_user_confirmation(
         judge_llm: ChatOpenAI,
-        qt_tool_status: pyqtSignal
-) -> Callable:
-    judge_prompt_template = ChatPromptTemplate.from_messages([
-        ("system", judge_prompt),
-        ("human", "{agent_input}")
-    ])
+        qt_tool_status: pyqtSignal,
+        speculator: Speculator | None = None,
+        intent_clf: ConfirmIntentClassifier | None = None,
+        escalate_llm: ChatOpenAI | None = None
+) -> RunnableLambda:
+    judge_prompt_template = layout_prompt(
+        judge_prompt,
+        history=(),
+        context_prompt=JUDGE_CONTEXT_PROMPT
+    )
+
+    def judge_llm_chain(llm: ChatOpenAI):
+        return judge_prompt_template | llm.bind(
+            response_format={"type": "json_object"}) | JsonOutputParser(
+            pydantic_object=UserIntent
+        )
+
+    intent_schema_check = schema_check(UserIntent)
 
-    judge_chain = judge_prompt_template | judge_llm.bind(
-        response_format={"type": "json_object"}) | JsonOutputParser(
-        pydantic_object=UserIntent
+    def judge_check(judge_result: Any) -> str | None:
+        reason = intent_schema_check(judge_result)
+        if reason is None and judge_result["decision"] == "clarify" and (
+                not judge_result.get("clarification_query")):
+            reason = "clarify without a clarification_query"
+        return reason
+
+    judge_chain = escalating(
+        judge_llm_chain(judge_llm),
+        judge_llm_chain(escalate_llm) if escalate_llm else None,
+        "proc_confirm",
+        judge_check
     )
 
-    def interpret_user_confimation(state: AgentState) -> dict[str, Any]:
+    def judge_update(judge_result: dict) -> dict[str, Any]:
+        if judge_result["decision"] == "confirm":
+            # TODO complete the return value
+            return {
+                "user_confirm": True,
+                "need_clarify": False
+            }
+        elif judge_result["decision"] == "deny":
+            return {
+                "user_confirm": False,
+                "need_clarify": False,
+            }
+
+        elif judge_result["decision"] == "clarify":
+
+            return {
+                "user_confirm": False,
+                "need_clarify": True,
+                "agent_input": judge_result["clarification_query"]
+            }
+        else:
+            return {
+                "user_confirm": False,
+                "need_clarify": False,
+            }
+
+    def drop_speculation(
+            update: dict[str, Any],
+            config: RunnableConfig
+    ) -> dict[str, Any]:
+        # the tool calls prepared for the plan are only used on confirm
+        thread_id = config_thread_id(config)
+        if speculator is not None and thread_id and not update[
+                "user_confirm"]:
+            speculator.discard(thread_id)
+        return update
+
+    def local_judge(user_response: str) -> dict[str, Any] | None:
+        if intent_clf is None:
+            return None
+        return intent_clf.classify(user_response)
+
+    def interpret_user_confimation(
+            state: AgentState,
+            config: RunnableConfig
+    ) -> dict[str, Any]:
         qt_tool_status.emit("Identifying the user's intention ...")
         user_response = state['agent_input']
+        judge_result = local_judge(user_response)
+        if judge_result is not None:
+            return drop_speculation(judge_update(judge_result), config)
         try:
             judge_result = judge_chain.invoke({
                 "agent_input": user_response,
                 "agent_plan": state['display_output']
             })
-            if judge_result["decision"] == "confirm":
-                # TODO complete the return value
-                return {
-                    "user_confirm": True,
-                    "need_clarify": False
-                }
-            elif judge_result["decision"] == "deny":
-                return {
-                    "user_confirm": False,
-                    "need_clarify": False,
-                }
-
-            elif judge_result["decision"] == "clarify":
+            return drop_speculation(judge_update(judge_result), config)
+        except Exception as e:
+            print(f"Error when parsing the user confimation of running script:"
+                  f"{e}")
+            return drop_speculation({
+                "user_confirm": False,
+                "need_clarify": False,
+            }, config)
 
-                return {
-                    "user_confirm": False,
-                    "need_clarify": True,
-                    "agent_input": judge_result["clarification_query"]
-                }
-            else:
-                return {
-                    "user_confirm": False,
-                    "need_clarify": False,
-                }
+    async def ainterpret_user_confimation(
+            state: AgentState,
+            config: RunnableConfig
+    ) -> dict[str, Any]:
+        qt_tool_status.emit("Identifying the user's intention ...")
+        user_response = state['agent_input']
+        judge_result = local_judge(user_response)
+        if judge_result is not None:
+            return drop_speculation(judge_update(judge_result), config)
+        try:
+            judge_result = await judge_chain.ainvoke({
+                "agent_input": user_response,
+                "agent_plan": state['display_output']
+            })
+            return drop_speculation(judge_update(judge_result), config)
         except Exception as e:
             print(f"Error when parsing the user confimation of running script:"
                   f"{e}")
-            return {
+            return drop_speculation({
                 "user_confirm": False,
                 "need_clarify": False,
-            }
+            }, config)
 
-    return interpret_user_confimation
+    return RunnableLambda(
+        interpret_user_confimation,
+        afunc=ainterpret_user_confimation
+    )
 
 
-def gen_toolcall_plan_node(
-        run_tools: Sequence[BaseTool],
+def gen_tool_call_chain(
+        tool_reg: ToolRegistry,
         exec_llm: ChatOpenAI,
-        qt_tool_status: pyqtSignal
-) -> Callable:
-    tool_llm = exec_llm.bind_tools(run_tools)
+        escalate_llm: ChatOpenAI | None = None,
+        tool_index: ToolIndex | None = None
+):
+
+    def build_tool_call_chain(tools: list[BaseTool], escalate: bool = True):
+        plan_run_prompt_template = layout_prompt(tool_call_sys_prompt)
+        return escalating(
+            plan_run_prompt_template | exec_llm.bind_tools(tools),
+            plan_run_prompt_template | escalate_llm.bind_tools(
+                tools) if escalate and escalate_llm else None,
+            "toolcall_plan",
+            tool_calls_check(tool_reg.tools_map)
+        )
 
-    def toolcall_plan_node(state: AgentState) -> dict[str: Any]:
-        qt_tool_status.emit("Preparing to execute plan ...")
-        plan_run_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", tool_call_sys_prompt),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("human", "{agent_input}")
-            ]
+    if tool_index is not None:
+        return tool_reg.cached(
+            "toolcall_plan_routed",
+            lambda: tool_index.routed(
+                "toolcall_plan",
+                build_tool_call_chain,
+                tool_calls_check(tool_reg.tools_map)
+            )
         )
+    return tool_reg.cached(
+        "toolcall_plan", lambda: build_tool_call_chain(tool_reg.tools))
 
-        tool_call_chain = plan_run_prompt_template | tool_llm
-        tool_call_msg = tool_call_chain.invoke({
-            "agent_input": state['display_output'],
-            "chat_history": state['chat_history'][:-1],
-        })
-        tool_call_plan = tool_call_msg.tool_calls
+
+def toolcall_spec_key(
+        tool_reg: ToolRegistry,
+        plan: str,
+        history: list
+) -> str:
+    # the plan, the history it was made from and the tools it may call
+    last_msg_id = history[-1].id if history else None
+    return speculation_key(tool_reg.version, plan, last_msg_id)
+
+
+def gen_toolcall_speculation(
+        tool_reg: ToolRegistry,
+        exec_llm: ChatOpenAI,
+        history_mgr: HistoryManager,
+        speculator: Speculator,
+        escalate_llm: ChatOpenAI | None = None,
+        tool_index: ToolIndex | None = None
+) -> Callable[[AgentState, RunnableConfig], None]:
+
+    def speculate(state: AgentState, config: RunnableConfig) -> None:
+        thread_id = config_thread_id(config)
+        if not thread_id or state['clsfy_result'] not in (
+                'success', 'partial_success'):
+            return
+        # the plan answer already carries them
+        if state.get('planned_tool_calls'):
+            return
+        plan = state['display_output']
+        history = state['chat_history']
+
+        def prepare():
+            return gen_tool_call_chain(
+                tool_reg, exec_llm, escalate_llm, tool_index).invoke({
+                "agent_input": plan,
+                "chat_history": history_mgr.window(history, "toolcall_plan")
+            })
+
+        speculator.start(
+            thread_id,
+            toolcall_spec_key(tool_reg, plan, history),
+            prepare
+        )
+
+    return speculate
+
+
+def gen_toolcall_plan_node(
+        tool_reg: ToolRegistry,
+        exec_llm: ChatOpenAI,
+        history_mgr: HistoryManager,
+        qt_tool_status: pyqtSignal,
+        speculator: Speculator | None = None,
+        escalate_llm: ChatOpenAI | None = None,
+        tool_index: ToolIndex | None = None
+) -> RunnableLambda:
+
+    def speculated(state: AgentState, config: RunnableConfig):
+        thread_id = config_thread_id(config)
+        if speculator is None or not thread_id:
+            return None
+        return speculator.take(thread_id, toolcall_spec_key(
+            tool_reg, state['display_output'], state['chat_history'][:-1]))
+
+    def toolcall_update(tool_call_msg) -> dict[str: Any]:
         return {
-            "tool_call_list": tool_call_plan,
+            "tool_call_list": tool_call_msg.tool_calls,
+            "planned_tool_calls": None,
             "chat_history": [tool_call_msg]
         }
 
-    return toolcall_plan_node
+    def planned(state: AgentState) -> AIMessage | None:
+        # the calls made together with the plan, see gen_cad_run_plan
+        if not state.get('planned_tool_calls'):
+            return None
+        return AIMessage(content="", tool_calls=state['planned_tool_calls'])
+
+    def toolcall_plan_node(
+            state: AgentState,
+            config: RunnableConfig
+    ) -> dict[str: Any]:
+        qt_tool_status.emit("Preparing to execute plan ...")
+        planned_msg = planned(state)
+        if planned_msg is not None:
+            return toolcall_update(planned_msg)
+        spec_future = speculated(state, config)
+        if spec_future is not None:
+            try:
+                return toolcall_update(spec_future.result())
+            except Exception as e:
+                print(f"Speculative tool call preparation failed: {e}")
+        tool_call_msg = gen_tool_call_chain(
+            tool_reg, exec_llm, escalate_llm, tool_index).invoke({
+            "agent_input": state['display_output'],
+            "chat_history": history_mgr.window(
+                state['chat_history'][:-1], "toolcall_plan"),
+        })
+        return toolcall_update(tool_call_msg)
+
+    async def atoolcall_plan_node(
+            state: AgentState,
+            config: RunnableConfig
+    ) -> dict[str: Any]:
+        qt_tool_status.emit("Preparing to execute plan ...")
+        planned_msg = planned(state)
+        if planned_msg is not None:
+            return toolcall_update(planned_msg)
+        spec_future = speculated(state, config)
+        if spec_future is not None:
+            try:
+                return toolcall_update(await asyncio.wrap_future(spec_future))
+            except Exception as e:
+                print(f"Speculative tool call preparation failed: {e}")
+        tool_call_msg = await gen_tool_call_chain(
+            tool_reg, exec_llm, escalate_llm, tool_index).ainvoke({
+                "agent_input": state['display_output'],
+                "chat_history": await history_mgr.awindow(
+                    state['chat_history'][:-1], "toolcall_plan"),
+            })
+        return toolcall_update(tool_call_msg)
+
+    return RunnableLambda(toolcall_plan_node, afunc=atoolcall_plan_node)
 
 
 def gen_tool_call_node(
-        run_tools: Sequence[BaseTool],
-        qt_slot_sig: pyqtSignal(dict)
-) -> Callable:
-    tools_map = {one_tool.name: one_tool for one_tool in run_tools}
+        tool_reg: ToolRegistry,
+        qt_slot_sig: pyqtSignal(dict),
+        store: ArtifactStore | None = None,
+        max_workers: int = MAX_TOOL_WORKERS
+) -> RunnableLambda:
 
     def tool_call_node(state: AgentState) -> dict[str: Any]:
         tool_call_l = state["tool_call_list"]
@@ -406,78 +853,91 @@ def gen_tool_call_node(
                 "tool_run_history": []
             }
         else:
-            # Tool Info accquire
-            tool_dict = tool_call_l[0]
-            tool_name = tool_dict['name']
-            tool_args = tool_dict['args']
-            tool_id = tool_dict['id']
-
-            # GUI Info pass
-            tool_start_str = f"Invoking tool: `{tool_name}`\n"
-            qt_slot_sig.emit({
-                "tool_name": tool_name,
-                "status": "start",
-                "message": tool_start_str
-            })
-
-            # Tool Run procedure
-            tool_on_call = tools_map.get(tool_name)
-            tool_run_result = tool_on_call.invoke(tool_args)
-            tool_run_content = (f"The result after running tool `{tool_name}` "
-                                f"is {tool_run_result}")
-
-            # Tool Result Info Pass
-            tool_run_rslt_list = tool_run_result.split()
-            rslt_show_gui = " ".join(tool_run_rslt_list[:30])
-            rslt_show_gui = f"{rslt_show_gui} ... ...\n"
-
-            qt_slot_sig.emit({
-                "tool_name": tool_name,
-                "status": "result",
-                "message": rslt_show_gui
-            })
-
-            # handle the stateGraph data pass
-            tool_run_msg = ToolMessage(
-                content=tool_run_content,
-                tool_call_id=tool_id,
-                name=tool_name
+            # run the head call together with every independent pending call
+            ready_idx = ready_tool_calls(tool_call_l)
+            tool_run_msgs = run_tool_calls(
+                [tool_call_l[idx] for idx in ready_idx],
+                tool_reg.tools_map,
+                qt_slot_sig,
+                max_workers=max_workers,
+                store=store
             )
+            remain_calls = [one_call for idx, one_call in enumerate(tool_call_l)
+                            if idx not in ready_idx]
+            return {
+                "tool_call_list": remain_calls,
+                "tool_run_history": tool_run_msgs
+            }
 
-            # Tool End Info Pass
-            tool_end_content = f"Done Tool: `{tool_name}`\n"
-            qt_slot_sig.emit({
-                "tool_name": tool_name,
-                "status": "end",
-                "message": tool_end_content
-            })
-
-            if tool_call_l[1:]:
-                return {
-                    "tool_call_list": tool_call_l[1:],
-                    "tool_run_history": [tool_run_msg]
-                }
-            else:
-                return {
-                    "tool_call_list": [],
-                    "tool_run_history": [tool_run_msg]
-                }
+    async def atool_call_node(state: AgentState) -> dict[str: Any]:
+        tool_call_l = state["tool_call_list"]
+        if not tool_call_l or len(tool_call_l) == 0:
+            return {
+                "tool_call_list": None,
+                "tool_run_history": []
+            }
+        else:
+            ready_idx = ready_tool_calls(tool_call_l)
+            tool_run_msgs = await arun_tool_calls(
+                [tool_call_l[idx] for idx in ready_idx],
+                tool_reg.tools_map,
+                qt_slot_sig,
+                max_workers=max_workers,
+                store=store
+            )
+            remain_calls = [one_call for idx, one_call in enumerate(tool_call_l)
+                            if idx not in ready_idx]
+            return {
+                "tool_call_list": remain_calls,
+                "tool_run_history": tool_run_msgs
+            }
 
-    return tool_call_node
+    return RunnableLambda(tool_call_node, afunc=atool_call_node)
 
 
 def gen_plan_update_node(
-        run_tools: Sequence[BaseTool],
+        tool_reg: ToolRegistry,
         exec_llm: ChatOpenAI,
-        qt_tool_status: pyqtSignal
-) -> Callable:
-    tool_llm = exec_llm.bind_tools(run_tools)
+        history_mgr: HistoryManager,
+        qt_tool_status: pyqtSignal,
+        escalate_llm: ChatOpenAI | None = None,
+        tool_index: ToolIndex | None = None
+) -> RunnableLambda:
+
+    def build_plan_update_chain(tools: list[BaseTool], escalate: bool = True):
+        plan_update_prompt_template = layout_prompt(
+            plan_update_sys_prompt2,
+            history=("chat_history", "tool_run_history")
+        )
+        return escalating(
+            plan_update_prompt_template | exec_llm.bind_tools(tools),
+            plan_update_prompt_template | escalate_llm.bind_tools(
+                tools) if escalate and escalate_llm else None,
+            "plan_update",
+            tool_calls_check(tool_reg.tools_map)
+        )
 
-    def plan_update_node(state: AgentState) -> dict[str: Any]:
-        qt_tool_status.emit("Updating the dependencies ...")
+    def plan_update_chain():
+        if tool_index is not None:
+            return tool_reg.cached(
+                "plan_update_routed",
+                lambda: tool_index.routed(
+                    "plan_update",
+                    build_plan_update_chain,
+                    tool_calls_check(tool_reg.tools_map)
+                )
+            )
+        return tool_reg.cached(
+            "plan_update", lambda: build_plan_update_chain(tool_reg.tools))
+
+    def update_prompt(state: AgentState) -> str:
         initial_plan = state["display_output"]
         remaining_tool = orjson.dumps(state['tool_call_list'][0])
         next_tool_name = state['tool_call_list'][0]['name']
+        unresolved_args = find_unresolved_args(
+            state['tool_call_list'][0],
+            tool_reg.tools_map.get(next_tool_name)
+        )
         # input_prompt = (f"Initial workflow execution plan presented to the "
         #                 f"user is {initial_plan}, The remaining tool_calls "
         #                 f"please refer {remaining_tool}, please help me check"
@@ -485,24 +945,13 @@ def gen_plan_update_node(
 
         input_prompt = (f"Initial workflow execution plan presented to user is"
                         f"{initial_plan}, The next tool to run is "
-                        f"{next_tool_name}, please check if there are any "
-                        f"placeholder parameters should be replaced and "
+                        f"{next_tool_name}, the parameters "
+                        f"{', '.join(unresolved_args)} are still unresolved, "
+                        f"please replace these placeholder parameters and "
                         f"help me run next tool.")
+        return input_prompt
 
-        plan_update_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", plan_update_sys_prompt2),
-                MessagesPlaceholder(variable_name="chat_history"),
-                MessagesPlaceholder(variable_name="tool_run_history"),
-                ("human", "{agent_input}")
-            ]
-        )
-        plan_update_chain = plan_update_prompt_template | tool_llm
-        new_tool_msg = plan_update_chain.invoke({
-            "agent_input": input_prompt,
-            "chat_history": state['chat_history'][:-1],
-            "tool_run_history": state['tool_run_history']
-        })
+    def merge_tool_calls(state: AgentState, new_tool_msg) -> dict[str: Any]:
         new_tool_call_list = new_tool_msg.tool_calls
         if not new_tool_call_list:
             return
@@ -517,6 +966,14 @@ def gen_plan_update_node(
                     "tool_call_list": final_tool_call_list,
                     "chat_history": [new_tool_msg]
                 }
+            if latest_tool_name == READ_ARTIFACT_TOOL:
+                # the output needed to resolve the next tool is an
+                # artifact, read it first and come back to the same call
+                return {
+                    "tool_call_list": (new_tool_call_list
+                                       + state["tool_call_list"]),
+                    "chat_history": [new_tool_msg]
+                }
         elif len(new_tool_call_list) > 1:
             return {
                 "tool_call_list": new_tool_call_list,
@@ -526,24 +983,44 @@ def gen_plan_update_node(
             return {
                 "tool_call_list": []
             }
-    return plan_update_node
+
+    def plan_update_node(state: AgentState) -> dict[str: Any]:
+        qt_tool_status.emit("Updating the dependencies ...")
+        new_tool_msg = plan_update_chain().invoke({
+            "agent_input": update_prompt(state),
+            "chat_history": history_mgr.window(
+                state['chat_history'][:-1], "plan_update"),
+            "tool_run_history": state['tool_run_history']
+        })
+        return merge_tool_calls(state, new_tool_msg)
+
+    async def aplan_update_node(state: AgentState) -> dict[str: Any]:
+        qt_tool_status.emit("Updating the dependencies ...")
+        new_tool_msg = await plan_update_chain().ainvoke({
+            "agent_input": update_prompt(state),
+            "chat_history": await history_mgr.awindow(
+                state['chat_history'][:-1], "plan_update"),
+            "tool_run_history": state['tool_run_history']
+        })
+        return merge_tool_calls(state, new_tool_msg)
+
+    return RunnableLambda(plan_update_node, afunc=aplan_update_node)
 
 
 def gen_tool_summary_node(
         smry_llm: ChatOpenAI,
         qt_tool_status: pyqtSignal
-) -> Callable:
+) -> RunnableLambda:
+
+    tool_summary_prompt_template = layout_prompt(
+        tool_summary_sys_prompt,
+        history=("tool_run_history",)
+    )
+    tool_summary_chain = tool_summary_prompt_template | smry_llm
+
     def tool_summary_node(state: AgentState) -> dict[str: Any]:
         qt_tool_status.emit("Generating summary ...")
         initial_plan = state["display_output"] + "/no_think"
-        tool_summary_prompt_template = ChatPromptTemplate.from_messages(
-            [
-                ("system", tool_summary_sys_prompt),
-                MessagesPlaceholder(variable_name="tool_run_history"),
-                ("human", "{agent_input}")
-            ]
-        )
-        tool_summary_chain = tool_summary_prompt_template | smry_llm
         tool_summary_msg = tool_summary_chain.invoke({
             "agent_input": initial_plan,
             "tool_run_history": state['tool_run_history']
@@ -552,7 +1029,20 @@ def gen_tool_summary_node(
             "chat_history": [tool_summary_msg],
             "tool_run_history": []
         }
-    return tool_summary_node
+
+    async def atool_summary_node(state: AgentState) -> dict[str: Any]:
+        qt_tool_status.emit("Generating summary ...")
+        initial_plan = state["display_output"] + "/no_think"
+        tool_summary_msg = await tool_summary_chain.ainvoke({
+            "agent_input": initial_plan,
+            "tool_run_history": state['tool_run_history']
+        })
+        return {
+            "chat_history": [tool_summary_msg],
+            "tool_run_history": []
+        }
+
+    return RunnableLambda(tool_summary_node, afunc=atool_summary_node)
 
 
 def check_user_cfrm(state: AgentState) -> str:
@@ -564,87 +1054,292 @@ def check_user_cfrm(state: AgentState) -> str:
         return "reject_plan"
 
 
-def check_run_end(state: AgentState) -> str:
-    if state["tool_call_list"]:
-        return "running"
-    else:
-        return "run_done"
+def gen_check_run_end(tool_reg: ToolRegistry) -> Callable:
+
+    def check_run_end(state: AgentState) -> str:
+        tool_call_l = state["tool_call_list"]
+        if not tool_call_l:
+            return "run_done"
+        # only go through plan_update when the next call can't run as is
+        next_call = tool_call_l[0]
+        next_tool = tool_reg.tools_map.get(next_call['name'])
+        if find_unresolved_args(next_call, next_tool):
+            return "running"
+        return "run_ready"
+
+    return check_run_end
 
 
 def graph_core(
         new_text: pyqtSignal,
         tool_info: pyqtSignal,
-        node_status: pyqtSignal
+        node_status: pyqtSignal,
+        ckpt_db_path: str | Path = CHECKPOINT_DB_PATH,
+        replay: ReplaySession | None = None
 ) -> StateGraph:
+    """
+    :param replay: A started ReplaySession to record / replay the LLMs and
+        the tools with, by default one is started when REPLAY_MODE is set.
+    """
+    if replay is None and REPLAY_MODE is not None:
+        replay = ReplaySession(
+            REPLAY_PATH,
+            record=REPLAY_MODE == "record"
+        ).start()
+    wrap_tool = replay.wrap_tool if replay is not None else None
+
+    # the retrieval models and indexes load while the rest is set up and
+    # the user types, rtrv only waits for what isn't ready yet
+    warmup = Warmup(
+        max_workers=WARMUP_WORKERS,
+        on_done=lambda done: print(
+            f"Startup warm-up finished:\n{done.format_report()}")
+    )
+    # the history budgets count tokens from the first prompt on
+    tokenizer = warmup.add("tokenizer", gen_qwen_tokenizer)
+    custom_retriever = gen_lazy_retriever(srch_k=5, warmup=warmup)
+    if RETRIEVAL_WARMUP:
+        warmup.start()
+
+    # no LLM cache with a replay session, every request must reach it
+    llm_cache = router_cache = None
+    if replay is None:
+        llm_cache = SqliteLLMCache(
+            LLM_CACHE_PATH,
+            ttl=LLM_CACHE_TTL,
+            max_entries=LLM_CACHE_MAX_ENTRIES
+        )
+        router_cache = llm_cache
+    if replay is None and LLM_CACHE_SEMANTIC:
+        router_cache = SqliteLLMCache(
+            LLM_CACHE_PATH,
+            ttl=LLM_CACHE_TTL,
+            max_entries=LLM_CACHE_MAX_ENTRIES,
+            embeddings=gen_custom_embeddings(max_len=512),
+            sim_threshold=LLM_CACHE_SIM_THRESHOLD
+        )
+
+    def stream_cache(node_name: str) -> SqliteLLMCache | None:
+        return llm_cache if node_name in LLM_CACHE_STREAM_NODES else None
+
+    diag_cbs = []
+    if PREFIX_CACHE_DIAG:
+        diag_cbs.append(PrefixCacheProbe(
+            tokenizer,
+            block_size=PREFIX_CACHE_BLOCK_SIZE
+        ))
+
+    # one handler for all streaming LLMs, they share its flusher thread
+    gui_stream = BufferedGUICallbackHandler(
+        new_text,
+        interval=GUI_STREAM_INTERVAL,
+        max_chars=GUI_STREAM_MAX_CHARS
+    )
+
+    # max_tokens is part of the requests a replay session matches, it stays
+    # on the declared maximum with one
+    adaptive_budget = OUTPUT_BUDGET_ADAPTIVE and replay is None
+    out_budget = OutputBudget(
+        NODE_OUTPUT_BUDGET,
+        path=OUTPUT_BUDGET_PATH if adaptive_budget else None,
+        adaptive=OUTPUT_BUDGET_ADAPTIVE_NODES if adaptive_budget else ()
+    )
 
-    router_llm = gen_llm_qwq_235b(temp=0.1)
-    chat_llm = gen_llm_qwq_235b(
+    def budgeted(node: str, llm_kwargs: dict) -> dict:
+        llm_kwargs = {**out_budget.llm_kwargs(node), **llm_kwargs}
+        if adaptive_budget:
+            llm_kwargs["callbacks"] = list(
+                llm_kwargs.get("callbacks") or []) + [
+                out_budget.callback(node)]
+        return llm_kwargs
+
+    def node_llm(node: str, **llm_kwargs):
+        llm = gen_node_llm(node, **budgeted(node, llm_kwargs))
+        out_budget.attach(node, llm)
+        return llm
+
+    def node_llms(node: str, **llm_kwargs):
+        # the LLM of the node's tier and the one its calls escalate to
+        llm_kwargs = budgeted(node, llm_kwargs)
+        llms = (gen_node_llm(node, **llm_kwargs),
+                gen_escalation_llm(node, **llm_kwargs))
+        out_budget.attach(node, *llms)
+        return llms
+
+    judge_llm, judge_esc_llm = node_llms(
+        "proc_confirm",
+        temp=0.1,
+        callbacks=diag_cbs,
+        cache=router_cache
+    )
+    reception_llm, reception_esc_llm = node_llms(
+        "reception",
+        temp=0.1,
+        callbacks=diag_cbs,
+        cache=router_cache
+    )
+    chat_llm = node_llm(
+        "chat",
         temp=0.7,
         streaming=True,
-        callbacks=[GUICallbackHandler(new_text)]
+        callbacks=[gui_stream] + diag_cbs,
+        cache=stream_cache("chat")
     )
-    rtrvr_llm = gen_llm_qwq_235b(
+    rtrvr_llm, rtrvr_esc_llm = node_llms(
+        "rtrv",
         temp=0.1,
-        streaming=False
+        streaming=False,
+        callbacks=diag_cbs,
+        cache=llm_cache
     )
-    rag_llm = gen_llm_qwq_235b(
+    rag_llm = node_llm(
+        "rag",
         temp=0.5,
         streaming=True,
-        callbacks=[GUICallbackHandler(new_text)]
+        callbacks=[gui_stream] + diag_cbs,
+        cache=stream_cache("rag")
     )
-    tool_call_llm = gen_llm_qwq_235b(
+    tool_llm_kwargs = dict(
         temp=0.1,
-        streaming=False
+        streaming=False,
+        callbacks=diag_cbs,
+        cache=llm_cache
     )
+    # the plan is shown while generated, its flow_plan field is streamed out
+    # of the JSON answer
+    plan_stream = JsonFieldGUICallbackHandler(
+        new_text,
+        "flow_plan",
+        interval=GUI_STREAM_INTERVAL,
+        max_chars=GUI_STREAM_MAX_CHARS
+    )
+    plan_llm, plan_esc_llm = node_llms(
+        "plan_run",
+        temp=0.1,
+        streaming=True,
+        callbacks=[plan_stream] + diag_cbs,
+        cache=llm_cache
+    )
+    toolcall_llm, toolcall_esc_llm = node_llms(
+        "toolcall_plan", **tool_llm_kwargs)
+    update_llm, update_esc_llm = node_llms("plan_update", **tool_llm_kwargs)
 
-    smry_llm = gen_llm_qwq_235b(
+    smry_llm = node_llm(
+        "tool_summary",
         temp=0.7,
         streaming=True,
-        callbacks=[GUICallbackHandler(new_text)],
-        thk_en=False
+        callbacks=[gui_stream] + diag_cbs,
+        cache=stream_cache("tool_summary")
     )
+    hist_smry_llm = node_llm(
+        "history_summary",
+        temp=0.1,
+        streaming=False
+    )
+    history_mgr = HistoryManager(hist_smry_llm, tokenizer)
+
+    def load_tools():
+        tools, tools_name = auto_reg_tools()
+        if wrap_tool is not None:
+            tools = [wrap_tool(one_tool) for one_tool in tools]
+        return tools, tools_name
+
+    artifact_store = ArtifactStore()
+    tool_reg = ToolRegistry(
+        loader=load_tools,
+        extra_tools=[gen_read_artifact_tool(artifact_store)]
+    )
+    # the tool vectors are computed with the retrieval embedding model, as
+    # part of the warm-up
+    tool_index = None
+    if TOOL_INDEX_ENABLED:
+        tool_index = ToolIndex(
+            tool_reg,
+            LazyEmbeddings(warmup.component("embeddings")),
+            top_k=TOOL_INDEX_TOP_K,
+            min_tools=TOOL_INDEX_MIN_TOOLS,
+            max_subsets=TOOL_INDEX_MAX_SUBSETS,
+            always=[one_tool.name for one_tool in tool_reg.extra_tools]
+        )
+        warmup.add("tool_index", lambda embed: tool_index.warm(),
+                   warmup.component("embeddings"))
 
-    script_tools, tools_name = auto_reg_tools()
-
-    custom_retriever = gen_retriever(srch_k=5)
 
     # ------------ grpah node generate --------------------
     # six nodes with LLM
     plan_node = gen_cad_run_plan(
-        run_tools=script_tools,
-        tool_llm=tool_call_llm,
-        qt_tool_status=node_status
+        tool_reg=tool_reg,
+        tool_llm=plan_llm,
+        history_mgr=history_mgr,
+        qt_tool_status=node_status,
+        single_pass=PLAN_SINGLE_PASS,
+        escalate_llm=plan_esc_llm,
+        tool_index=tool_index,
+        plan_stream=plan_stream
     )
 
+    speculator = Speculator()
     toolcall_plan_node = gen_toolcall_plan_node(
-        run_tools=script_tools,
-        exec_llm=tool_call_llm,
-        qt_tool_status=node_status
+        tool_reg=tool_reg,
+        exec_llm=toolcall_llm,
+        history_mgr=history_mgr,
+        qt_tool_status=node_status,
+        speculator=speculator,
+        escalate_llm=toolcall_esc_llm,
+        tool_index=tool_index
+    )
+    post_plan_node = gen_post_plan_input(
+        gen_toolcall_speculation(
+            tool_reg=tool_reg,
+            exec_llm=toolcall_llm,
+            history_mgr=history_mgr,
+            speculator=speculator,
+            escalate_llm=toolcall_esc_llm,
+            tool_index=tool_index
+        )
     )
 
     tool_call_node = gen_tool_call_node(
-        run_tools=script_tools,
-        qt_slot_sig=tool_info
+        tool_reg=tool_reg,
+        qt_slot_sig=tool_info,
+        store=artifact_store
     )
 
     plan_update_node = gen_plan_update_node(
-        run_tools=script_tools,
-        exec_llm=tool_call_llm,
-        qt_tool_status=node_status
+        tool_reg=tool_reg,
+        exec_llm=update_llm,
+        history_mgr=history_mgr,
+        qt_tool_status=node_status,
+        escalate_llm=update_esc_llm,
+        tool_index=tool_index
     )
 
     rtrv_node = gen_retrieve_node(
         retrvr=custom_retriever,
-        tools_name=tools_name,
+        tools_name=tool_reg.tools_name,
         retrieve_llm=rtrvr_llm,
+        history_mgr=history_mgr,
+        qt_tool_status=node_status,
+        wrap_tool=wrap_tool,
+        escalate_llm=rtrvr_esc_llm
+    )
+    rag_node = gen_rag_node(rag_llm, history_mgr, qt_tool_status=node_status)
+    chat_node = gen_chat_node(
+        chat_llm,
+        history_mgr,
         qt_tool_status=node_status
     )
-    rag_node = gen_rag_node(rag_llm, qt_tool_status=node_status)
-    chat_node = gen_chat_node(chat_llm, qt_tool_status=node_status)
-    reception_node = gen_reception_node(router_llm)
+    reception_node = gen_reception_node(
+        reception_llm,
+        history_mgr,
+        escalate_llm=reception_esc_llm
+    )
     proc_confim_node = process_user_confirmation(
-        router_llm,
-        qt_tool_status=node_status
+        judge_llm,
+        qt_tool_status=node_status,
+        speculator=speculator,
+        intent_clf=ConfirmIntentClassifier() if CONFIRM_FAST_PATH else None,
+        escalate_llm=judge_esc_llm
     )
 
     tool_summary_node = gen_tool_summary_node(
@@ -654,8 +1349,8 @@ def graph_core(
 
     # Add the node to the graph
     cad_agent = StateGraph(AgentState)
-    cad_agent.add_node("begin_input", begin_input_node)
-    cad_agent.add_node("post_plan_input", post_plan_input)
+    cad_agent.add_node("begin_input", gen_begin_input(tool_reg.refresh))
+    cad_agent.add_node("post_plan_input", post_plan_node)
     # cad_agent.add_node("reception", reception_node)
     cad_agent.add_node("plan_run", plan_node)
     cad_agent.add_node("toolcall_plan", toolcall_plan_node)
@@ -702,10 +1397,11 @@ def graph_core(
     cad_agent.add_edge("toolcall_plan", "tool_call")
     cad_agent.add_conditional_edges(
         "tool_call",
-        check_run_end,
+        gen_check_run_end(tool_reg),
         {
             "run_done": "tool_summary",
-            "running": "plan_update"
+            "running": "plan_update",
+            "run_ready": "tool_call"
         }
     )
     cad_agent.add_edge("tool_summary", "begin_input")
@@ -714,8 +1410,17 @@ def graph_core(
     cad_agent.add_edge("rag", "begin_input")
     cad_agent.add_edge("chat", "begin_input")
 
-    check_pnt = InMemorySaver()
+    check_pnt = CompactSqliteSaver(
+        ckpt_db_path,
+        keep_last=CHECKPOINT_KEEP_LAST
+    )
     graph_app = cad_agent.compile(
         checkpointer=check_pnt
     )
+    if TRACE_ENABLED:
+        trace_recorder = TraceRecorder(TRACE_PATH)
+        set_recorder(trace_recorder)
+        graph_app = graph_app.with_config(
+            callbacks=[TracingCallbackHandler(trace_recorder)]
+        )
     return graph_app
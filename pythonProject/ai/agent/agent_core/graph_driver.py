@@ -0,0 +1,128 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable
+from langgraph.types import Command
+from ai.cad_agent_release.agent_core.json_stream import JsonFieldStream
+
+# nodes whose LLM tokens are shown to the user
+STREAM_NODES = {"chat", "rag", "tool_summary"}
+# nodes answering in JSON, only the tokens of this field are shown
+JSON_STREAM_NODES = {"plan_run": "flow_plan"}
+
+
+def thread_config(thread_id: str) -> dict[str, Any]:
+    return {"configurable": {"thread_id": thread_id}}
+
+
+async def astream_turn(
+        graph_app,
+        thread_id: str,
+        user_input: dict[str, Any],
+        stream_tokens: bool = True
+) -> AsyncIterator[dict[str, Any]]:
+    """
+    Feed one user input to the graph and stream its events until the graph
+    stops at the next interrupt.
+    :param graph_app: The compiled graph returned by graph_core().
+    :param thread_id: The conversation to run.
+    :param user_input: The resume value of begin_input / post_plan_input,
+        e.g. {"query_str": ..., "assert_rag": ..., "assert_flow": ...}
+    :param stream_tokens: False when the tokens already reach the user
+        through the new_text callback of the graph.
+    :return: An async iterator of events:
+        - {"type": "token", "node": str, "content": str}
+        - {"type": "node", "node": str, "update": dict}
+        - {"type": "interrupt", "value": str}
+    """
+    config = thread_config(thread_id)
+    snapshot = await graph_app.aget_state(config)
+    if not snapshot.next:
+        # a fresh thread, run up to the begin_input interrupt first
+        async for _ in graph_app.astream({"agent_input": None}, config):
+            pass
+
+    stream_mode = ["messages", "updates"] if stream_tokens else ["updates"]
+    # message id -> field stream of the JSON answers
+    field_streams: dict[str, JsonFieldStream] = {}
+    async for mode, payload in graph_app.astream(
+            Command(resume=user_input),
+            config,
+            stream_mode=stream_mode
+    ):
+        if mode == "messages":
+            chunk, metadata = payload
+            node_name = metadata.get("langgraph_node")
+            content = chunk.content if isinstance(chunk.content, str) else ""
+            if node_name in JSON_STREAM_NODES and content:
+                field_stream = field_streams.get(chunk.id)
+                if field_stream is None:
+                    field_stream = field_streams[chunk.id] = JsonFieldStream(
+                        JSON_STREAM_NODES[node_name])
+                content = field_stream.feed(content)
+            elif node_name not in STREAM_NODES:
+                content = ""
+            if content:
+                yield {
+                    "type": "token",
+                    "node": node_name,
+                    "content": content
+                }
+        else:
+            for node_name, update in payload.items():
+                if node_name == "__interrupt__":
+                    yield {
+                        "type": "interrupt",
+                        "value": update[0].value
+                    }
+                else:
+                    yield {
+                        "type": "node",
+                        "node": node_name,
+                        "update": update
+                    }
+
+
+class AsyncGraphRunner:
+    """
+    Owns one event loop on a background thread and runs conversation turns
+    on it, so a single process can overlap several conversations. The Qt
+    front end submits a turn and receives the events through `on_event`,
+    typically a pyqtSignal.emit which is safe to call from this thread.
+    """
+
+    def __init__(self, graph_app):
+        self.graph_app = graph_app
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name="cad-agent-loop",
+            daemon=True
+        )
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _run_turn(
+            self,
+            thread_id: str,
+            user_input: dict[str, Any],
+            on_event: Callable[[dict], None]
+    ) -> None:
+        async for event in astream_turn(self.graph_app, thread_id, user_input):
+            on_event(event)
+
+    def submit(
+            self,
+            thread_id: str,
+            user_input: dict[str, Any],
+            on_event: Callable[[dict], None]
+    ) -> Future:
+        return asyncio.run_coroutine_threadsafe(
+            self._run_turn(thread_id, user_input, on_event),
+            self.loop
+        )
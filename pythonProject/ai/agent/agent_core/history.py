@@ -0,0 +1,249 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Sequence
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts.chat import ChatPromptTemplate
+from ai.agent.ai_config.config import (
+    HISTORY_DEFAULT_BUDGET,
+    HISTORY_FOLD_STEP,
+    HISTORY_KEEP_TURNS,
+    HISTORY_TOKEN_BUDGET
+)
+from ai.cad_agent_release.agent_core.prompt import history_summary_sys_prompt
+from ai.cad_agent_release.agent_core.warmup import LazyComponent, resolve
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def _msg_text(msg: BaseMessage) -> str:
+    if isinstance(msg.content, str):
+        return msg.content
+    return " ".join(
+        part.get("text", "") if isinstance(part, dict) else str(part)
+        for part in msg.content
+    )
+
+
+def _msg_key(msg: BaseMessage) -> str:
+    # add_messages gives every message an id, fall back to the content
+    if msg.id:
+        return msg.id
+    return hashlib.sha1(
+        f"{msg.type}:{_msg_text(msg)}".encode("utf-8")
+    ).hexdigest()
+
+
+def split_turns(messages: Sequence[BaseMessage]) -> list[list[BaseMessage]]:
+    """
+    Group the chat history into turns, each turn begins with a HumanMessage.
+    """
+    turns = []
+    for msg in messages:
+        if isinstance(msg, HumanMessage) or not turns:
+            turns.append([msg])
+        else:
+            turns[-1].append(msg)
+    return turns
+
+
+class HistoryManager:
+    """
+    Sits between AgentState['chat_history'] and the prompt templates.
+    The last `keep_turns` turns are passed verbatim, the older ones are
+    folded into a rolling summary, and the result is kept under the token
+    budget of the calling node. Turns are folded `fold_step` at a time, in
+    between the summary and the kept turns only grow at their end, which
+    keeps the prompt prefix cacheable on the LLM server.
+    """
+
+    def __init__(
+            self,
+            summary_llm: ChatOpenAI,
+            tokenizer: LazyComponent | Any,
+            keep_turns: int = HISTORY_KEEP_TURNS,
+            fold_step: int = HISTORY_FOLD_STEP,
+            node_budgets: dict[str, int] | None = None,
+            default_budget: int = HISTORY_DEFAULT_BUDGET,
+            cache_size: int = 256
+    ):
+        # may still be loading, resolved by the first count
+        self.tokenizer_ref = tokenizer
+        self.keep_turns = keep_turns
+        self.fold_step = max(1, fold_step)
+        self.node_budgets = node_budgets or HISTORY_TOKEN_BUDGET
+        self.default_budget = default_budget
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # message key -> token count
+        self.token_cache: OrderedDict[str, int] = OrderedDict()
+        # key of the last folded message -> summary up to that message
+        self.summary_cache: OrderedDict[str, str] = OrderedDict()
+        self.summary_chain = ChatPromptTemplate.from_messages(
+            [
+                ("system", history_summary_sys_prompt),
+                ("human", "Previous Summary:\n{prev_summary}\n\n"
+                          "New Messages:\n{new_messages}")
+            ]
+        ) | summary_llm | StrOutputParser()
+
+    @staticmethod
+    def _cache_put(cache: OrderedDict, key: str, value, max_size: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+    @property
+    def tokenizer(self):
+        return resolve(self.tokenizer_ref)
+
+    def count_text_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_tokens(self, messages: Sequence[BaseMessage]) -> int:
+        total = 0
+        for msg in messages:
+            key = _msg_key(msg)
+            with self.lock:
+                cnt = self.token_cache.get(key)
+            if cnt is None:
+                cnt = self.count_text_tokens(_msg_text(msg))
+                with self.lock:
+                    self._cache_put(self.token_cache, key, cnt,
+                                    self.cache_size * 16)
+            total += cnt
+        return total
+
+    def _summary_start(self, keys: list[str]) -> tuple[str, int]:
+        # longest prefix of the folded messages that is already summarized
+        with self.lock:
+            for idx in range(len(keys) - 1, -1, -1):
+                if keys[idx] in self.summary_cache:
+                    self.summary_cache.move_to_end(keys[idx])
+                    return self.summary_cache[keys[idx]], idx + 1
+        return "", 0
+
+    @staticmethod
+    def _summary_input(
+            prev_summary: str,
+            new_msgs: Sequence[BaseMessage]
+    ) -> dict[str, str]:
+        return {
+            "prev_summary": prev_summary or "(empty)",
+            "new_messages": "\n".join(
+                f"{msg.type}: {_msg_text(msg)}" for msg in new_msgs
+            )
+        }
+
+    def summarize(self, folded: Sequence[BaseMessage]) -> str:
+        """
+        Rolling summary of the folded messages, only the messages after the
+        longest already summarized prefix are sent to the LLM.
+        """
+        if not folded:
+            return ""
+        keys = [_msg_key(msg) for msg in folded]
+        prev_summary, start = self._summary_start(keys)
+        if start == len(folded):
+            return prev_summary
+        summary = self.summary_chain.invoke(
+            self._summary_input(prev_summary, folded[start:])
+        )
+        with self.lock:
+            self._cache_put(self.summary_cache, keys[-1], summary,
+                            self.cache_size)
+        return summary
+
+    async def asummarize(self, folded: Sequence[BaseMessage]) -> str:
+        if not folded:
+            return ""
+        keys = [_msg_key(msg) for msg in folded]
+        prev_summary, start = self._summary_start(keys)
+        if start == len(folded):
+            return prev_summary
+        summary = await self.summary_chain.ainvoke(
+            self._summary_input(prev_summary, folded[start:])
+        )
+        with self.lock:
+            self._cache_put(self.summary_cache, keys[-1], summary,
+                            self.cache_size)
+        return summary
+
+    def _n_keep(self, n_turns: int) -> int:
+        # the fold boundary only moves once every fold_step turns
+        n_fold = max(0, n_turns - self.keep_turns)
+        return n_turns - n_fold // self.fold_step * self.fold_step
+
+    def _split_window(
+            self,
+            turns: list[list[BaseMessage]],
+            n_keep: int
+    ) -> tuple[list[BaseMessage], list[BaseMessage]]:
+        folded = [msg for turn in turns[:len(turns) - n_keep] for msg in turn]
+        recent = [msg for turn in turns[len(turns) - n_keep:] for msg in turn]
+        return folded, recent
+
+    def _fits(
+            self,
+            summary: str,
+            recent: list[BaseMessage],
+            budget: int
+    ) -> tuple[list[BaseMessage], bool]:
+        head = [SystemMessage(content=SUMMARY_PREFIX + summary)
+                ] if summary else []
+        used = self.count_tokens(recent) + (
+            self.count_text_tokens(head[0].content) if head else 0)
+        return head + recent, used <= budget
+
+    def window(
+            self,
+            messages: Sequence[BaseMessage],
+            node: str
+    ) -> list[BaseMessage]:
+        """
+        Return the history to place into the prompt of `node`.
+        """
+        budget = self.node_budgets.get(node, self.default_budget)
+        turns = split_turns(messages)
+        n_keep = self._n_keep(len(turns))
+        if (n_keep == len(turns)
+                and self.count_tokens(messages) <= budget):
+            return list(messages)
+
+        while True:
+            folded, recent = self._split_window(turns, n_keep)
+            # cheap check before paying for a summary
+            if n_keep > 1 and self.count_tokens(recent) > budget:
+                n_keep -= 1
+                continue
+            history, fits = self._fits(self.summarize(folded), recent, budget)
+            if fits or n_keep <= 1:
+                return history
+            n_keep -= 1
+
+    async def awindow(
+            self,
+            messages: Sequence[BaseMessage],
+            node: str
+    ) -> list[BaseMessage]:
+        budget = self.node_budgets.get(node, self.default_budget)
+        turns = split_turns(messages)
+        n_keep = self._n_keep(len(turns))
+        if (n_keep == len(turns)
+                and self.count_tokens(messages) <= budget):
+            return list(messages)
+
+        while True:
+            folded, recent = self._split_window(turns, n_keep)
+            if n_keep > 1 and self.count_tokens(recent) > budget:
+                n_keep -= 1
+                continue
+            history, fits = self._fits(
+                await self.asummarize(folded), recent, budget
+            )
+            if fits or n_keep <= 1:
+                return history
+            n_keep -= 1
@@ -0,0 +1,107 @@
+import re
+import threading
+from typing import Any
+
+# words that don't change the intent of a short reply
+FILLER_PATTERN = re.compile(
+    r"\b(?:please|pls|plz|thanks?|thank you|thx|just|then|now|sir)\b"
+    r"|[请吧啊呀呢了哈嗯哦喔的]"
+)
+PUNCT_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+
+CONFIRM_PATTERN = re.compile(
+    r"(?:y|ya|yes|yeah|yep|yup|ok|okay|k|sure|fine|go|goahead|proceed|"
+    r"run|runit|doit|execute|start|confirm|confirmed|approve|approved|lgtm|"
+    r"looksgood|soundsgood|letsgo|gogogo|yesplease|okgo|oksure|yesgo|"
+    r"yesrunit|yesproceed|okrunit|okproceed|"
+    r"确认|确定|可以|好|好的|行|没问题|开始|执行|运行|继续|同意|是|是的|对|"
+    r"开始吧|执行吧|跑吧|跑)+"
+)
+# one deny word, possibly repeated: two different ones may cancel out,
+# e.g. "don't cancel" or "不要停"
+DENY_PATTERN = re.compile(
+    r"(n|no|nope|nah|cancel|stop|abort|dont|donot|dontrunit|deny|reject|"
+    r"notnow|never|nevermind|forgetit|nothanks|"
+    r"不|不要|不用|取消|不行|停止|停|算了|否|别|别执行|不执行|先不要)\1*"
+)
+# replies that ask for something or add conditions always go to the LLM
+DEFER_PATTERN = re.compile(
+    r"[?？]|\b(?:what|why|how|which|when|where|who|explain|but|however|"
+    r"instead|change|modify|except|only|first|before|after|if|unless)\b"
+    r"|吗|什么|怎么|为什么|为何|哪|解释|但是|不过|修改|改成|换成|除了|只|如果",
+    re.IGNORECASE
+)
+# words of a reply which are neither a confirm nor a deny, but don't
+# change what it says about the plan either, e.g. "ok run it"
+REPLY_FILLER_WORDS = {
+    "it", "this", "that", "the", "a", "and", "all", "ahead", "me", "us",
+    "lets", "plan", "script", "scripts", "steps", "oh", "well", "alright"
+}
+WORD_SEP_PATTERN = re.compile(r"[\s,.!;:，。！；：、]+")
+
+
+def normalize_reply(text: str) -> str:
+    text = FILLER_PATTERN.sub(" ", text.lower())
+    return PUNCT_PATTERN.sub("", text)
+
+
+def _lexicon_decision(reply: str) -> str | None:
+    normalized = normalize_reply(reply)
+    if not normalized:
+        return None
+    if CONFIRM_PATTERN.fullmatch(normalized):
+        return "confirm"
+    if DENY_PATTERN.fullmatch(normalized):
+        return "deny"
+    # word by word: every word a confirm word or a filler, or the deny
+    # word and fillers
+    words = [normalize_reply(word) for word in WORD_SEP_PATTERN.split(reply)]
+    words = [word for word in words
+             if word and word not in REPLY_FILLER_WORDS]
+    if not words:
+        return None
+    if all(CONFIRM_PATTERN.fullmatch(word) for word in words):
+        return "confirm"
+    if DENY_PATTERN.fullmatch("".join(words)):
+        return "deny"
+    return None
+
+
+class ConfirmIntentClassifier:
+    """
+    Local fast path in front of the judge LLM of proc_confirm. A reply is
+    decided here only when it is short, asks nothing and either matches the
+    confirm lexicon or one deny word as a whole, or its words are confirm
+    words and fillers, or one deny word and fillers. A reply adding
+    anything, e.g. "ok run it tomorrow" or "don't cancel", returns None and
+    goes to the LLM.
+    """
+
+    def __init__(self, max_chars: int = 48):
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+        self.stats = {"lexicon": 0, "llm": 0}
+
+    def _count(self, source: str) -> None:
+        with self.lock:
+            self.stats[source] += 1
+
+    def classify(self, reply: str | None) -> dict[str, Any] | None:
+        """
+        Return the judge result for a plain confirm / deny reply, None when
+        the LLM has to decide.
+        """
+        if not reply or len(reply) > self.max_chars or DEFER_PATTERN.search(
+                reply):
+            self._count("llm")
+            return None
+        decision = _lexicon_decision(reply)
+        if decision is None:
+            self._count("llm")
+            return None
+        self._count("lexicon")
+        return {
+            "decision": decision,
+            "clarification_needed": False,
+            "clarification_query": None
+        }
@@ -0,0 +1,123 @@
+"""
+Incremental extraction of one top-level string field from a JSON answer
+being streamed, e.g. the markdown `flow_plan` of the plan node, so it can be
+shown while the rest of the JSON is still generated. Every chunk is scanned
+once, unlike re-parsing the whole partial JSON on each token.
+"""
+import json
+import re
+
+ESCAPES = {
+    '"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n",
+    "r": "\r", "t": "\t"
+}
+
+
+class JsonFieldStream:
+    """
+    feed() the raw chunks of a JSON object, get back the decoded text of
+    the string value of `field` they add.
+    """
+
+    def __init__(self, field: str):
+        self.key = f'"{field}"'
+        self.key_pattern = re.compile(re.escape(self.key) + r'\s*:\s*"')
+        self.key_prefix = re.compile(r"\s*(?::\s*)?")
+        self.raw = ""
+        # index in raw of the next undecoded char of the value, None until
+        # the key is found
+        self.pos: int | None = None
+        self.done = False
+        self.text = ""
+        # where the key search goes on, if it is inside a string there and
+        # how many objects and arrays are open
+        self.scan_pos = 0
+        self.in_string = False
+        self.depth = 0
+
+    def _may_become_key(self, idx: int) -> bool:
+        rest = self.raw[idx:]
+        if len(rest) <= len(self.key):
+            return self.key.startswith(rest)
+        return rest.startswith(self.key) and bool(
+            self.key_prefix.fullmatch(rest[len(self.key):]))
+
+    def _find_key(self) -> None:
+        # the key must be outside of any other string, and a key of the
+        # top-level object rather than of a nested one
+        raw, idx = self.raw, self.scan_pos
+        while idx < len(raw):
+            char = raw[idx]
+            if self.in_string and char == "\\":
+                if idx + 1 >= len(raw):
+                    break
+                idx += 2
+                continue
+            if not self.in_string and char in "{[":
+                self.depth += 1
+            elif not self.in_string and char in "}]":
+                self.depth -= 1
+            elif char == '"':
+                if not self.in_string and self.depth == 1:
+                    match = self.key_pattern.match(raw, idx)
+                    if match:
+                        self.pos = match.end()
+                        return
+                    if self._may_become_key(idx):
+                        break
+                self.in_string = not self.in_string
+            idx += 1
+        self.scan_pos = idx
+
+    def _decode(self) -> str:
+        pieces = []
+        raw, pos = self.raw, self.pos
+        while pos < len(raw):
+            char = raw[pos]
+            if char == '"':
+                self.done = True
+                pos += 1
+                break
+            if char != "\\":
+                end = pos
+                while end < len(raw) and raw[end] not in '"\\':
+                    end += 1
+                pieces.append(raw[pos:end])
+                pos = end
+                continue
+            if pos + 1 >= len(raw):
+                break
+            code = raw[pos + 1]
+            if code != "u":
+                pieces.append(ESCAPES.get(code, code))
+                pos += 2
+                continue
+            # \uXXXX, a surrogate pair is decoded together
+            if pos + 6 > len(raw):
+                break
+            hex_end = pos + 6
+            if 0xD800 <= int(raw[pos + 2:pos + 6], 16) <= 0xDBFF:
+                if pos + 12 > len(raw):
+                    break
+                hex_end = pos + 12
+            pieces.append(json.loads(f'"{raw[pos:hex_end]}"'))
+            pos = hex_end
+        self.pos = pos
+        return "".join(pieces)
+
+    def feed(self, chunk: str) -> str:
+        if self.done or not chunk:
+            return ""
+        self.raw += chunk
+        if self.pos is None:
+            self._find_key()
+            if self.pos is None:
+                # the scanned part is no longer needed
+                self.raw = self.raw[self.scan_pos:]
+                self.scan_pos = 0
+                return ""
+        delta = self._decode()
+        self.raw = self.raw[self.pos:]
+        self.pos = 0
+        self.text += delta
+        return delta
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Sequence
+from langchain_core.caches import BaseCache
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key TEXT PRIMARY KEY,
+    llm_hash TEXT NOT NULL,
+    ctx_hash TEXT,
+    query TEXT,
+    embedding BLOB,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS llm_cache_ctx ON llm_cache (llm_hash, ctx_hash);
+CREATE INDEX IF NOT EXISTS llm_cache_lru ON llm_cache (last_used);
+"""
+
+# run the LRU eviction once every this many updates
+EVICT_EVERY = 64
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _split_prompt(prompt: str) -> tuple[str, str | None, str | None]:
+    """
+    Split the serialized chat prompt into the normalized prompt, the text of
+    its last human message and a hash of everything around that message.
+    """
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return prompt, None, None
+    if not isinstance(messages, list):
+        return prompt, None, None
+
+    query_idx = None
+    for idx, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            return prompt, None, None
+        # message ids differ between sessions, they are not part of the key
+        msg.get("kwargs", {}).pop("id", None)
+        if msg.get("id", [""])[-1] in ("HumanMessage", "HumanMessageChunk"):
+            query_idx = idx
+    normalized = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    if query_idx is None:
+        return normalized, None, None
+
+    query = messages[query_idx].get("kwargs", {}).get("content")
+    if not isinstance(query, str):
+        return normalized, None, None
+    context = messages[:query_idx] + messages[query_idx + 1:]
+    ctx_hash = _sha256(json.dumps(context, sort_keys=True, ensure_ascii=False))
+    return normalized, query, ctx_hash
+
+
+class SqliteLLMCache(BaseCache):
+    """
+    LLM response cache in a local SQLite file, shared by every session on
+    the host.
+
+    - Exact match: keyed by the model parameters (`llm_string`, which
+      includes the bound tools and response_format) and the prompt.
+    - Semantic match (optional, when `embeddings` is given): for the same
+      model and the same prompt apart from the last human message, reuse
+      the answer whose human message embedding is most similar, e.g.
+      "confirm" / "yes go ahead" against the same plan.
+    - Entries expire after `ttl` seconds, the least recently used ones are
+      evicted past `max_entries`.
+    """
+
+    def __init__(
+            self,
+            db_path: str | Path,
+            ttl: float | None = 7 * 24 * 3600,
+            max_entries: int = 20000,
+            embeddings: Embeddings | None = None,
+            sim_threshold: float = 0.95
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embeddings = embeddings
+        self.sim_threshold = sim_threshold
+        self.lock = threading.Lock()
+        self.n_updates = 0
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False,
+                                    timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def _expire_before(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    def _embed(self, query: str) -> array:
+        return array("f", self.embeddings.embed_query(query))
+
+    def _semantic_lookup(
+            self,
+            llm_hash: str,
+            ctx_hash: str,
+            query: str
+    ) -> tuple[str, str] | None:
+        rows = self.conn.execute(
+            "SELECT cache_key, embedding, response FROM llm_cache "
+            "WHERE llm_hash=? AND ctx_hash=? AND embedding IS NOT NULL "
+            "AND created_at>?",
+            (llm_hash, ctx_hash, self._expire_before())
+        ).fetchall()
+        if not rows:
+            return None
+        query_vec = self._embed(query)
+        query_norm = sum(val * val for val in query_vec) ** 0.5 or 1.0
+        best, best_sim = None, self.sim_threshold
+        for cache_key, emb_blob, response in rows:
+            cand_vec = array("f")
+            cand_vec.frombytes(emb_blob)
+            cand_norm = sum(val * val for val in cand_vec) ** 0.5 or 1.0
+            sim = sum(a * b for a, b in zip(query_vec, cand_vec)) / (
+                query_norm * cand_norm)
+            if sim >= best_sim:
+                best, best_sim = (cache_key, response), sim
+        return best
+
+    def lookup(
+            self,
+            prompt: str,
+            llm_string: str
+    ) -> Sequence[Generation] | None:
+        normalized, query, ctx_hash = _split_prompt(prompt)
+        llm_hash = _sha256(llm_string)
+        cache_key = _sha256(llm_hash + normalized)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT cache_key, response FROM llm_cache "
+                "WHERE cache_key=? AND created_at>?",
+                (cache_key, self._expire_before())
+            ).fetchone()
+            if row is None and self.embeddings is not None and query:
+                row = self._semantic_lookup(llm_hash, ctx_hash, query)
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE llm_cache SET last_used=?, hits=hits+1 "
+                "WHERE cache_key=?",
+                (time.time(), row[0])
+            )
+            self.conn.commit()
+        return [loads(gen_str) for gen_str in json.loads(row[1])]
+
+    def update(
+            self,
+            prompt: str,
+            llm_string: str,
+            return_val: Sequence[Generation]
+    ) -> None:
+        normalized, query, ctx_hash = _split_prompt(prompt)
+        llm_hash = _sha256(llm_string)
+        cache_key = _sha256(llm_hash + normalized)
+        embedding = None
+        if self.embeddings is not None and query:
+            embedding = self._embed(query).tobytes()
+        response = json.dumps([dumps(gen) for gen in return_val])
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (cache_key, llm_hash, "
+                "ctx_hash, query, embedding, response, created_at, "
+                "last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, llm_hash, ctx_hash, query, embedding, response,
+                 now, now)
+            )
+            self.n_updates += 1
+            if self.n_updates % EVICT_EVERY == 0:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        self.conn.execute(
+            "DELETE FROM llm_cache WHERE created_at<=?",
+            (self._expire_before(),)
+        )
+        self.conn.execute(
+            "DELETE FROM llm_cache WHERE cache_key IN (SELECT cache_key "
+            "FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.conn.commit()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            entries, hits = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM llm_cache"
+            ).fetchone()
+        return {"entries": entries, "hits": hits}
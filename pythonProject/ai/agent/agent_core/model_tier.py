@@ -0,0 +1,118 @@
+"""
+Model tiers of the graph nodes: every node runs on the LLM of its tier
+(NODE_LLM_TIER), simple nodes on a smaller and faster model. A call of a
+node below ESCALATION_TIER is retried on ESCALATION_TIER when its answer
+can't be parsed or fails the node's check. Such calls are traced as `tier`
+spans, `escalated` tells how often the retry was needed. An answer cut off
+by the adapted output budget is first retried on the same tier, see
+output_budget.retry_truncated().
+"""
+from typing import Any, Callable
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.tools import BaseTool
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, ValidationError
+from ai.agent.ai_config.config import (
+    ESCALATION_TIER,
+    NODE_LLM_TIER,
+    gen_llm_tier
+)
+from ai.cad_agent_release.agent_core.output_budget import retry_truncated
+from ai.cad_agent_release.agent_core.tool_exec import validate_tool_call
+from ai.cad_agent_release.agent_core.tracing import trace_span
+
+# the reason to escalate, None when the answer is good enough
+AnswerCheck = Callable[[Any], str | None]
+
+
+def node_tier(node: str) -> str:
+    return NODE_LLM_TIER.get(node, ESCALATION_TIER)
+
+
+def gen_node_llm(node: str, **llm_kwargs) -> ChatOpenAI:
+    return gen_llm_tier(node_tier(node), **llm_kwargs)
+
+
+def gen_escalation_llm(node: str, **llm_kwargs) -> ChatOpenAI | None:
+    """
+    The LLM the calls of node escalate to, None when it already runs on
+    ESCALATION_TIER.
+    """
+    if node_tier(node) == ESCALATION_TIER:
+        return None
+    return gen_llm_tier(ESCALATION_TIER, **llm_kwargs)
+
+
+def schema_check(model: type[BaseModel]) -> AnswerCheck:
+    # JsonOutputParser only checks that the answer is JSON
+    def check(result: Any) -> str | None:
+        try:
+            model.model_validate(result)
+        except ValidationError as e:
+            return f"schema: {e.errors()[0]['msg']}"
+        return None
+
+    return check
+
+
+def tool_calls_check(tools_map: dict[str, BaseTool]) -> AnswerCheck:
+    def check(tool_call_msg) -> str | None:
+        if not tool_call_msg.tool_calls:
+            return "no tool call"
+        for one_call in tool_call_msg.tool_calls:
+            errors = validate_tool_call(one_call, tools_map)
+            if errors:
+                return f"tool call: {errors[0]}"
+        return None
+
+    return check
+
+
+def escalating(
+        primary: Runnable,
+        fallback: Runnable | None,
+        node: str,
+        check: AnswerCheck
+) -> Runnable:
+    """
+    Run primary, and fallback instead when the answer of primary fails to
+    parse or check() gives a reason. Returns primary itself without a
+    fallback. Both are run again once when the output budget cut them off.
+    """
+    primary = retry_truncated(primary)
+    if fallback is None:
+        return primary
+    fallback = retry_truncated(fallback)
+
+    def escalate(span: dict[str, Any], reason: str) -> None:
+        span["escalated"] = True
+        span["reason"] = reason[:200]
+
+    def run(inputs: Any, config: RunnableConfig) -> Any:
+        with trace_span("tier", node, tier=node_tier(node),
+                        escalated=False) as span:
+            try:
+                result = primary.invoke(inputs, config)
+                reason = check(result)
+            except (OutputParserException, ValidationError) as e:
+                reason = f"parse: {e}"
+            if reason is None:
+                return result
+            escalate(span, reason)
+            return fallback.invoke(inputs, config)
+
+    async def arun(inputs: Any, config: RunnableConfig) -> Any:
+        with trace_span("tier", node, tier=node_tier(node),
+                        escalated=False) as span:
+            try:
+                result = await primary.ainvoke(inputs, config)
+                reason = check(result)
+            except (OutputParserException, ValidationError) as e:
+                reason = f"parse: {e}"
+            if reason is None:
+                return result
+            escalate(span, reason)
+            return await fallback.ainvoke(inputs, config)
+
+    return RunnableLambda(run, afunc=arun, name=f"{node}_tiered")
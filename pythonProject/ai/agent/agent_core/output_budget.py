@@ -0,0 +1,260 @@
+"""
+Per-node output budgets of the LLM calls. Every node declares the most
+tokens its answer may take and how many of them the model may spend on
+thinking (NODE_OUTPUT_BUDGET). The max_tokens of the node's LLMs then
+follows the observed answer lengths: a high percentile of the recent
+completions with some headroom, rounded up to a power of two so the value,
+which is part of the LLM cache key, rarely changes. An answer cut off by
+the limit puts the node back on its declared maximum, and the call is run
+again at once when made through retry_truncated(). Only the nodes whose
+calls are retried that way should adapt, see OUTPUT_BUDGET_ADAPTIVE_NODES.
+"""
+import json
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_openai import ChatOpenAI
+
+# nodes whose calls the adapted limit cut off, within the running
+# retry_truncated() call
+_cut_off: ContextVar[list[str] | None] = ContextVar(
+    "output_budget_cut_off", default=None)
+
+
+def _completion_tokens(response: LLMResult) -> int | None:
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None),
+                            "usage_metadata", None)
+            if usage:
+                return usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("completion_tokens")
+
+
+def _truncated(response: LLMResult) -> bool:
+    return any(
+        (generation.generation_info or {}).get("finish_reason") == "length"
+        for generations in response.generations
+        for generation in generations
+    )
+
+
+def _next_pow2(value: float) -> int:
+    return 1 << max(0, math.ceil(math.log2(max(value, 1.0))))
+
+
+class OutputBudget:
+    """
+    The adaptive max_tokens of the LLMs of each node. The limit of a node
+    only moves once it has `min_samples` completions, and never goes below
+    `floor` plus its thinking budget nor above its declared maximum.
+    """
+
+    def __init__(
+            self,
+            budgets: dict[str, dict[str, int | None]],
+            path: str | Path | None = None,
+            percentile: float = 0.99,
+            headroom: float = 1.5,
+            floor: int = 256,
+            window: int = 200,
+            min_samples: int = 20,
+            adaptive: Iterable[str] | None = None
+    ):
+        """
+        :param adaptive: The nodes whose limit adapts, all of them by
+            default, the others always get their declared maximum.
+        """
+        self.budgets = budgets
+        self.adaptive = set(adaptive) if adaptive is not None else None
+        self.path = Path(path) if path is not None else None
+        self.percentile = percentile
+        self.headroom = headroom
+        self.floor = floor
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.samples: dict[str, deque[int]] = {}
+        self.limits: dict[str, int] = {}
+        self.llms: dict[str, list[ChatOpenAI]] = {}
+        self.stats: dict[str, dict[str, int]] = {}
+        for node, samples in self._load().items():
+            self.samples[node] = deque(samples, maxlen=window)
+
+    def _load(self) -> dict[str, list[int]]:
+        if self.path is None or not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(
+            {node: list(samples) for node, samples in self.samples.items()}
+        ), encoding="utf-8")
+
+    def max_tokens(self, node: str) -> int | None:
+        return self.budgets.get(node, {}).get("tokens")
+
+    def thinking(self, node: str) -> int | None:
+        return self.budgets.get(node, {}).get("thinking")
+
+    def llm_kwargs(self, node: str) -> dict[str, Any]:
+        """
+        The factory arguments of the node's declared budget, thinking is
+        disabled for a budget of 0.
+        """
+        kwargs = {}
+        if self.max_tokens(node) is not None:
+            kwargs["tokens"] = self.limit(node)
+        thinking = self.thinking(node)
+        if thinking == 0:
+            kwargs["thk_en"] = False
+        elif thinking is not None:
+            kwargs["thk_budget"] = thinking
+        return kwargs
+
+    def limit(self, node: str) -> int | None:
+        with self.lock:
+            return self.limits.get(node) or self._adapted(node)
+
+    def _adapted(self, node: str) -> int | None:
+        ceiling = self.max_tokens(node)
+        samples = self.samples.get(node)
+        if self.adaptive is not None and node not in self.adaptive:
+            return ceiling
+        if ceiling is None or not samples or len(
+                samples) < self.min_samples:
+            return ceiling
+        ranked = sorted(samples)
+        idx = min(len(ranked) - 1, int(self.percentile * len(ranked)))
+        lower = self.floor + (self.thinking(node) or 0)
+        return max(min(_next_pow2(ranked[idx] * self.headroom), ceiling),
+                   min(lower, ceiling))
+
+    def attach(self, node: str, *llms: ChatOpenAI | None) -> None:
+        with self.lock:
+            self.llms.setdefault(node, []).extend(
+                llm for llm in llms if llm is not None)
+            limit = self._adapted(node)
+            if limit is not None:
+                self.limits[node] = limit
+                self._apply(node, limit)
+
+    def _apply(self, node: str, limit: int) -> None:
+        for llm in self.llms.get(node, []):
+            llm.max_tokens = limit
+
+    def observe(self, node: str, tokens: int | None, truncated: bool) -> bool:
+        """
+        Record a completion, return True when it was cut off by a limit
+        below the declared maximum.
+        """
+        ceiling = self.max_tokens(node)
+        if ceiling is None:
+            return False
+        with self.lock:
+            cut_off = truncated and self.limits.get(node, ceiling) < ceiling
+            stats = self.stats.setdefault(
+                node, {"calls": 0, "truncated": 0, "changes": 0})
+            stats["calls"] += 1
+            samples = self.samples.setdefault(
+                node, deque(maxlen=self.window))
+            if truncated:
+                # the distribution no longer covers the answers
+                stats["truncated"] += 1
+                samples.clear()
+            elif tokens is not None:
+                samples.append(tokens)
+            limit = self._adapted(node)
+            if limit == self.limits.get(node):
+                return cut_off
+            self.limits[node] = limit
+            stats["changes"] += 1
+            self._apply(node, limit)
+            self._save()
+            return cut_off
+
+    def callback(self, node: str) -> "OutputBudgetProbe":
+        return OutputBudgetProbe(self, node)
+
+
+class OutputBudgetProbe(BaseCallbackHandler):
+    """
+    Feeds the completion lengths of one node's LLM calls to the budget.
+    """
+
+    def __init__(self, budget: OutputBudget, node: str):
+        self.budget = budget
+        self.node = node
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        cut_off = self.budget.observe(
+            self.node,
+            _completion_tokens(response),
+            _truncated(response)
+        )
+        watched = _cut_off.get()
+        if cut_off and watched is not None:
+            watched.append(self.node)
+
+
+@contextmanager
+def _watch_cut_off() -> Iterator[list[str]]:
+    token = _cut_off.set([])
+    try:
+        yield _cut_off.get()
+    finally:
+        _cut_off.reset(token)
+
+
+def retry_truncated(runnable: Runnable) -> Runnable:
+    """
+    Run runnable once more when one of its LLM calls was cut off by an
+    adapted limit, whether it returned or failed to parse the answer. The
+    node is back on its declared maximum by then.
+    """
+
+    def report_retry(cut_off: list[str]) -> None:
+        print(f"Answer of {', '.join(cut_off)} cut off by the adapted "
+              f"output budget, retrying")
+
+    def run(inputs: Any, config: RunnableConfig) -> Any:
+        with _watch_cut_off() as cut_off:
+            try:
+                result = runnable.invoke(inputs, config)
+            except Exception:
+                if not cut_off:
+                    raise
+            else:
+                if not cut_off:
+                    return result
+        report_retry(cut_off)
+        return runnable.invoke(inputs, config)
+
+    async def arun(inputs: Any, config: RunnableConfig) -> Any:
+        with _watch_cut_off() as cut_off:
+            try:
+                result = await runnable.ainvoke(inputs, config)
+            except Exception:
+                if not cut_off:
+                    raise
+            else:
+                if not cut_off:
+                    return result
+        report_retry(cut_off)
+        return await runnable.ainvoke(inputs, config)
+
+    return RunnableLambda(run, afunc=arun, name="retry_truncated")
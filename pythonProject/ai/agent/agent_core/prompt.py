@@ -198,10 +198,8 @@ rag_answer_sys_prompt = """
 You are an intelligent and knowledgeable Integrated-Circuit Domain CAD Expert 
 Assistant. Your primary goal is to provide clear, concise, and accurate 
 explanations or instructions to the user, strictly based on the retrieved 
-information provided below.
-
-**Retrieved Context Information:**
-{rag_info}
+information provided in the "Retrieved Context Information" message, which 
+follows the conversation history.
 
 **Instructions**
 1. **Synthesize and Explain:** Carefully read the "Retrieved Context Information". 
@@ -408,9 +406,9 @@ output, and dataflow between steps.
 **DO NOT Generate any tool call information(tool_calls)**, only produce a 
 natural language execution plan.
 
-# Avaliable Tools and corresponding descriptions:
-{tools_description}
-when compose the workflow, you should refer above toolset and its description.
+# Avaliable Tools
+The available tools and their descriptions are listed in the tool catalogue 
+message that follows this one.
 
 # Workflow Composition Strategy
 When faced with a Complex task:
@@ -617,6 +615,37 @@ of their requirements.
   are sufficient to generate plan.
 """
 
+# single-pass planning: the plan and the tool calls in one answer, the
+# rules of cad_plan_sys_prompt_2 are kept as they are
+cad_plan_tool_call_sys_prompt = cad_plan_sys_prompt_2.replace(
+    """**DO NOT Generate any tool call information(tool_calls)**, only produce a 
+natural language execution plan.""",
+    """Together with the natural language execution plan, produce the tool calls
+which execute it in the `tool_calls` field of your answer."""
+).replace(
+    """    "flow_plan": string | null
+}}""",
+    """    "flow_plan": string | null,
+    "tool_calls": [{{"name": string, "args": object}}] | null
+}}"""
+).replace(
+    """- DO NOT Generate any tool_calls related message or information
+  (e.g. `tool_calls`), Only generate the Json string.""",
+    """- Only generate the Json string, tool calls only go into its `tool_calls`
+  field."""
+) + """
+## tool_calls
+When `flow_results` is "success" or "partial_success", `tool_calls` lists one 
+call per automated step of `flow_plan`, in the same order:
+  - `name`: The name of the tool, exactly as in the tool catalogue.
+  - `args`: A dictionary of the tool parameters and their values, use only the
+    parameter names of the tool.
+  - For parameters depending on a previous step, put the placeholder of the 
+    plan (e.g. `[content from step 1]`) verbatim as the value.
+  - Never add a call for a manual step or for a step not in the plan.
+Otherwise `tool_calls` is null.
+"""
+
 tool_call_sys_prompt = """
 You are a specialized AI assistant designed to convert execution plans into 
 precise tool calls within a LangChain AIMessage object. Your role is to 
@@ -817,9 +846,9 @@ and provided a response. Please determine whether the user's intention is to:
 - 'deny'(cancel running the script)
 - 'clarify' (ask for more information about the script or task)
 
-This is the original proposal script/output that the user is 
-confirming: \n{agent_plan}\n
-\n
+The original proposal script/output that the user is confirming is given 
+in the message right before the user's response.
+
 Please output your answer in Json format and strictly follows this schema:
 {{
   "decision": "confirm" | "deny" | "clarify",
@@ -946,4 +975,27 @@ You will be provide with:
 * If a tool was in the original plan but no corresponding `ToolMessage` is 
   present (e.g., execution stopped early), infer that it was not executed and 
   mention it in the overall summary if significant.
-"""
\ No newline at end of file
+"""
+history_summary_sys_prompt = """
+You are an assistant that maintains a running summary of a conversation 
+between an IC CAD engineer and the CAD agent.
+
+# Input Content
+- Previous Summary: the summary of the older part of the conversation, it may 
+  be empty.
+- New Messages: the messages that followed the previous summary, each line 
+  starts with the role of the speaker.
+
+# Core Task
+* Merge the New Messages into the Previous Summary and output one updated 
+  summary.
+* Keep every concrete value the engineer gave or the agent produced: file 
+  paths, cell names, project names, pin names, tool names, parameters, 
+  confirmed or rejected plans and tool results.
+* Drop greetings, repetitions and reasoning that did not lead to a decision.
+* Write plain text in the language of the conversation, no more than 300 
+  words.
+
+# NOTE
+Only output the updated summary, Do Not include any other text.
+"""
@@ -0,0 +1,58 @@
+from typing import Sequence
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts.chat import ChatPromptTemplate, MessagesPlaceholder
+
+TOOL_CATALOGUE_PROMPT = """
+# Available Tools and corresponding descriptions:
+{tools_description}
+when compose the workflow, you should refer above toolset and its description.
+"""
+
+RAG_CONTEXT_PROMPT = """
+**Retrieved Context Information:**
+{rag_info}
+"""
+
+JUDGE_CONTEXT_PROMPT = """
+This is the original proposal script/output that the user is confirming:
+{agent_plan}
+"""
+
+
+def tool_catalogue_msg(tools_description: str) -> SystemMessage:
+    # a literal message, the descriptions are never parsed as a template
+    return SystemMessage(
+        content=TOOL_CATALOGUE_PROMPT.format(
+            tools_description=tools_description)
+    )
+
+
+def layout_prompt(
+        system_prompt: str,
+        tools_description: str | None = None,
+        history: Sequence[str] = ("chat_history",),
+        context_prompt: str | None = None,
+        human_prompt: str = "{agent_input}"
+) -> ChatPromptTemplate:
+    """
+    Build a node prompt ordered from the most to the least stable part, so
+    that successive calls share the longest token prefix in the prefix cache
+    of the LLM server:
+    1. the system prompt, fixed per node;
+    2. the tool catalogue, fixed per tool registry version;
+    3. the history placeholders, which only grow at their end;
+    4. the per-turn context, e.g. retrieved documents or the plan under
+       review;
+    5. the human message.
+    Per-turn values must go to `context_prompt` or `human_prompt`, never into
+    the system prompt.
+    """
+    messages = [("system", system_prompt)]
+    if tools_description is not None:
+        messages.append(tool_catalogue_msg(tools_description))
+    for var_name in history:
+        messages.append(MessagesPlaceholder(variable_name=var_name))
+    if context_prompt is not None:
+        messages.append(("system", context_prompt))
+    messages.append(("human", human_prompt))
+    return ChatPromptTemplate.from_messages(messages)
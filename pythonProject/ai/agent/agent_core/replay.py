@@ -0,0 +1,331 @@
+"""
+Record / replay of the LLM traffic and the tool results of agent sessions,
+to run the graph on fixed conversations without the LLM server and the EDA
+tools, e.g. to benchmark the overhead of graph_core itself.
+
+A ReplaySession serves a local stand-in of the OpenAI compatible endpoints
+and redirects the LLMs of config.py to it (LLM_URL_OVERRIDES):
+- record: requests are forwarded to the real server, every request and
+  response, streamed or not, is appended to the recording;
+- replay: the recorded responses are served back, streamed chunk by chunk
+  when the request asked for a stream.
+Tools wrapped with wrap_tool() are recorded and replayed the same way.
+Requests are matched by a hash of their canonical JSON body, identical
+requests are answered in the order they were recorded.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+from aiohttp import ClientSession, ClientTimeout, web
+from langchain_core.tools import BaseTool
+from ai.agent.ai_config.config import (
+    BASE_URL,
+    LLM_URL_OVERRIDES,
+    NORMAL_URL
+)
+
+SSE_EVENT_SEP = re.compile(r"(?<=\n\n)")
+FORWARD_HEADERS = ("authorization", "content-type", "accept")
+
+
+def _normalize_call_ids(messages: list) -> None:
+    # tool call ids may be generated on our side, e.g. by the single-pass plan
+    ids: dict[str, str] = {}
+
+    def stable(call_id: str) -> str:
+        return ids.setdefault(call_id, f"call_{len(ids)}")
+
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        if isinstance(message.get("tool_call_id"), str):
+            message["tool_call_id"] = stable(message["tool_call_id"])
+        for one_call in message.get("tool_calls") or []:
+            if isinstance(one_call, dict) and isinstance(
+                    one_call.get("id"), str):
+                one_call["id"] = stable(one_call["id"])
+
+
+def request_key(path: str, body: bytes) -> str:
+    """
+    Hash of an LLM request, the same for requests which only differ in the
+    ids of the tool calls they carry.
+    """
+    try:
+        payload = json.loads(body or b"null")
+    except ValueError:
+        payload = body.decode("utf-8", errors="replace")
+    if isinstance(payload, dict) and isinstance(payload.get("messages"), list):
+        _normalize_call_ids(payload["messages"])
+    canonical = json.dumps([path, payload], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def tool_key(name: str, args: dict[str, Any]) -> str:
+    canonical = json.dumps([name, args], sort_keys=True, default=str,
+                           ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Recording:
+    """
+    JSON lines file of recorded LLM exchanges and tool results. Records
+    with the same key are served in recording order, the last one repeats.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.records: dict[str, list[dict[str, Any]]] = defaultdict(list)
+        self.cursor: dict[str, int] = defaultdict(int)
+        self.stats = {"recorded": 0, "hits": 0, "misses": 0}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as rec_file:
+                for line in rec_file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record["key"]].append(record)
+
+    def add(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as rec_file:
+                rec_file.write(line + "\n")
+            self.records[record["key"]].append(record)
+            self.stats["recorded"] += 1
+
+    def next(self, key: str) -> dict[str, Any] | None:
+        with self.lock:
+            records = self.records.get(key)
+            if not records:
+                self.stats["misses"] += 1
+                return None
+            idx = min(self.cursor[key], len(records) - 1)
+            self.cursor[key] += 1
+            self.stats["hits"] += 1
+            return records[idx]
+
+    def rewind(self) -> None:
+        with self.lock:
+            self.cursor.clear()
+
+
+class ReplayTool(BaseTool):
+    """
+    Stands in for `inner` with the same name and args schema, records its
+    results, or serves the recorded ones without running it.
+    """
+
+    inner: BaseTool
+    recording: Recording
+    replay: bool = False
+
+    def _result(self, kwargs: dict[str, Any]) -> str:
+        record = self.recording.next(tool_key(self.name, kwargs))
+        if record is None:
+            raise RuntimeError(f"no recorded result of `{self.name}` for "
+                               f"{kwargs}")
+        if "error" in record:
+            raise RuntimeError(record["error"])
+        return record["result"]
+
+    def _record(self, kwargs: dict[str, Any], **outcome: str) -> None:
+        self.recording.add({
+            "kind": "tool",
+            "key": tool_key(self.name, kwargs),
+            "name": self.name,
+            "args": kwargs,
+            **outcome
+        })
+
+    def _run(self, **kwargs: Any) -> Any:
+        if self.replay:
+            return self._result(kwargs)
+        try:
+            # the wrapper already reports the run to the callbacks
+            result = self.inner.invoke(kwargs, {"callbacks": []})
+        except Exception as e:
+            self._record(kwargs, error=str(e))
+            raise
+        self._record(kwargs, result=str(result))
+        return result
+
+    async def _arun(self, **kwargs: Any) -> Any:
+        if self.replay:
+            return self._result(kwargs)
+        try:
+            result = await self.inner.ainvoke(kwargs, {"callbacks": []})
+        except Exception as e:
+            self._record(kwargs, error=str(e))
+            raise
+        self._record(kwargs, result=str(result))
+        return result
+
+
+class ReplaySession:
+    """
+    The local LLM endpoint and the tool wrapper of one recording. start()
+    runs the endpoint on a background event loop and redirects the LLM
+    base URLs of config.py to it, so it must be called before the LLMs are
+    built, i.e. before graph_core().
+    """
+
+    def __init__(
+            self,
+            path: str | Path,
+            record: bool = False,
+            upstreams: tuple[str, ...] = (BASE_URL, NORMAL_URL),
+            chunk_delay: float = 0.0,
+            host: str = "127.0.0.1"
+    ):
+        self.recording = Recording(path)
+        self.record = record
+        self.upstreams = upstreams
+        # seconds between two streamed chunks, 0 measures the graph alone
+        self.chunk_delay = chunk_delay
+        self.host = host
+        self.base_url: str | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.runner: web.AppRunner | None = None
+        self.client: ClientSession | None = None
+        self.thread: threading.Thread | None = None
+        self.serve_time = 0.0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {**self.recording.stats, "serve_time": self.serve_time}
+
+    def wrap_tool(self, tool: BaseTool) -> BaseTool:
+        return ReplayTool(
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema,
+            inner=tool,
+            recording=self.recording,
+            replay=not self.record
+        )
+
+    async def _forward(
+            self,
+            request: web.Request,
+            upstream: str,
+            path: str,
+            body: bytes
+    ) -> tuple[web.StreamResponse, dict[str, Any]]:
+        headers = {name: value for name, value in request.headers.items()
+                   if name.lower() in FORWARD_HEADERS}
+        url = upstream.rstrip("/") + "/" + path
+        async with self.client.post(url, data=body,
+                                    headers=headers) as upstream_resp:
+            content_type = upstream_resp.headers.get(
+                "Content-Type", "application/json")
+            response = web.StreamResponse(
+                status=upstream_resp.status,
+                headers={"Content-Type": content_type}
+            )
+            await response.prepare(request)
+            chunks = []
+            async for data in upstream_resp.content.iter_any():
+                chunks.append(data)
+                await response.write(data)
+            await response.write_eof()
+        return response, {
+            "status": upstream_resp.status,
+            "content_type": content_type,
+            "body": b"".join(chunks).decode("utf-8", errors="replace")
+        }
+
+    async def _serve(
+            self,
+            request: web.Request,
+            record: dict[str, Any]
+    ) -> web.StreamResponse:
+        response = web.StreamResponse(
+            status=record["status"],
+            headers={"Content-Type": record["content_type"]}
+        )
+        await response.prepare(request)
+        if record["content_type"].startswith("text/event-stream"):
+            for event in SSE_EVENT_SEP.split(record["body"]):
+                if event:
+                    await response.write(event.encode("utf-8"))
+                    if self.chunk_delay:
+                        await asyncio.sleep(self.chunk_delay)
+        else:
+            await response.write(record["body"].encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        start = time.perf_counter()
+        upstream = self.upstreams[int(request.match_info["upstream"])]
+        path = request.match_info["path"]
+        body = await request.read()
+        key = request_key(path, body)
+        try:
+            if self.record:
+                response, exchange = await self._forward(
+                    request, upstream, path, body)
+                self.recording.add({"kind": "llm", "key": key, "path": path,
+                                    "request": body.decode("utf-8"),
+                                    **exchange})
+                return response
+            record = self.recording.next(key)
+            if record is None:
+                return web.json_response({"error": {
+                    "message": f"no recorded response for request {key}",
+                    "type": "replay_miss"
+                }}, status=404)
+            return await self._serve(request, record)
+        finally:
+            self.serve_time += time.perf_counter() - start
+
+    async def _start(self) -> None:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.add_routes([
+            web.post("/{upstream:\\d+}/{path:.*}", self.handle)
+        ])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://{self.host}:{port}"
+        if self.record:
+            self.client = ClientSession(timeout=ClientTimeout(total=None))
+
+    def start(self) -> "ReplaySession":
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name="cad-agent-replay",
+            daemon=True
+        )
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        for idx, upstream in enumerate(self.upstreams):
+            LLM_URL_OVERRIDES[upstream] = f"{self.base_url}/{idx}/"
+        return self
+
+    async def _stop(self) -> None:
+        if self.client is not None:
+            await self.client.close()
+        await self.runner.cleanup()
+
+    def stop(self) -> None:
+        for upstream in self.upstreams:
+            LLM_URL_OVERRIDES.pop(upstream, None)
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
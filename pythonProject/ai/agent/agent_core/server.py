@@ -0,0 +1,310 @@
+"""
+Headless server mode: one compiled graph, and so one embedding model,
+reranker and BM25 corpus, shared by the conversations of every user on the
+host. The Qt signals of graph_core() are replaced by per-session event
+streams.
+
+HTTP API:
+- POST   /sessions                  -> {"thread_id": ...}
+- GET    /sessions/{thread_id}/ws   websocket, send turn inputs as JSON
+                                    {"query_str", "assert_rag", "assert_flow"}
+                                    and receive the events of the session
+- POST   /sessions/{thread_id}/turns  run one turn, return all its events
+- DELETE /sessions/{thread_id}
+- GET    /health
+
+Events are JSON objects with a "type": token, status, tool, node,
+interrupt, error or turn_end.
+
+usage: python -m ai.agent.agent_core.server [--host 127.0.0.1] [--port 8765]
+"""
+import argparse
+import asyncio
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any
+from aiohttp import WSMsgType, web
+from langchain_core.messages import BaseMessage, message_to_dict
+from ai.agent.ai_config.config import (
+    SERVER_HOST,
+    SERVER_MAX_TURNS,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    http_pool_stats
+)
+from ai.cad_agent_release.agent_core.graph_driver import astream_turn
+from ai.cad_agent_release.tools.sys_tools import work_dir
+
+_current_session: ContextVar["Session | None"] = ContextVar(
+    "agent_session", default=None
+)
+
+TURN_INPUT_KEYS = ("query_str", "assert_rag", "assert_flow")
+
+
+class SessionSignal:
+    """
+    Stands in for the pyqtSignal objects taken by graph_core(), emit()
+    publishes to the session whose turn is running in the current context.
+    """
+
+    def __init__(self, event_type: str):
+        self.event_type = event_type
+
+    def emit(self, payload: Any) -> None:
+        session = _current_session.get()
+        if session is None:
+            return
+        if isinstance(payload, dict):
+            session.publish({"type": self.event_type, **payload})
+        else:
+            session.publish({"type": self.event_type, "content": payload})
+
+
+class Session:
+    """
+    One conversation (a checkpointer thread) and its event subscribers.
+    publish() may be called from any thread.
+    """
+
+    def __init__(self, thread_id: str, loop: asyncio.AbstractEventLoop):
+        self.thread_id = thread_id
+        self.loop = loop
+        self.subscribers: set[asyncio.Queue] = set()
+        self.turn_task: asyncio.Task | None = None
+        # the working directory of the tools, see sys_tools.work_dir()
+        self.work_dir = [os.getcwd()]
+
+    @property
+    def busy(self) -> bool:
+        return self.turn_task is not None and not self.turn_task.done()
+
+    def _fan_out(self, event: dict[str, Any]) -> None:
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def publish(self, event: dict[str, Any]) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._fan_out(event)
+        else:
+            self.loop.call_soon_threadsafe(self._fan_out, event)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+
+def _jsonable(obj: Any) -> Any:
+    if isinstance(obj, BaseMessage):
+        return message_to_dict(obj)
+    return str(obj)
+
+
+def _dump_event(event: dict[str, Any]) -> str:
+    return json.dumps(event, default=_jsonable, ensure_ascii=False)
+
+
+def _turn_input(data: Any) -> dict[str, Any]:
+    if not isinstance(data, dict) or not isinstance(
+            data.get("query_str"), str):
+        raise ValueError("a turn needs a string `query_str`")
+    return {
+        "query_str": data["query_str"],
+        "assert_rag": bool(data.get("assert_rag", False)),
+        "assert_flow": bool(data.get("assert_flow", False))
+    }
+
+
+class AgentServer:
+    """
+    Runs the turns of many sessions on one event loop, at most
+    `max_turns` at once. The blocking work of a turn goes to a pool of
+    `workers` threads.
+    """
+
+    def __init__(
+            self,
+            graph_app=None,
+            max_turns: int = SERVER_MAX_TURNS,
+            workers: int = SERVER_WORKERS
+    ):
+        self.graph_app = graph_app
+        self.max_turns = max_turns
+        self.workers = workers
+        self.sessions: dict[str, Session] = {}
+        self.turn_slots: asyncio.Semaphore | None = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="cad-agent-worker"
+        )
+
+    def session(self, thread_id: str) -> Session:
+        # unknown ids attach to the thread kept by the checkpointer
+        if thread_id not in self.sessions:
+            self.sessions[thread_id] = Session(
+                thread_id, asyncio.get_running_loop())
+        return self.sessions[thread_id]
+
+    async def _run_turn(
+            self,
+            session: Session,
+            user_input: dict[str, Any]
+    ) -> None:
+        async with self.turn_slots:
+            token = _current_session.set(session)
+            try:
+                with work_dir(session.work_dir):
+                    async for event in astream_turn(
+                            self.graph_app,
+                            session.thread_id,
+                            user_input,
+                            stream_tokens=False
+                    ):
+                        session.publish(event)
+            except Exception as e:
+                session.publish({"type": "error", "message": str(e)})
+            finally:
+                _current_session.reset(token)
+                session.publish({"type": "turn_end"})
+
+    def start_turn(
+            self,
+            session: Session,
+            user_input: dict[str, Any]
+    ) -> asyncio.Task:
+        if session.busy:
+            raise RuntimeError(
+                f"session `{session.thread_id}` is running a turn")
+        session.turn_task = asyncio.create_task(
+            self._run_turn(session, user_input))
+        return session.turn_task
+
+    # ------------ HTTP handlers --------------------
+    async def create_session(self, request: web.Request) -> web.Response:
+        session = self.session(uuid.uuid4().hex)
+        return web.json_response({"thread_id": session.thread_id})
+
+    async def delete_session(self, request: web.Request) -> web.Response:
+        session = self.sessions.pop(request.match_info["thread_id"], None)
+        if session is not None and session.busy:
+            session.turn_task.cancel()
+        return web.json_response({"deleted": session is not None})
+
+    async def run_turn(self, request: web.Request) -> web.Response:
+        session = self.session(request.match_info["thread_id"])
+        try:
+            user_input = _turn_input(await request.json())
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        queue = session.subscribe()
+        try:
+            try:
+                self.start_turn(session, user_input)
+            except RuntimeError as e:
+                raise web.HTTPConflict(text=str(e))
+            events = []
+            while True:
+                event = await queue.get()
+                events.append(event)
+                if event["type"] == "turn_end":
+                    break
+        finally:
+            session.unsubscribe(queue)
+        return web.json_response(text=_dump_event({"events": events}))
+
+    async def session_ws(self, request: web.Request) -> web.WebSocketResponse:
+        session = self.session(request.match_info["thread_id"])
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        queue = session.subscribe()
+
+        async def pump_events():
+            while True:
+                event = await queue.get()
+                await ws.send_str(_dump_event(event))
+
+        sender = asyncio.create_task(pump_events())
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    self.start_turn(session, _turn_input(json.loads(msg.data)))
+                except (ValueError, RuntimeError) as e:
+                    await ws.send_str(_dump_event(
+                        {"type": "error", "message": str(e)}))
+        finally:
+            sender.cancel()
+            session.unsubscribe(queue)
+        return ws
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "sessions": len(self.sessions),
+            "running_turns": sum(
+                session.busy for session in self.sessions.values()),
+            "max_turns": self.max_turns,
+            "ready": self.graph_app is not None,
+            "llm_http_pools": http_pool_stats()
+        })
+
+    async def _startup(self, app: web.Application) -> None:
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(self.executor)
+        self.turn_slots = asyncio.Semaphore(self.max_turns)
+        if self.graph_app is None:
+            # loads the models and the retrieval stack, once per host
+            from ai.cad_agent_release.agent_core.graph_core import graph_core
+            self.graph_app = await loop.run_in_executor(
+                None,
+                graph_core,
+                SessionSignal("token"),
+                SessionSignal("tool"),
+                SessionSignal("status")
+            )
+
+    async def _cleanup(self, app: web.Application) -> None:
+        for session in self.sessions.values():
+            if session.busy:
+                session.turn_task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/sessions", self.create_session),
+            web.delete("/sessions/{thread_id}", self.delete_session),
+            web.post("/sessions/{thread_id}/turns", self.run_turn),
+            web.get("/sessions/{thread_id}/ws", self.session_ws),
+            web.get("/health", self.health)
+        ])
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--max-turns", type=int, default=SERVER_MAX_TURNS)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    args = parser.parse_args()
+
+    server = AgentServer(max_turns=args.max_turns, workers=args.workers)
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+from langchain_core.runnables import RunnableConfig
+
+
+def speculation_key(*parts: Any) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def config_thread_id(config: RunnableConfig | None) -> str | None:
+    return ((config or {}).get("configurable") or {}).get("thread_id")
+
+
+class Speculator:
+    """
+    Runs work the graph will probably need next while it waits for the
+    user, e.g. the toolcall_plan LLM call while the plan is being read.
+    A result is only used when the consumer asks for the same key, it is
+    dropped otherwise. At most one speculation per conversation thread.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="cad-agent-spec"
+        )
+        self.lock = threading.Lock()
+        # thread id -> (key, future)
+        self.pending: dict[str, tuple[str, Future]] = {}
+        self.stats = {"started": 0, "used": 0, "discarded": 0}
+
+    def start(
+            self,
+            thread_id: str,
+            key: str,
+            func: Callable[[], Any]
+    ) -> None:
+        with self.lock:
+            current = self.pending.get(thread_id)
+            # the node that starts it runs again when the graph resumes
+            if current is not None and current[0] == key:
+                return
+            if current is not None:
+                current[1].cancel()
+                self.stats["discarded"] += 1
+            self.pending[thread_id] = (key, self.executor.submit(func))
+            self.stats["started"] += 1
+
+    def take(self, thread_id: str, key: str) -> Future | None:
+        """
+        Hand over the speculation of thread_id if it was started for key.
+        """
+        with self.lock:
+            current = self.pending.pop(thread_id, None)
+            if current is None:
+                return None
+            if current[0] != key:
+                current[1].cancel()
+                self.stats["discarded"] += 1
+                return None
+            self.stats["used"] += 1
+            return current[1]
+
+    def discard(self, thread_id: str) -> None:
+        with self.lock:
+            current = self.pending.pop(thread_id, None)
+            if current is not None:
+                current[1].cancel()
+                self.stats["discarded"] += 1
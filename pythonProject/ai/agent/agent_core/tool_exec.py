@@ -0,0 +1,410 @@
+import os
+import re
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Sequence
+from PyQt5.QtCore import pyqtSignal
+from pydantic import TypeAdapter, ValidationError
+from langchain_core.tools import BaseTool
+from langchain_core.messages import ToolMessage
+from ai.cad_agent_release.agent_core.artifact_store import ArtifactStore
+from ai.cad_agent_release.agent_core.tool_stream import ToolOutputStream
+
+MAX_TOOL_WORKERS = 4
+# the GUI preview of a result is taken from this many leading chars only
+PREVIEW_CHARS = 1024
+
+# Placeholders emitted by the plan / tool_call prompts, e.g.
+# `[content from step 1]`, `[derived from the result from step2]`,
+# `<output_of_step_2>`, `{previous_tool_output}`, `[step_3_result]`.
+PLACEHOLDER_PATTERN = re.compile(
+    r"\[[^\[\]]*(?:step|output|result)[^\[\]]*\]"
+    r"|<[^<>]*(?:step|output|result)[^<>]*>"
+    r"|\{\{?[^{}]*(?:step|output|result)[^{}]*\}?\}",
+    re.IGNORECASE
+)
+STEP_REF_PATTERN = re.compile(r"step[\s_-]*(\d+)", re.IGNORECASE)
+
+# Tools that change process-wide state, nothing may run beside them.
+BARRIER_TOOLS = {"change_dir"}
+
+# Tools known to have no side effects. Every other tool, e.g. the EDA
+# scripts of auto_reg_tools(), may write the paths of its args and the
+# files next to them, it only runs beside calls on other absolute paths.
+READ_ONLY_TOOLS = {
+    "get_current_dir", "list_directory", "check_exist", "get_permissions",
+    "read_tool", "read_artifact"
+}
+# A relative path, or a bare file name, e.g. `out/rpt` or `top.v`.
+RELATIVE_PATH_PATTERN = re.compile(
+    r"(?:\.{1,2}|[\w.-]+)(?:/[\w.-]*)+|\.{1,2}|[\w-][\w.-]*\.[A-Za-z]\w*"
+)
+
+
+def _iter_arg_str(args: Any):
+    if isinstance(args, str):
+        yield args
+    elif isinstance(args, dict):
+        for value in args.values():
+            yield from _iter_arg_str(value)
+    elif isinstance(args, (list, tuple)):
+        for value in args:
+            yield from _iter_arg_str(value)
+
+
+def find_placeholders(args: Any) -> list[str]:
+    """
+    Return every unresolved placeholder found in the tool call args.
+    """
+    holders = []
+    for arg_str in _iter_arg_str(args):
+        holders.extend(PLACEHOLDER_PATTERN.findall(arg_str))
+    return holders
+
+
+def _step_refs(holders: list[str]) -> set[int] | None:
+    """
+    Step numbers referenced by the placeholders, None means a placeholder
+    does not name its step and may depend on any earlier call.
+    """
+    steps = set()
+    for holder in holders:
+        found = STEP_REF_PATTERN.findall(holder)
+        if not found:
+            return None
+        steps.update(int(num) for num in found)
+    return steps
+
+
+def _call_step(tool_call: dict, default: int) -> int:
+    # toolcall_plan names the calls `call_<step_number>`
+    match = re.fullmatch(r"call_(\d+)", str(tool_call.get("id", "")))
+    return int(match.group(1)) if match else default
+
+
+def _path_args(tool_call: dict) -> set[str] | None:
+    """
+    The absolute paths in the args, None when an arg is a relative path,
+    which depends on the working directory at run time.
+    """
+    paths = set()
+    for arg in _iter_arg_str(tool_call["args"]):
+        arg = os.path.expanduser(arg.strip())
+        if arg.startswith("/"):
+            paths.add(os.path.normpath(arg))
+        elif "://" not in arg and RELATIVE_PATH_PATTERN.fullmatch(arg):
+            return None
+    return paths
+
+
+def _paths_conflict(
+        paths_a: set[str] | None,
+        paths_b: set[str] | None
+) -> bool:
+    # unknown paths may be any path
+    if paths_a is None or paths_b is None:
+        return True
+    for path_a in paths_a:
+        for path_b in paths_b:
+            if (path_a == path_b or path_b.startswith(path_a + "/")
+                    or path_a.startswith(path_b + "/")):
+                return True
+    return False
+
+
+def _writable_paths(tool_call: dict) -> set[str] | None:
+    paths = _path_args(tool_call)
+    # a writer without any path arg writes where it runs
+    if not paths and tool_call["name"] not in READ_ONLY_TOOLS:
+        return None
+    return paths
+
+
+def build_tool_dag(tool_calls: Sequence[dict]) -> list[set[int]]:
+    """
+    Build the dependency graph of the pending tool calls.
+    :param tool_calls: The pending tool calls, in plan order.
+    :return: For each call, the indices of the earlier calls it must wait for.
+    """
+    step_index = {
+        _call_step(one_call, idx + 1): idx
+        for idx, one_call in enumerate(tool_calls)
+    }
+    dag = []
+    for idx, one_call in enumerate(tool_calls):
+        deps = set()
+        refs = _step_refs(find_placeholders(one_call["args"]))
+        if refs is None:
+            deps.update(range(idx))
+        else:
+            deps.update(step_index[step] for step in refs
+                        if step_index.get(step, idx) < idx)
+
+        call_paths = _writable_paths(one_call)
+        for prev_idx in range(idx):
+            prev_call = tool_calls[prev_idx]
+            if (one_call["name"] in BARRIER_TOOLS
+                    or prev_call["name"] in BARRIER_TOOLS):
+                deps.add(prev_idx)
+            elif ((one_call["name"] not in READ_ONLY_TOOLS
+                   or prev_call["name"] not in READ_ONLY_TOOLS)
+                  and _paths_conflict(call_paths,
+                                      _writable_paths(prev_call))):
+                deps.add(prev_idx)
+        dag.append(deps)
+    return dag
+
+
+def ready_tool_calls(tool_calls: Sequence[dict]) -> list[int]:
+    """
+    Indices of the pending calls which can run now. The head call is always
+    ready because check_run_end only sends it here once its args are
+    resolved, the others must neither wait for an earlier call nor hold a
+    placeholder.
+    """
+    if not tool_calls:
+        return []
+    dag = build_tool_dag(tool_calls)
+    ready = [0]
+    for idx in range(1, len(tool_calls)):
+        if not dag[idx] and not find_placeholders(tool_calls[idx]["args"]):
+            ready.append(idx)
+    return ready
+
+
+def _emit_start(tool_calls: Sequence[dict], qt_slot_sig: pyqtSignal(dict)):
+    for tool_dict in tool_calls:
+        qt_slot_sig.emit({
+            "tool_name": tool_dict['name'],
+            "status": "start",
+            "message": f"Invoking tool: `{tool_dict['name']}`\n"
+        })
+
+
+def _emit_done(
+        tool_name: str,
+        tool_run_result: str,
+        qt_slot_sig: pyqtSignal(dict),
+        streamed: bool = False
+):
+    # the output of a streaming tool is already on the GUI
+    if not streamed:
+        rslt_show_gui = " ".join(
+            tool_run_result[:PREVIEW_CHARS].split()[:30])
+        qt_slot_sig.emit({
+            "tool_name": tool_name,
+            "status": "result",
+            "message": f"{rslt_show_gui} ... ...\n"
+        })
+    qt_slot_sig.emit({
+        "tool_name": tool_name,
+        "status": "end",
+        "message": f"Done Tool: `{tool_name}`\n"
+    })
+
+
+def _finish_result(
+        tool_run_result: str,
+        stream: ToolOutputStream,
+        store: ArtifactStore | None
+) -> str:
+    # the text kept in tool_run_history, large results become references
+    if store is None:
+        return tool_run_result
+    tool_run_result = store.compact(tool_run_result)
+    if stream.reference is not None:
+        return f"{tool_run_result}\n{stream.reference}"
+    return tool_run_result
+
+
+def _tool_messages(
+        tool_calls: Sequence[dict],
+        results: Sequence[str]
+) -> list[ToolMessage]:
+    return [
+        ToolMessage(
+            content=(f"The result after running tool `{tool_dict['name']}` "
+                     f"is {tool_run_result}"),
+            tool_call_id=tool_dict['id'],
+            name=tool_dict['name']
+        )
+        for tool_dict, tool_run_result in zip(tool_calls, results)
+    ]
+
+
+def run_tool_calls(
+        tool_calls: Sequence[dict],
+        tools_map: dict[str, BaseTool],
+        qt_slot_sig: pyqtSignal(dict),
+        max_workers: int = MAX_TOOL_WORKERS,
+        store: ArtifactStore | None = None
+) -> list[ToolMessage]:
+    """
+    Run independent tool calls on a bounded worker pool.
+    :return: One ToolMessage per call, in the same order as tool_calls, the
+        results longer than the inline limit of `store` are replaced by
+        artifact references.
+    """
+
+    def run_one(tool_dict: dict) -> tuple[str, str, bool]:
+        tool_on_call = tools_map.get(tool_dict['name'])
+        if tool_on_call is None:
+            error = f"Error: Tool `{tool_dict['name']}` is not registered."
+            return error, error, False
+        with ToolOutputStream(tool_dict['name'], qt_slot_sig,
+                              store=store) as stream:
+            try:
+                tool_run_result = str(tool_on_call.invoke(tool_dict['args']))
+            except Exception as e:
+                tool_run_result = f"Error: Failed to run tool: {str(e)}"
+        return (tool_run_result,
+                _finish_result(tool_run_result, stream, store),
+                stream.streamed)
+
+    _emit_start(tool_calls, qt_slot_sig)
+    results = [""] * len(tool_calls)
+    pool_size = max(1, min(max_workers, len(tool_calls)))
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        # the workers see the callbacks and session of the calling node
+        futures = {
+            executor.submit(contextvars.copy_context().run, run_one,
+                            tool_dict): idx
+            for idx, tool_dict in enumerate(tool_calls)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            tool_run_result, results[idx], streamed = future.result()
+            _emit_done(tool_calls[idx]['name'], tool_run_result, qt_slot_sig,
+                       streamed=streamed)
+
+    return _tool_messages(tool_calls, results)
+
+
+async def arun_tool_calls(
+        tool_calls: Sequence[dict],
+        tools_map: dict[str, BaseTool],
+        qt_slot_sig: pyqtSignal(dict),
+        max_workers: int = MAX_TOOL_WORKERS,
+        store: ArtifactStore | None = None
+) -> list[ToolMessage]:
+    """
+    Async twin of run_tool_calls, at most max_workers tools run at once.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def run_one(tool_dict: dict) -> str:
+        tool_on_call = tools_map.get(tool_dict['name'])
+        streamed = False
+        if tool_on_call is None:
+            tool_run_result = (f"Error: Tool `{tool_dict['name']}` is not "
+                               f"registered.")
+            kept_result = tool_run_result
+        else:
+            async with semaphore:
+                with ToolOutputStream(tool_dict['name'], qt_slot_sig,
+                                      store=store) as stream:
+                    try:
+                        tool_run_result = str(
+                            await tool_on_call.ainvoke(tool_dict['args'])
+                        )
+                    except Exception as e:
+                        tool_run_result = (f"Error: Failed to run tool: "
+                                           f"{str(e)}")
+                streamed = stream.streamed
+            kept_result = _finish_result(tool_run_result, stream, store)
+        _emit_done(tool_dict['name'], tool_run_result, qt_slot_sig,
+                   streamed=streamed)
+        return kept_result
+
+    _emit_start(tool_calls, qt_slot_sig)
+    results = await asyncio.gather(
+        *(run_one(tool_dict) for tool_dict in tool_calls)
+    )
+    return _tool_messages(tool_calls, results)
+
+
+def _required_args(tool: BaseTool | None) -> list[str]:
+    if tool is None or tool.args_schema is None:
+        return []
+    if isinstance(tool.args_schema, dict):
+        return tool.args_schema.get("required", [])
+    return tool.args_schema.model_json_schema().get("required", [])
+
+
+JSON_SCHEMA_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict
+}
+
+
+def _arg_error(tool: BaseTool, arg_name: str, value: Any) -> str | None:
+    schema = tool.args_schema
+    if isinstance(schema, dict):
+        properties = schema.get("properties", {})
+        if arg_name not in properties:
+            return f"`{tool.name}` has no parameter `{arg_name}`"
+        expected = JSON_SCHEMA_TYPES.get(properties[arg_name].get("type"))
+        if expected is not None and not isinstance(value, expected):
+            return (f"`{tool.name}.{arg_name}` expects "
+                    f"{properties[arg_name]['type']}")
+        return None
+    field = schema.model_fields.get(arg_name)
+    if field is None:
+        return f"`{tool.name}` has no parameter `{arg_name}`"
+    try:
+        TypeAdapter(field.annotation).validate_python(value)
+    except ValidationError as e:
+        return f"`{tool.name}.{arg_name}`: {e.errors()[0]['msg']}"
+    return None
+
+
+def validate_tool_call(
+        tool_call: dict,
+        tools_map: dict[str, BaseTool]
+) -> list[str]:
+    """
+    Check a tool call which did not come from a bind_tools LLM answer
+    against the schema of its tool. Args holding a step placeholder and
+    missing required args are left to the plan_update LLM.
+    :return: The errors found, empty when the call can be run.
+    """
+    tool = tools_map.get(tool_call.get("name"))
+    if tool is None:
+        return [f"unknown tool `{tool_call.get('name')}`"]
+    args = tool_call.get("args")
+    if not isinstance(args, dict):
+        return [f"the args of `{tool.name}` are not an object"]
+    if tool.args_schema is None:
+        return []
+    errors = []
+    for arg_name, value in args.items():
+        if find_placeholders(value):
+            continue
+        error = _arg_error(tool, arg_name, value)
+        if error is not None:
+            errors.append(error)
+    return errors
+
+
+def find_unresolved_args(
+        tool_call: dict,
+        tool: BaseTool | None
+) -> list[str]:
+    """
+    Names of the args which still need the plan_update LLM: those holding a
+    step placeholder and the required ones that are missing or empty.
+    """
+    args = tool_call.get("args") or {}
+    unresolved = [arg_name for arg_name, value in args.items()
+                  if find_placeholders(value)]
+    for arg_name in _required_args(tool):
+        value = args.get(arg_name)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            if arg_name not in unresolved:
+                unresolved.append(arg_name)
+    return unresolved
@@ -0,0 +1,253 @@
+"""
+Tool retrieval index of the planning and tool-call nodes: instead of the
+whole registry, a request is given the tools whose name, description and
+args are closest to it by embedding, plus the tools it names, so their
+prompts stay about the same size as tools are added. The tool vectors are
+computed once per registry version, the chains of the most recent
+`max_subsets` tool subsets are kept. An answer that fails with the subset is
+redone with every tool, such calls are traced as `tool_subset` spans.
+"""
+import asyncio
+import hashlib
+import math
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Callable, Iterable
+from langchain_core.embeddings import Embeddings
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.tools import BaseTool
+from pydantic import ValidationError
+from ai.cad_agent_release.agent_core.callbacks import (
+    JsonFieldGUICallbackHandler
+)
+from ai.cad_agent_release.agent_core.model_tier import AnswerCheck
+from ai.cad_agent_release.agent_core.tool_registry import ToolRegistry
+from ai.cad_agent_release.agent_core.tracing import trace_span
+
+
+def tool_text(tool: BaseTool) -> str:
+    args = "; ".join(
+        f"{name}: {schema.get('description') or schema.get('type', '')}"
+        for name, schema in tool.args.items()
+    )
+    return f"{tool.name}: {tool.description or ''}\nargs: {args}"
+
+
+def _unit(vector: Iterable[float]) -> array:
+    vector = array("f", vector)
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return array("f", (value / norm for value in vector))
+
+
+def _recent_text(inputs: dict[str, Any], n_msgs: int = 2) -> str:
+    texts = []
+    for value in inputs.values():
+        if isinstance(value, list):
+            texts.extend(str(getattr(msg, "content", msg))
+                         for msg in value[-n_msgs:])
+    return "\n".join(texts)
+
+
+def tools_key(tools: list[BaseTool]) -> str:
+    return hashlib.sha1(
+        "\0".join(one_tool.name for one_tool in tools).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def with_tool_fallback(
+        subset: Runnable,
+        full: Runnable,
+        node: str,
+        check: AnswerCheck,
+        n_tools: int,
+        stream: JsonFieldGUICallbackHandler | None = None
+) -> Runnable:
+    """
+    Run subset, and full instead when its answer fails to parse or check()
+    gives a reason. The answer of subset isn't streamed by `stream`, it is
+    shown once kept so that a fallback doesn't show two answers.
+    """
+
+    def holding():
+        return stream.holding() if stream is not None else nullcontext()
+
+    def keep(result: Any) -> Any:
+        if stream is not None:
+            stream.release(result)
+        return result
+
+    def fall_back(span: dict[str, Any], reason: str) -> None:
+        span["fell_back"] = True
+        span["reason"] = reason[:200]
+
+    def run(inputs: Any, config: RunnableConfig) -> Any:
+        with trace_span("tool_subset", node, n_tools=n_tools,
+                        fell_back=False) as span:
+            try:
+                with holding():
+                    result = subset.invoke(inputs, config)
+                reason = check(result)
+            except (OutputParserException, ValidationError) as e:
+                reason = f"parse: {e}"
+            if reason is None:
+                return keep(result)
+            fall_back(span, reason)
+            return full.invoke(inputs, config)
+
+    async def arun(inputs: Any, config: RunnableConfig) -> Any:
+        with trace_span("tool_subset", node, n_tools=n_tools,
+                        fell_back=False) as span:
+            try:
+                with holding():
+                    result = await subset.ainvoke(inputs, config)
+                reason = check(result)
+            except (OutputParserException, ValidationError) as e:
+                reason = f"parse: {e}"
+            if reason is None:
+                return keep(result)
+            fall_back(span, reason)
+            return await full.ainvoke(inputs, config)
+
+    return RunnableLambda(run, afunc=arun, name=f"{node}_tool_subset")
+
+
+class ToolIndex:
+    """
+    Selects the tools of a request among those of tool_reg. Registries of
+    at most `min_tools` tools are always used whole. The `always` tools,
+    e.g. the agent's own ones, are part of every subset. The chains of the
+    `max_subsets` most recently used subsets are kept.
+    """
+
+    def __init__(
+            self,
+            tool_reg: ToolRegistry,
+            embeddings: Embeddings,
+            top_k: int = 8,
+            min_tools: int = 16,
+            always: Iterable[str] = (),
+            max_subsets: int = 64
+    ):
+        self.tool_reg = tool_reg
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.min_tools = min_tools
+        self.always = set(always)
+        self.max_subsets = max_subsets
+        self.lock = threading.Lock()
+        # (registry version, node, tools key) -> chain of the subset
+        self.subset_chains: OrderedDict[tuple[str, str, str], Runnable] = (
+            OrderedDict())
+        self.stats = {"selections": 0, "tools_bound": 0, "tools_total": 0}
+
+    def _vectors(self) -> tuple[list[BaseTool], list[array]]:
+        def build() -> tuple[list[BaseTool], list[array]]:
+            tools = list(self.tool_reg.tools)
+            vectors = self.embeddings.embed_documents(
+                [tool_text(one_tool) for one_tool in tools])
+            return tools, [_unit(vector) for vector in vectors]
+
+        return self.tool_reg.cached("tool_index", build)
+
+    def warm(self) -> int:
+        return len(self._vectors()[0])
+
+    def select(
+            self,
+            query: str,
+            context: str = ""
+    ) -> list[BaseTool]:
+        """
+        The top_k tools closest to query, plus those named in query or
+        context, in registry order so that the same selection always gives
+        the same prompt.
+        """
+        tools = self.tool_reg.tools
+        if len(tools) <= self.min_tools:
+            return tools
+        tools, vectors = self._vectors()
+        text = f"{query}\n{context}"
+        chosen = self.always | {
+            one_tool.name for one_tool in tools
+            if re.search(rf"\b{re.escape(one_tool.name)}\b", text)
+        }
+        query_vec = _unit(self.embeddings.embed_query(query))
+        ranked = sorted(
+            range(len(tools)),
+            key=lambda idx: sum(a * b for a, b in zip(query_vec,
+                                                      vectors[idx])),
+            reverse=True
+        )
+        chosen.update(tools[idx].name for idx in ranked[:self.top_k])
+        selected = [one_tool for one_tool in tools
+                    if one_tool.name in chosen]
+        self.stats["selections"] += 1
+        self.stats["tools_bound"] += len(selected)
+        self.stats["tools_total"] += len(tools)
+        return selected
+
+    def chain(
+            self,
+            node: str,
+            build: Callable[[list[BaseTool], bool], Runnable],
+            check: AnswerCheck,
+            query: str,
+            context: str = "",
+            stream: JsonFieldGUICallbackHandler | None = None
+    ) -> Runnable:
+        """
+        The chain of node for the tools of the request. build(tools,
+        escalate) makes the chain of a tool set, the full set with its
+        escalation is the fallback of the subset.
+        """
+        full = self.tool_reg.cached(
+            node, lambda: build(self.tool_reg.tools, True))
+        version = self.tool_reg.version
+        tools = self.select(query, context)
+        if len(tools) == len(self.tool_reg.tools):
+            return full
+        key = (version, node, tools_key(tools))
+        with self.lock:
+            chain = self.subset_chains.get(key)
+            if chain is not None:
+                self.subset_chains.move_to_end(key)
+                return chain
+        chain = with_tool_fallback(
+            build(tools, False), full, node, check, len(tools), stream)
+        with self.lock:
+            chain = self.subset_chains.setdefault(key, chain)
+            self.subset_chains.move_to_end(key)
+            while len(self.subset_chains) > self.max_subsets:
+                self.subset_chains.popitem(last=False)
+        return chain
+
+    def routed(
+            self,
+            node: str,
+            build: Callable[[list[BaseTool], bool], Runnable],
+            check: AnswerCheck,
+            stream: JsonFieldGUICallbackHandler | None = None
+    ) -> Runnable:
+        """
+        Runs the node's prompt inputs through the chain of their tools, the
+        query is the `agent_input`, tools named in the recent history are
+        kept too. `stream` is the handler streaming the node's answer.
+        """
+
+        def pick(inputs: dict[str, Any]) -> Runnable:
+            return self.chain(node, build, check, inputs["agent_input"],
+                              _recent_text(inputs), stream)
+
+        def run(inputs: dict[str, Any], config: RunnableConfig) -> Any:
+            return pick(inputs).invoke(inputs, config)
+
+        async def arun(inputs: dict[str, Any], config: RunnableConfig) -> Any:
+            # embedding the query runs on the cpu, off the event loop
+            chain = await asyncio.to_thread(pick, inputs)
+            return await chain.ainvoke(inputs, config)
+
+        return RunnableLambda(run, afunc=arun, name=f"{node}_tool_routed")
@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import orjson
+from typing import Any, Callable, Sequence
+from langchain_core.tools import BaseTool
+from ai.cad_agent_release.tools.auto_reg import auto_reg_tools
+
+
+def _tool_schema(tool: BaseTool) -> Any:
+    if tool.args_schema is None:
+        return None
+    if isinstance(tool.args_schema, dict):
+        return tool.args_schema
+    return tool.args_schema.model_json_schema()
+
+
+def registry_hash(tools: Sequence[BaseTool]) -> str:
+    """
+    Hash of the tool set, changes whenever a tool is added or removed or a
+    name, description or args schema changes.
+    """
+    digest = hashlib.sha1()
+    for tool in sorted(tools, key=lambda one_tool: one_tool.name):
+        digest.update(orjson.dumps(
+            [tool.name, tool.description, _tool_schema(tool)],
+            option=orjson.OPT_SORT_KEYS
+        ))
+    return digest.hexdigest()
+
+
+class ToolRegistry:
+    """
+    The tools returned by auto_reg_tools() plus the agent's own
+    `extra_tools`, together with everything derived from them: tool
+    descriptions, prompt templates and runnables bound to the tools.
+    Derived objects are built once per registry version and rebuilt only
+    after refresh() sees a different tool set; graph_core() refreshes at the
+    start of every cad_run turn. `tools_name` only lists the loaded tools,
+    which are the ones documented in the SOP knowledge base.
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[], tuple[list[BaseTool], list[str]]] = (
+                    auto_reg_tools),
+            extra_tools: Sequence[BaseTool] = ()
+    ):
+        self.loader = loader
+        self.extra_tools = list(extra_tools)
+        self.lock = threading.Lock()
+        self.tools: list[BaseTool] = []
+        self.tools_name: list[str] = []
+        self.tools_map: dict[str, BaseTool] = {}
+        self.version = ""
+        self._cache: dict[str, Any] = {}
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        Reload the tools, return True when the tool set has changed.
+        """
+        tools, tools_name = self.loader()
+        tools = list(tools) + self.extra_tools
+        version = registry_hash(tools)
+        with self.lock:
+            if version == self.version:
+                return False
+            self.tools = tools
+            self.tools_name = list(tools_name)
+            self.tools_map = {one_tool.name: one_tool for one_tool in tools}
+            self.version = version
+            self._cache.clear()
+            return True
+
+    def cached(self, key: str, builder: Callable[[], Any]) -> Any:
+        """
+        Return the object stored under key for the current version, build it
+        with builder() on first use.
+        """
+        with self.lock:
+            if key in self._cache:
+                return self._cache[key]
+            version = self.version
+        built = builder()
+        with self.lock:
+            # a refresh() during the build makes the result stale
+            if version != self.version:
+                return built
+            return self._cache.setdefault(key, built)
+
+    def tools_desc(self, tools: Sequence[BaseTool] | None = None) -> str:
+        """
+        Description of the given tools, of all of them by default.
+        """
+        def build(tools: Sequence[BaseTool]) -> str:
+            tools_desc = []
+            for tool in tools:
+                desc = tool.description or "No Definition."
+                tools_desc.append(f"- `{tool.name}`: {desc}")
+            return "\n".join(tools_desc)
+        if tools is not None:
+            return build(tools)
+        return self.cached("tools_desc", lambda: build(self.tools))
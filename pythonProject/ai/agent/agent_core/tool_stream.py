@@ -0,0 +1,307 @@
+import asyncio
+import codecs
+import contextvars
+import subprocess
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Sequence
+from PyQt5.QtCore import pyqtSignal
+from ai.cad_agent_release.agent_core.artifact_store import (
+    ArtifactStore,
+    KeyLineScanner
+)
+from ai.cad_agent_release.tools.sys_tools import resolve_path
+from ai.agent.ai_config.config import (
+    TOOL_OUTPUT_DIR,
+    TOOL_OUTPUT_HEAD_CHARS,
+    TOOL_OUTPUT_TAIL_CHARS,
+    TOOL_STREAM_INTERVAL,
+    TOOL_STREAM_MAX_CHUNK
+)
+
+READ_SIZE = 64 * 1024
+
+_current_stream: ContextVar["ToolOutputStream | None"] = ContextVar(
+    "tool_output_stream", default=None
+)
+
+
+def current_tool_output() -> "ToolOutputStream | None":
+    """
+    The output stream of the tool call running in this context, set by
+    run_tool_calls / arun_tool_calls.
+    """
+    return _current_stream.get()
+
+
+class ToolOutputStream:
+    """
+    Sink for the output of one running tool call:
+    - forwarded to the GUI (`tool_info`) at most once per `interval`
+      seconds and at most `max_chunk` chars at a time, the newest output
+      wins when the tool prints faster than that, output left pending
+      when the tool goes quiet is sent by a timer once due;
+    - spooled to a file under `spool_dir`, kept only when the output is too
+      long to be passed to the LLM as is, then moved into `store` if given;
+    - in memory only the first `head_chars` and the last `tail_chars`,
+      plus the key lines of the output.
+    Used as a context manager it becomes current_tool_output().
+    """
+
+    def __init__(
+            self,
+            tool_name: str,
+            qt_slot_sig: pyqtSignal(dict) = None,
+            store: ArtifactStore | None = None,
+            spool_dir: str | Path = TOOL_OUTPUT_DIR,
+            head_chars: int = TOOL_OUTPUT_HEAD_CHARS,
+            tail_chars: int = TOOL_OUTPUT_TAIL_CHARS,
+            interval: float = TOOL_STREAM_INTERVAL,
+            max_chunk: int = TOOL_STREAM_MAX_CHUNK
+    ):
+        self.tool_name = tool_name
+        self.qt_slot_sig = qt_slot_sig
+        self.store = store
+        self.spool_dir = Path(spool_dir)
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.interval = interval
+        self.max_chunk = max_chunk
+        self.lock = threading.Lock()
+        self.n_chars = 0
+        self.truncated = False
+        self.text = ""
+        self.head = ""
+        self.tail = ""
+        self.pending = ""
+        self.n_skipped = 0
+        self.last_emit = 0.0
+        self.timer: threading.Timer | None = None
+        self.scanner = KeyLineScanner()
+        self.reference: str | None = None
+        self.spool_path: Path | None = None
+        self.spool_file = None
+        self._token = None
+
+    @property
+    def streamed(self) -> bool:
+        return self.n_chars > 0
+
+    def __enter__(self) -> "ToolOutputStream":
+        self._token = _current_stream.set(self)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _current_stream.reset(self._token)
+        self.close()
+
+    def _spool(self, text: str) -> None:
+        if self.spool_file is None:
+            self.spool_dir.mkdir(parents=True, exist_ok=True)
+            self.spool_path = self.spool_dir / (
+                f"{self.tool_name}-{uuid.uuid4().hex}.log")
+            self.spool_file = open(self.spool_path, "w", encoding="utf-8")
+        self.spool_file.write(text)
+
+    def _keep(self, text: str) -> None:
+        if self.truncated:
+            self.tail = (self.tail + text)[-self.tail_chars:]
+            return
+        self.text += text
+        if len(self.text) > self.head_chars + self.tail_chars:
+            self.truncated = True
+            self.head = self.text[:self.head_chars]
+            self.tail = self.text[self.head_chars:][-self.tail_chars:]
+            self.text = ""
+
+    def _flush(self, force: bool = False) -> None:
+        if not self.pending or self.qt_slot_sig is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_emit < self.interval:
+            return
+        message = self.pending
+        if self.n_skipped:
+            message = (f"... [{self.n_skipped} chars skipped] ...\n"
+                       f"{message}")
+        self.pending, self.n_skipped, self.last_emit = "", 0, now
+        self.qt_slot_sig.emit({
+            "tool_name": self.tool_name,
+            "status": "result",
+            "message": message
+        })
+
+    def _flush_later(self) -> None:
+        with self.lock:
+            self.timer = None
+            self._flush(force=True)
+
+    def _schedule_flush(self) -> None:
+        if (not self.pending or self.qt_slot_sig is None
+                or self.timer is not None):
+            return
+        delay = max(0.0, self.last_emit + self.interval - time.monotonic())
+        # the signal may depend on context variables, e.g. the session of
+        # the server
+        self.timer = threading.Timer(
+            delay, contextvars.copy_context().run, (self._flush_later,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        with self.lock:
+            self.n_chars += len(text)
+            self._spool(text)
+            self._keep(text)
+            self.scanner.feed(text)
+            pending = self.pending + text
+            if len(pending) > self.max_chunk:
+                self.n_skipped += len(pending) - self.max_chunk
+                pending = pending[-self.max_chunk:]
+            self.pending = pending
+            self._flush()
+            self._schedule_flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._flush(force=True)
+            if self.spool_file is None:
+                return
+            self.spool_file.close()
+            self.spool_file = None
+            # short output is passed to the LLM in full
+            if not self.truncated:
+                self.spool_path.unlink(missing_ok=True)
+                self.spool_path = None
+            elif self.store is not None:
+                self.scanner.close()
+                handle = self.store.put_file(self.spool_path)
+                self.spool_path = None
+                self.reference = self.store.reference(
+                    handle,
+                    head=self.head,
+                    tail=self.tail,
+                    n_lines=self.scanner.n_lines,
+                    key_lines=self.scanner.key_lines
+                )
+
+    def summary(self) -> str:
+        """
+        The output as passed to the LLM, head and tail only when it is long.
+        """
+        with self.lock:
+            if self.reference is not None:
+                return self.reference
+            if not self.truncated:
+                return self.text
+            if self.store is not None:
+                # the tool executor appends the reference once it is stored
+                return (f"[{self.n_chars} chars of output, kept as an "
+                        f"artifact]")
+            n_omitted = self.n_chars - len(self.head) - len(self.tail)
+            return (f"{self.head}\n... [{n_omitted} chars omitted, the full "
+                    f"output ({self.n_chars} chars) is saved in "
+                    f"{self.spool_path}] ...\n{self.tail}")
+
+
+def _script_stream() -> tuple[ToolOutputStream, bool]:
+    stream = current_tool_output()
+    if stream is not None:
+        return stream, False
+    # called outside of the tool executor, nothing goes to the GUI
+    return ToolOutputStream("script"), True
+
+
+def run_script(
+        cmd: str | Sequence[str],
+        cwd: str | None = None,
+        timeout: float | None = None
+) -> str:
+    """
+    Run a script for a tool, its stdout and stderr are streamed to
+    current_tool_output() while it runs.
+    :param cmd: A shell command line or an argv list.
+    :param cwd: The working directory of the script, by default the one
+        of the session.
+    :param timeout: Seconds after which the script is killed.
+    :return: The exit code and the (possibly truncated) output.
+    """
+    stream, own_stream = _script_stream()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    cwd = resolve_path(cwd or ".")
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        shell=isinstance(cmd, str),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+    try:
+        while True:
+            data = proc.stdout.read1(READ_SIZE)
+            if not data:
+                break
+            stream.write(decoder.decode(data))
+        stream.write(decoder.decode(b"", final=True))
+        return_code = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        proc.stdout.close()
+        if own_stream:
+            stream.close()
+    return f"exit code: {return_code}\n{stream.summary()}"
+
+
+async def arun_script(
+        cmd: str | Sequence[str],
+        cwd: str | None = None,
+        timeout: float | None = None
+) -> str:
+    """
+    Async twin of run_script.
+    """
+    stream, own_stream = _script_stream()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    cwd = resolve_path(cwd or ".")
+    if isinstance(cmd, str):
+        proc = await asyncio.create_subprocess_shell(
+            cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+
+    async def pump() -> int:
+        while True:
+            data = await proc.stdout.read(READ_SIZE)
+            if not data:
+                break
+            stream.write(decoder.decode(data))
+        stream.write(decoder.decode(b"", final=True))
+        return await proc.wait()
+
+    try:
+        return_code = await asyncio.wait_for(pump(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        return_code = await proc.wait()
+    finally:
+        if own_stream:
+            stream.close()
+    return f"exit code: {return_code}\n{stream.summary()}"
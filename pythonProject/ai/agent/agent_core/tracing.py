@@ -0,0 +1,393 @@
+"""
+Span tracing of the agent graph: graph turns and nodes, LLM calls, retriever
+stages and tools, written as JSON lines to a local file.
+
+usage: python -m ai.agent.agent_core.tracing [--path traces.jsonl]
+                                             [--last-hours 24]
+"""
+import argparse
+import json
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from ai.agent.ai_config.config import TRACE_PATH
+
+
+class TraceRecorder:
+    """
+    Append-only JSONL sink of the finished spans, shared by all threads.
+    """
+
+    def __init__(self, path: str | Path = TRACE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, span: dict[str, Any]) -> None:
+        line = json.dumps(span, default=str, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+_recorder: TraceRecorder | None = None
+
+
+def set_recorder(recorder: TraceRecorder | None) -> None:
+    global _recorder
+    _recorder = recorder
+
+
+def get_recorder() -> TraceRecorder | None:
+    return _recorder
+
+
+@contextmanager
+def trace_span(
+        kind: str,
+        name: str,
+        parent_id: UUID | None = None,
+        **attrs: Any
+) -> Iterator[dict[str, Any]]:
+    """
+    Record a span around code that emits no LangChain callbacks, e.g. the
+    CrossEncoder rerank. The yielded dict takes extra attributes.
+    """
+    if _recorder is None:
+        yield attrs
+        return
+    start = time.time()
+    error = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        end = time.time()
+        _recorder.write({
+            "trace_id": None,
+            "span_id": str(uuid.uuid4()),
+            "parent_id": str(parent_id) if parent_id else None,
+            "kind": kind,
+            "name": name,
+            "start": start,
+            "end": end,
+            "duration_ms": (end - start) * 1e3,
+            "error": error,
+            **attrs
+        })
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Turn the LangChain callbacks into spans:
+    - turn: one graph invocation, node: one graph node run;
+    - llm: model, prompt/completion tokens, time to first token;
+    - retriever: every retriever stage, vector, BM25, ensemble and the
+      compression retriever around the reranker;
+    - tool: one tool invocation.
+    The chains in between are not recorded, a span's parent is its nearest
+    recorded ancestor.
+    """
+
+    def __init__(self, recorder: TraceRecorder):
+        self.recorder = recorder
+        self.lock = threading.Lock()
+        # run id -> (trace id, nearest recorded ancestor, recorded)
+        self.runs: dict[UUID, tuple[UUID, UUID | None, bool]] = {}
+        self.spans: dict[UUID, dict[str, Any]] = {}
+
+    def _enter(
+            self,
+            run_id: UUID,
+            parent_run_id: UUID | None,
+            span: dict[str, Any] | None,
+            metadata: dict[str, Any] | None = None
+    ) -> None:
+        with self.lock:
+            parent = self.runs.get(parent_run_id)
+            if parent is None:
+                trace_id, span_parent = parent_run_id or run_id, None
+            else:
+                trace_id = parent[0]
+                span_parent = parent_run_id if parent[2] else parent[1]
+            self.runs[run_id] = (trace_id, span_parent, span is not None)
+            if span is None:
+                return
+            metadata = metadata or {}
+            span.update({
+                "trace_id": str(trace_id),
+                "span_id": str(run_id),
+                "parent_id": str(span_parent) if span_parent else None,
+                "thread_id": metadata.get("thread_id"),
+                "start": time.time()
+            })
+            self.spans[run_id] = span
+
+    def _exit(self, run_id: UUID, error: BaseException | None = None,
+              **attrs: Any) -> None:
+        with self.lock:
+            self.runs.pop(run_id, None)
+            span = self.spans.pop(run_id, None)
+        if span is None:
+            return
+        end = time.time()
+        span.update(attrs)
+        span["end"] = end
+        span["duration_ms"] = (end - span["start"]) * 1e3
+        span["error"] = str(error) if error is not None else None
+        self.recorder.write(span)
+
+    # ------------ graph and nodes --------------------
+    def on_chain_start(
+            self,
+            serialized: dict[str, Any],
+            inputs: dict[str, Any],
+            *,
+            run_id: UUID,
+            parent_run_id: UUID | None = None,
+            metadata: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> None:
+        name = kwargs.get("name")
+        node = (metadata or {}).get("langgraph_node")
+        span = None
+        if parent_run_id is None:
+            span = {"kind": "turn", "name": name or "graph"}
+        elif name is not None and name == node:
+            span = {"kind": "node", "name": name}
+        self._enter(run_id, parent_run_id, span, metadata)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID,
+                     **kwargs: Any) -> None:
+        self._exit(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID,
+                       **kwargs: Any) -> None:
+        # interrupt() ends the node by raising, it is not a failure
+        if type(error).__name__ == "GraphInterrupt":
+            self._exit(run_id, interrupted=True)
+        else:
+            self._exit(run_id, error)
+
+    # ------------ LLM calls --------------------
+    def _llm_start(self, run_id, parent_run_id, metadata, kwargs) -> None:
+        params = kwargs.get("invocation_params") or {}
+        metadata = metadata or {}
+        model = (params.get("model") or params.get("model_name")
+                 or metadata.get("ls_model_name") or kwargs.get("name"))
+        self._enter(run_id, parent_run_id, {
+            "kind": "llm",
+            "name": model,
+            "node": metadata.get("langgraph_node"),
+            "max_tokens": params.get("max_tokens"),
+            "ttft_ms": None
+        }, metadata)
+
+    def on_chat_model_start(
+            self,
+            serialized: dict[str, Any],
+            messages: list,
+            *,
+            run_id: UUID,
+            parent_run_id: UUID | None = None,
+            metadata: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> None:
+        self._llm_start(run_id, parent_run_id, metadata, kwargs)
+
+    def on_llm_start(
+            self,
+            serialized: dict[str, Any],
+            prompts: list[str],
+            *,
+            run_id: UUID,
+            parent_run_id: UUID | None = None,
+            metadata: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> None:
+        self._llm_start(run_id, parent_run_id, metadata, kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID,
+                         **kwargs: Any) -> None:
+        with self.lock:
+            span = self.spans.get(run_id)
+            if span is not None and span["ttft_ms"] is None:
+                span["ttft_ms"] = (time.time() - span["start"]) * 1e3
+
+    @staticmethod
+    def _usage(response: LLMResult) -> tuple[int | None, int | None]:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None),
+                                "usage_metadata", None)
+                if usage:
+                    return usage.get("input_tokens"), usage.get(
+                        "output_tokens")
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID,
+                   **kwargs: Any) -> None:
+        prompt_tokens, completion_tokens = self._usage(response)
+        self._exit(
+            run_id,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID,
+                     **kwargs: Any) -> None:
+        self._exit(run_id, error)
+
+    # ------------ retrievers --------------------
+    def on_retriever_start(
+            self,
+            serialized: dict[str, Any],
+            query: str,
+            *,
+            run_id: UUID,
+            parent_run_id: UUID | None = None,
+            metadata: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> None:
+        name = kwargs.get("name") or (serialized or {}).get(
+            "id", ["retriever"])[-1]
+        self._enter(run_id, parent_run_id,
+                    {"kind": "retriever", "name": name}, metadata)
+
+    def on_retriever_end(self, documents, *, run_id: UUID,
+                         **kwargs: Any) -> None:
+        self._exit(run_id, n_docs=len(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID,
+                           **kwargs: Any) -> None:
+        self._exit(run_id, error)
+
+    # ------------ tools --------------------
+    def on_tool_start(
+            self,
+            serialized: dict[str, Any],
+            input_str: str,
+            *,
+            run_id: UUID,
+            parent_run_id: UUID | None = None,
+            metadata: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        self._enter(run_id, parent_run_id,
+                    {"kind": "tool", "name": name}, metadata)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID,
+                    **kwargs: Any) -> None:
+        self._exit(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID,
+                      **kwargs: Any) -> None:
+        self._exit(run_id, error)
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    idx = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[idx]
+
+
+def load_spans(
+        path: str | Path,
+        since: float | None = None
+) -> list[dict[str, Any]]:
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            if since is None or span.get("start", 0) >= since:
+                spans.append(span)
+    return spans
+
+
+def aggregate(spans: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Latency percentiles per (kind, name), e.g. per node and per model, and
+    for the `tier` spans of model_tier how many calls escalated.
+    """
+    groups: dict[tuple[str, str], list[dict[str, Any]]] = {}
+    for span in spans:
+        if span.get("duration_ms") is None:
+            continue
+        groups.setdefault(
+            (span.get("kind"), str(span.get("name"))), []).append(span)
+
+    rows = []
+    for (kind, name), group in sorted(groups.items()):
+        durations = [span["duration_ms"] for span in group]
+        ttfts = [span["ttft_ms"] for span in group
+                 if span.get("ttft_ms") is not None]
+        prompt_tokens = [span["prompt_tokens"] for span in group
+                         if span.get("prompt_tokens") is not None]
+        completion_tokens = [span["completion_tokens"] for span in group
+                             if span.get("completion_tokens") is not None]
+        rows.append({
+            "kind": kind,
+            "name": name,
+            "count": len(group),
+            "errors": sum(1 for span in group if span.get("error")),
+            "escalated": sum(1 for span in group if span.get("escalated")),
+            "p50_ms": _percentile(durations, 50),
+            "p95_ms": _percentile(durations, 95),
+            "ttft_p50_ms": _percentile(ttfts, 50) if ttfts else None,
+            "prompt_tokens_avg": (sum(prompt_tokens) / len(prompt_tokens)
+                                  if prompt_tokens else None),
+            "completion_tokens_avg": (
+                sum(completion_tokens) / len(completion_tokens)
+                if completion_tokens else None)
+        })
+    return rows
+
+
+def _fmt(value: float | None) -> str:
+    return "-" if value is None else f"{value:.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=str(TRACE_PATH))
+    parser.add_argument("--last-hours", type=float, default=None)
+    args = parser.parse_args()
+
+    since = None
+    if args.last_hours is not None:
+        since = time.time() - args.last_hours * 3600
+    rows = aggregate(load_spans(args.path, since))
+    print(f"{'kind':<10} {'name':<36} {'count':>6} {'err':>4} {'esc':>4} "
+          f"{'p50(ms)':>9} {'p95(ms)':>9} {'ttft50':>7} {'in_tok':>7} "
+          f"{'out_tok':>7}")
+    for row in rows:
+        print(f"{row['kind']:<10} {row['name'][:36]:<36} {row['count']:>6} "
+              f"{row['errors']:>4} {row['escalated']:>4} "
+              f"{row['p50_ms']:>9.0f} "
+              f"{row['p95_ms']:>9.0f} {_fmt(row['ttft_p50_ms']):>7} "
+              f"{_fmt(row['prompt_tokens_avg']):>7} "
+              f"{_fmt(row['completion_tokens_avg']):>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Background warm-up of the slow startup components: tokenizer, embedding
+and reranker models, vector store, BM25 corpus. They are declared as
+LazyComponent handles and built by a small thread pool as soon as the graph
+is created, so the first prompt doesn't wait for them. Only a caller that
+needs one before it is ready blocks on it, and the report shows the build
+and wait time of every component.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class LazyComponent:
+    """
+    A component built once by `factory` from the values of its `deps`.
+    Built in the background after start(), or by the first get() otherwise.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            factory: Callable[..., Any],
+            deps: tuple["LazyComponent", ...] = ()
+    ):
+        self.name = name
+        self.factory = factory
+        self.deps = deps
+        self.lock = threading.Lock()
+        self.future: Future | None = None
+        self.build_time: float | None = None
+        self.ready_at: float | None = None
+        self.wait_time = 0.0
+
+    def _build(self) -> Any:
+        # not dep.get(), waited only counts the callers outside the builds
+        args = [dep.start().result() for dep in self.deps]
+        start = time.perf_counter()
+        value = self.factory(*args)
+        self.ready_at = time.perf_counter()
+        self.build_time = self.ready_at - start
+        return value
+
+    def start(self, executor: ThreadPoolExecutor | None = None) -> Future:
+        with self.lock:
+            if self.future is None:
+                if executor is not None:
+                    self.future = executor.submit(self._build)
+                else:
+                    self.future = Future()
+                    self.future.set_running_or_notify_cancel()
+                    try:
+                        self.future.set_result(self._build())
+                    except BaseException as e:
+                        self.future.set_exception(e)
+            return self.future
+
+    @property
+    def ready(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def get(self) -> Any:
+        if self.ready:
+            return self.future.result()
+        start = time.perf_counter()
+        try:
+            return self.start().result()
+        finally:
+            self.wait_time += time.perf_counter() - start
+
+    async def aget(self) -> Any:
+        if self.ready:
+            return self.future.result()
+        start = time.perf_counter()
+        try:
+            # a component nobody started is built off the event loop
+            future = self.future or await asyncio.to_thread(self.start)
+            return await asyncio.wrap_future(future)
+        finally:
+            self.wait_time += time.perf_counter() - start
+
+
+def resolve(value: Any) -> Any:
+    """
+    value, or the component it is when it's a LazyComponent, waiting for
+    the build if needed.
+    """
+    return value.get() if isinstance(value, LazyComponent) else value
+
+
+class Warmup:
+    """
+    The lazy components of the process. Components must be added after
+    their deps, they are submitted in that order so a build only ever waits
+    for builds that already run.
+    """
+
+    def __init__(
+            self,
+            max_workers: int = 3,
+            on_done: Callable[["Warmup"], None] | None = None
+    ):
+        self.max_workers = max_workers
+        self.on_done = on_done
+        self.components: list[LazyComponent] = []
+        self.executor: ThreadPoolExecutor | None = None
+        self.started_at: float | None = None
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def add(
+            self,
+            name: str,
+            factory: Callable[..., Any],
+            *deps: LazyComponent
+    ) -> LazyComponent:
+        component = LazyComponent(name, factory, deps)
+        self.components.append(component)
+        if self.executor is not None:
+            self._submit(component)
+        return component
+
+    def component(self, name: str) -> LazyComponent:
+        for component in self.components:
+            if component.name == name:
+                return component
+        raise KeyError(name)
+
+    def _submit(self, component: LazyComponent) -> None:
+        with self.lock:
+            self.pending += 1
+        component.start(self.executor).add_done_callback(self._finished)
+
+    def _finished(self, future: Future) -> None:
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done and self.on_done is not None:
+            self.on_done(self)
+
+    def start(self) -> "Warmup":
+        self.started_at = time.perf_counter()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="cad-agent-warmup"
+        )
+        for component in self.components:
+            self._submit(component)
+        return self
+
+    def report(self) -> list[dict[str, Any]]:
+        rows = []
+        for component in self.components:
+            error = None
+            if component.ready and component.future.exception():
+                error = str(component.future.exception())
+            rows.append({
+                "name": component.name,
+                "ready": component.ready,
+                "build_s": component.build_time,
+                "ready_after_s": (
+                    component.ready_at - self.started_at
+                    if component.ready_at is not None
+                    and self.started_at is not None else None),
+                "waited_s": component.wait_time,
+                "error": error
+            })
+        return rows
+
+    def format_report(self) -> str:
+        def fmt(value: float | None) -> str:
+            return "-" if value is None else f"{value:.2f}"
+
+        lines = [f"{'component':<16} {'build(s)':>9} {'ready at(s)':>12} "
+                 f"{'waited(s)':>10}"]
+        for row in self.report():
+            line = (f"{row['name']:<16} {fmt(row['build_s']):>9} "
+                    f"{fmt(row['ready_after_s']):>12} "
+                    f"{fmt(row['waited_s']):>10}")
+            if row["error"]:
+                line += f"  error: {row['error']}"
+            lines.append(line)
+        return "\n".join(lines)
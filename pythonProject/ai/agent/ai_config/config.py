@@ -1,10 +1,13 @@
 from langchain_openai import ChatOpenAI
-from openai import base_url
+from langchain_core.caches import BaseCache
 from pydantic import SecretStr
 from pathlib import Path
 # from ai.ai_config.custom_embedding import CustomEmbeddings
 from transformers import AutoTokenizer
 import asyncio
+import threading
+import weakref
+import httpx
 # from ai.ai_config.custom_reranker import CustomReranker
 from langchain_huggingface import HuggingFaceEmbeddings
 from sentence_transformers import CrossEncoder
@@ -30,29 +33,377 @@ RERANKER_API_KEY = SecretStr("test_bge_reranker_v2_m3_RTAwMTk1NjYmdGVzdF9iZ2V"
 RERANKER_MODEL_NAME = "test-bge-reranker-v2-m3"
 
 NORMAL_URL = "http://llmserver.ai.cxmt.com/v1/"
+# base URL -> the URL actually used by the LLMs, set by the record / replay
+# sessions of agent_core/replay.py
+LLM_URL_OVERRIDES: dict[str, str] = {}
 QWQ_CODER_NAME = "Qwen3-Coder-480B-fp8"
 QWQ_CODER_KEY = SecretStr("Qwen3_Coder_480B_fp8_EDA_RTAwMTk1NjYmUXdlbj"
                           "NfQ29kZXJfNDgwQl9mcDgmMjAyNS8xMC8xNQ==")
 
+AGENT_DATA_DIR = Path.home() / ".cad_agent"
+CHECKPOINT_DB_PATH = AGENT_DATA_DIR / "checkpoints.sqlite"
+CHECKPOINT_KEEP_LAST = 20
+
+LLM_CACHE_PATH = AGENT_DATA_DIR / "llm_cache.sqlite"
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 20000
+# embedding-similarity lookup for the router/judge cache, it loads an extra
+# embedding model and a short "yes" may look close to a short "no", so it
+# stays off unless the threshold has been tuned on real replies
+LLM_CACHE_SEMANTIC = False
+LLM_CACHE_SIM_THRESHOLD = 0.97
+# streaming nodes whose answers may be served from the cache
+LLM_CACHE_STREAM_NODES = {"chat", "rag"}
+
+# tokenizer of the Qwen3 models served at BASE_URL, used for token budgets
+QWEN_TOKENIZER_NAME = "Qwen/Qwen3-235B-A22B"
+# recent turns passed to the prompts verbatim, older ones are summarized
+HISTORY_KEEP_TURNS = 4
+# turns are folded into the summary this many at a time, so the history
+# prefix of the prompts stays byte-stable in between
+HISTORY_FOLD_STEP = 4
+HISTORY_DEFAULT_BUDGET = 6144
+HISTORY_TOKEN_BUDGET = {
+    "chat": 6144,
+    "plan_run": 8192,
+    "rtrv": 3072,
+    "rag": 4096,
+    "reception": 2048,
+    "toolcall_plan": 8192,
+    "plan_update": 4096,
+}
+
+# report per LLM call how much of the prompt the server prefix cache can
+# reuse, the cache works on whole KV blocks of this many tokens
+PREFIX_CACHE_DIAG = False
+PREFIX_CACHE_BLOCK_SIZE = 16
+
+# full output of the streaming tools, only a head and a tail of it are kept
+# in memory and passed to the LLM
+TOOL_OUTPUT_DIR = AGENT_DATA_DIR / "tool_output"
+TOOL_OUTPUT_HEAD_CHARS = 4000
+TOOL_OUTPUT_TAIL_CHARS = 4000
+# tool output goes to the GUI at most once per interval (seconds), and at
+# most this many chars at a time
+TOOL_STREAM_INTERVAL = 0.2
+TOOL_STREAM_MAX_CHUNK = 4096
+
+# tool results longer than ARTIFACT_INLINE_CHARS are stored on disk by
+# content hash, the conversation only carries a reference with a head, a
+# tail and the error/warning lines
+ARTIFACT_DIR = AGENT_DATA_DIR / "artifacts"
+ARTIFACT_INLINE_CHARS = 6000
+ARTIFACT_HEAD_CHARS = 1500
+ARTIFACT_TAIL_CHARS = 1500
+ARTIFACT_KEY_LINES = 20
+ARTIFACT_PAGE_MAX_LINES = 500
+ARTIFACT_MAX_BYTES = 2 * 1024 ** 3
+
+# headless server, one graph and one retrieval stack shared by all sessions
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# conversation turns running at once, the others wait for a slot
+SERVER_MAX_TURNS = 8
+# threads for the blocking work of the turns: sync tools, local models
+SERVER_WORKERS = 16
+
+# span tracing of nodes, LLM calls, retrievers and tools, summarize with
+# `python -m ai.agent.agent_core.tracing`
+TRACE_ENABLED = False
+TRACE_PATH = AGENT_DATA_DIR / "traces.jsonl"
+
+# the plan LLM call also returns the tool calls of the plan, toolcall_plan
+# only calls the LLM again when they don't fit the tool schemas
+PLAN_SINGLE_PASS = False
+
+# latency/quality tier of the LLM of each graph node, nodes not listed use
+# ESCALATION_TIER. A node on a lower tier retries a call on ESCALATION_TIER
+# when the answer fails its schema or confidence check, see
+# agent_core/model_tier.py
+LLM_TIER_MODELS = {
+    "fast": "qwq_32b",
+    "strong": "qwq_235b"
+}
+ESCALATION_TIER = "strong"
+NODE_LLM_TIER = {
+    "reception": "fast",
+    "proc_confirm": "fast",
+    "rtrv": "fast",
+    "history_summary": "fast",
+    "plan_run": "strong",
+    "toolcall_plan": "strong",
+    "plan_update": "strong",
+    "chat": "strong",
+    "rag": "strong",
+    "tool_summary": "strong"
+}
+
+# record the LLM traffic and the tool results of the sessions ("record"), or
+# run on a recording without the LLM server and the tools ("replay")
+REPLAY_MODE: str | None = None
+REPLAY_PATH = AGENT_DATA_DIR / "replay" / "session.jsonl"
+
+# decide plain confirm / deny replies to the plan locally, the judge LLM
+# sees every reply the lexicon can't settle word by word
+CONFIRM_FAST_PATH = True
+
+# output budget of the LLM calls of each node: "tokens" is the largest
+# max_tokens, "thinking" caps the reasoning tokens (0 disables thinking,
+# None leaves it to the model). With OUTPUT_BUDGET_ADAPTIVE the max_tokens
+# follows the observed answer lengths below "tokens", see
+# agent_core/output_budget.py
+NODE_OUTPUT_BUDGET = {
+    "reception": {"tokens": 1024, "thinking": 0},
+    "proc_confirm": {"tokens": 1024, "thinking": 0},
+    "rtrv": {"tokens": 4096, "thinking": 1024},
+    "plan_run": {"tokens": 16384, "thinking": 8192},
+    "toolcall_plan": {"tokens": 8192, "thinking": 4096},
+    "plan_update": {"tokens": 8192, "thinking": 4096},
+    "chat": {"tokens": 8192, "thinking": 4096},
+    "rag": {"tokens": 8192, "thinking": 4096},
+    "tool_summary": {"tokens": 4096, "thinking": 0},
+    "history_summary": {"tokens": 1024, "thinking": 0}
+}
+# off while a ReplaySession runs, max_tokens is part of its request keys
+OUTPUT_BUDGET_ADAPTIVE = True
+# the nodes whose max_tokens adapts: their calls go through escalating(),
+# which retries an answer cut off by the adapted limit at "tokens". The
+# streamed answers keep "tokens", a retry would show them twice
+OUTPUT_BUDGET_ADAPTIVE_NODES = {
+    "reception", "proc_confirm", "rtrv", "toolcall_plan", "plan_update"
+}
+OUTPUT_BUDGET_PATH = AGENT_DATA_DIR / "output_budget.json"
+
+# the streamed answer tokens reach the GUI in chunks of at most this many
+# seconds or characters, one Qt signal per chunk
+GUI_STREAM_INTERVAL = 0.03
+GUI_STREAM_MAX_CHARS = 64
+
+# load the retrieval models, vector store and BM25 corpus in the background
+# when the graph is built instead of on the first retrieval
+RETRIEVAL_WARMUP = True
+WARMUP_WORKERS = 3
+
+# the sub-queries of a retrieval are searched at once and reranked in one
+# cross-encoder batch, keeping the best RAG_TOP_N chunks of each of them
+# while the context fits in RAG_CONTEXT_TOKEN_BUDGET
+RAG_SEARCH_WORKERS = 4
+RAG_TOP_N = 3
+RAG_CONTEXT_TOKEN_BUDGET = 4096
+
+# once the registry has more than TOOL_INDEX_MIN_TOOLS tools, the plan and
+# tool call prompts only get the TOOL_INDEX_TOP_K tools closest to the
+# request by embedding and the tools it names; an answer failing with them
+# is redone with every tool; the chains of the TOOL_INDEX_MAX_SUBSETS most
+# recently used tool subsets are kept
+TOOL_INDEX_ENABLED = True
+TOOL_INDEX_MIN_TOOLS = 16
+TOOL_INDEX_TOP_K = 8
+TOOL_INDEX_MAX_SUBSETS = 64
+
+# one pooled sync and async HTTP client per LLM server, shared by every
+# ChatOpenAI. HTTP/2 is negotiated over TLS when the h2 package is installed
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE = 32
+HTTP_KEEPALIVE_EXPIRY = 120.0
+HTTP_CONNECT_TIMEOUT = 10.0
+HTTP_READ_TIMEOUT = 600.0
+HTTP2_ENABLED = True
+
+
+def llm_base_url(url: str) -> str:
+    return LLM_URL_OVERRIDES.get(url, url)
+
+
+def _http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _http_pool_kwargs() -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        "http2": _http2_available()
+    }
+
+
+class _PoolConnections:
+    """
+    The open connections of the httpx transport it is mixed into, which
+    keeps its httpcore pool private.
+    """
+
+    def connections(self) -> list:
+        return list(getattr(getattr(self, "_pool", None), "connections", []))
+
+
+class _SyncPool(_PoolConnections, httpx.HTTPTransport):
+    pass
+
+
+class _AsyncPool(_PoolConnections, httpx.AsyncHTTPTransport):
+    pass
+
+
+class _LoopAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Async connections belong to the event loop that opened them, so every
+    loop using the shared client (GUI worker, server, replay) gets its own
+    pool behind the one client.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, _AsyncPool
+        ] = weakref.WeakKeyDictionary()
+
+    def pool(self) -> _AsyncPool:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            transport = self.pools.get(loop)
+            if transport is None:
+                # the connections of a finished loop can't be reused
+                for done in [one for one in self.pools if one.is_closed()]:
+                    del self.pools[done]
+                transport = _AsyncPool(**_http_pool_kwargs())
+                self.pools[loop] = transport
+            return transport
+
+    def connections(self) -> list:
+        with self.lock:
+            pools = list(self.pools.values())
+        return [conn for pool in pools for conn in pool.connections()]
+
+    async def handle_async_request(
+            self,
+            request: httpx.Request
+    ) -> httpx.Response:
+        return await self.pool().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            transport = self.pools.pop(loop, None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_http_lock = threading.Lock()
+_http_clients: dict[str, tuple[httpx.Client, httpx.AsyncClient]] = {}
+# the transports behind _http_clients, for http_pool_stats()
+_http_transports: dict[str, tuple[_SyncPool, _LoopAsyncTransport]] = {}
+_http_requests: dict[str, int] = {}
+
+
+def gen_http_clients(url: str) -> tuple[httpx.Client, httpx.AsyncClient]:
+    """
+    The process-wide sync and async clients of the LLM server at url.
+    """
+    with _http_lock:
+        clients = _http_clients.get(url)
+        if clients is None:
+            _http_requests[url] = 0
+
+            def count(request: httpx.Request) -> None:
+                # the hooks of the clients run on any thread
+                with _http_lock:
+                    _http_requests[url] += 1
+
+            async def acount(request: httpx.Request) -> None:
+                count(request)
+
+            timeout = httpx.Timeout(HTTP_READ_TIMEOUT,
+                                    connect=HTTP_CONNECT_TIMEOUT)
+            transports = (_SyncPool(**_http_pool_kwargs()),
+                          _LoopAsyncTransport())
+            clients = (
+                httpx.Client(
+                    transport=transports[0],
+                    timeout=timeout,
+                    follow_redirects=True,
+                    event_hooks={"request": [count]}
+                ),
+                httpx.AsyncClient(
+                    transport=transports[1],
+                    timeout=timeout,
+                    follow_redirects=True,
+                    event_hooks={"request": [acount]}
+                )
+            )
+            _http_clients[url] = clients
+            _http_transports[url] = transports
+        return clients
+
+
+def http_pool_stats() -> dict[str, dict[str, int | bool]]:
+    """
+    Per LLM server: requests sent, open connections and the idle ones
+    among them, for the sync and the async clients together.
+    """
+    with _http_lock:
+        requests = dict(_http_requests)
+        transports = dict(_http_transports)
+    stats = {}
+    for url, (transport, async_transport) in transports.items():
+        connections = (transport.connections()
+                       + async_transport.connections())
+        stats[url] = {
+            "requests": requests[url],
+            "connections": len(connections),
+            "idle": sum(conn.is_idle() for conn in connections),
+            "http2": _http2_available()
+        }
+    return stats
+
+
+def llm_http_kwargs(url: str) -> dict:
+    # the ChatOpenAI connection arguments of the LLM server at url
+    server_url = llm_base_url(url)
+    client, async_client = gen_http_clients(server_url)
+    return {
+        "base_url": server_url,
+        "http_client": client,
+        "http_async_client": async_client
+    }
+
+
+def thinking_body(thk_en: bool, thk_budget: int | None) -> dict:
+    body = {"enable_thinking": thk_en}
+    if thk_en and thk_budget is not None:
+        body["thinking_budget"] = thk_budget
+    return body
+
 
 def gen_llm_deepseek_32b(
         temp: float = 0.1,
         tokens: int = 32768,
         streaming: bool = False,
         thk_en: bool = True,
-        callbacks: list = None
+        callbacks: list = None,
+        cache: BaseCache | None = None,
+        thk_budget: int | None = None
 ) -> ChatOpenAI:
     llm = ChatOpenAI(
         api_key=DS_QWQ_32B_KEY,
-        base_url=BASE_URL,
+        **llm_http_kwargs(BASE_URL),
         model=DS_QWQ_32B_NAME,
         streaming=streaming,
         temperature=temp,
         max_tokens=tokens,
-        extra_body={
-            "enable_thinking": thk_en
-        },
-        callbacks=callbacks
+        extra_body=thinking_body(thk_en, thk_budget),
+        stream_usage=True,
+        callbacks=callbacks,
+        cache=cache
     )
     return llm
 
@@ -62,19 +413,21 @@ def gen_llm_qwq_32b(
         tokens: int = 32768,
         streaming: bool = False,
         thk_en: bool = True,
-        callbacks: list = None
+        callbacks: list = None,
+        cache: BaseCache | None = None,
+        thk_budget: int | None = None
 ) -> ChatOpenAI:
     llm = ChatOpenAI(
         api_key=QWQ_32B_KEY,
-        base_url=BASE_URL,
+        **llm_http_kwargs(BASE_URL),
         model=QWQ_32B_NAME,
         streaming=streaming,
         temperature=temp,
         max_tokens=tokens,
-        extra_body={
-            "enable_thinking": thk_en
-        },
-        callbacks=callbacks
+        extra_body=thinking_body(thk_en, thk_budget),
+        stream_usage=True,
+        callbacks=callbacks,
+        cache=cache
     )
     return llm
 
@@ -84,23 +437,36 @@ def gen_llm_qwq_235b(
         tokens: int = 32768,
         streaming: bool = False,
         thk_en: bool = True,
-        callbacks: list = None
+        callbacks: list = None,
+        cache: BaseCache | None = None,
+        thk_budget: int | None = None
 ) -> ChatOpenAI:
     llm = ChatOpenAI(
         api_key=QWQ_235B_KEY,
-        base_url=BASE_URL,
+        **llm_http_kwargs(BASE_URL),
         model=QWQ_235B_NAME,
         streaming=streaming,
         temperature=temp,
         max_tokens=tokens,
-        extra_body={
-            "enable_thinking": thk_en
-        },
-        callbacks=callbacks
+        extra_body=thinking_body(thk_en, thk_budget),
+        stream_usage=True,
+        callbacks=callbacks,
+        cache=cache
     )
     return llm
 
 
+LLM_FACTORIES = {
+    "deepseek_32b": gen_llm_deepseek_32b,
+    "qwq_32b": gen_llm_qwq_32b,
+    "qwq_235b": gen_llm_qwq_235b
+}
+
+
+def gen_llm_tier(tier: str, **llm_kwargs) -> ChatOpenAI:
+    return LLM_FACTORIES[LLM_TIER_MODELS[tier]](**llm_kwargs)
+
+
 def gen_qwq_coder_480b(
         temp: float = 0.7,
         tokens: int = 65536,
@@ -118,7 +484,7 @@ def gen_qwq_coder_480b(
     """
     llm = ChatOpenAI(
         api_key=QWQ_CODER_KEY,
-        base_url=NORMAL_URL,
+        **llm_http_kwargs(NORMAL_URL),
         model=QWQ_CODER_NAME,
         streaming=streaming,
         temperature=temp,
@@ -128,6 +494,11 @@ def gen_qwq_coder_480b(
     return llm
 
 
+def gen_qwen_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(QWEN_TOKENIZER_NAME)
+    return tokenizer
+
+
 def gen_custom_embeddings(max_len: int):
 
 
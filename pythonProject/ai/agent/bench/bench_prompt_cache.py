@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the per-turn prompt building overhead of the cad_run
+branch: tool description, ChatPromptTemplate construction and bind_tools,
+rebuilt on every call (before) versus cached per tool registry version by
+ToolRegistry (after). No request is sent to the LLM server.
+
+usage: python -m ai.agent.bench.bench_prompt_cache [--tools 20 80] [--turns 200]
+"""
+import argparse
+import time
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.tools import StructuredTool
+from langchain_openai import ChatOpenAI
+from ai.cad_agent_release.agent_core.prompt import (
+    cad_plan_sys_prompt_2,
+    plan_update_sys_prompt2,
+    tool_call_sys_prompt
+)
+from ai.cad_agent_release.agent_core.prompt_layout import layout_prompt
+from ai.cad_agent_release.agent_core.tool_registry import ToolRegistry
+
+
+def gen_fake_tools(n_tools: int) -> list[StructuredTool]:
+    def make_tool(idx: int) -> StructuredTool:
+        def run_check(work_dir: str, cell_name: str, top_n: int = 10) -> str:
+            return f"check {idx} done"
+        return StructuredTool.from_function(
+            func=run_check,
+            name=f"eda_check_{idx}",
+            description=(f"Run EDA check number {idx} on the cell under "
+                         f"work_dir and report the top_n violations. " * 4)
+        )
+    return [make_tool(idx) for idx in range(n_tools)]
+
+
+def gen_history(n_turns: int = 6) -> list:
+    history = []
+    for idx in range(n_turns):
+        history.append(HumanMessage(content=f"question {idx} " * 20))
+        history.append(AIMessage(content=f"answer {idx} " * 40))
+    return history
+
+
+def build_chains(tools, llm, tools_desc: str):
+    plan_chain = layout_prompt(
+        cad_plan_sys_prompt_2,
+        tools_description=tools_desc
+    ) | llm.bind(response_format={"type": "json_object"})
+    toolcall_chain = layout_prompt(tool_call_sys_prompt) | llm.bind_tools(
+        tools)
+    update_chain = layout_prompt(
+        plan_update_sys_prompt2,
+        history=("chat_history", "tool_run_history")
+    ) | llm.bind_tools(tools)
+    return plan_chain, toolcall_chain, update_chain
+
+
+def turn_before(tools, llm, history) -> None:
+    tools_desc = []
+    for tool in tools:
+        desc = tool.description or "No Definition."
+        tools_desc.append(f"- `{tool.name}`: {desc}")
+    chains = build_chains(tools, llm, "\n".join(tools_desc))
+    for chain in chains:
+        chain.first.invoke({
+            "agent_input": "run the checks",
+            "chat_history": history,
+            "tool_run_history": []
+        })
+
+
+def turn_after(tool_reg: ToolRegistry, llm, history) -> None:
+    chains = tool_reg.cached(
+        "bench_chains",
+        lambda: build_chains(tool_reg.tools, llm, tool_reg.tools_desc())
+    )
+    for chain in chains:
+        chain.first.invoke({
+            "agent_input": "run the checks",
+            "chat_history": history,
+            "tool_run_history": []
+        })
+
+
+def run_bench(n_tools: int, n_turns: int) -> tuple[float, float]:
+    tools = gen_fake_tools(n_tools)
+    llm = ChatOpenAI(api_key="bench", base_url="http://127.0.0.1:9/v1",
+                     model="bench")
+    history = gen_history()
+    tool_reg = ToolRegistry(loader=lambda: (tools, [t.name for t in tools]))
+
+    turn_before(tools, llm, history)
+    start = time.perf_counter()
+    for _ in range(n_turns):
+        turn_before(tools, llm, history)
+    before = (time.perf_counter() - start) / n_turns
+
+    turn_after(tool_reg, llm, history)
+    start = time.perf_counter()
+    for _ in range(n_turns):
+        turn_after(tool_reg, llm, history)
+    after = (time.perf_counter() - start) / n_turns
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tools", type=int, nargs="+", default=[20, 80])
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'tools':>6} {'before(ms)':>11} {'after(ms)':>10} {'speedup':>8}")
+    for n_tools in args.tools:
+        before, after = run_bench(n_tools, args.turns)
+        print(f"{n_tools:>6} {before * 1e3:>11.3f} {after * 1e3:>10.3f} "
+              f"{before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+End-to-end latency benchmark of graph_core on fixed conversations of the
+cad_run, cad_rag and general_chat branches. The LLM server and the tools
+are replaced by a recording (agent_core/replay.py), so the numbers show the
+per-turn overhead of the agent itself: prompt template building, state
+serialization and checkpointing, callbacks, graph scheduling.
+
+usage:
+  record the scenarios once against the LLM server and the real tools
+    python -m ai.agent.bench.bench_replay record --recording rec.jsonl
+  then benchmark on the recording
+    python -m ai.agent.bench.bench_replay run --recording rec.jsonl
+  --scenarios takes a JSON file {"name": [turn input, ...]} instead of the
+  built-in ones, a turn input is {"query_str", "assert_rag", "assert_flow"}.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from functools import wraps
+from pathlib import Path
+from typing import Any
+from langchain_core.callbacks import BaseCallbackHandler
+from ai.cad_agent_release.agent_core.graph_driver import astream_turn
+from ai.cad_agent_release.agent_core.replay import ReplaySession
+
+
+def turn(
+        query_str: str,
+        assert_rag: bool = False,
+        assert_flow: bool = False
+) -> dict[str, Any]:
+    return {
+        "query_str": query_str,
+        "assert_rag": assert_rag,
+        "assert_flow": assert_flow
+    }
+
+
+SCENARIOS = {
+    "general_chat": [
+        turn("Hello, what can you help me with?")
+    ],
+    "cad_rag": [
+        turn("How do I run the pg_net flow and what does it check?",
+             assert_rag=True)
+    ],
+    "cad_run": [
+        turn("Run pg_net for cell A of project P1 at working dir "
+             "/home/barwellg/tmp, the vdd pin is VDD, the vss pin is VSS.",
+             assert_flow=True),
+        turn("yes", assert_flow=True)
+    ]
+}
+
+# per turn: wall time, and the time spent in each part
+PARTS = ("llm", "tool", "template", "checkpoint", "serialize")
+# the time waiting for these is not overhead, they may run concurrently
+EXTERNAL_PARTS = ("llm", "tool")
+
+
+class TurnProbe(BaseCallbackHandler):
+    """
+    Sums up per category the time of the runs reported to the callbacks,
+    plus the checkpointer and serializer calls of the graph.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started: dict[Any, tuple[str, float]] = {}
+        self.totals: dict[str, float] = defaultdict(float)
+        self.external: list[tuple[float, float]] = []
+
+    def reset(self) -> tuple[dict[str, float], float]:
+        """
+        :return: The totals per part and the wall time covered by the
+            LLM calls and the tools since the last reset.
+        """
+        with self.lock:
+            totals, self.totals = dict(self.totals), defaultdict(float)
+            intervals, self.external = sorted(self.external), []
+        covered, covered_end = 0.0, float("-inf")
+        for start, end in intervals:
+            if end > covered_end:
+                covered += end - max(start, covered_end)
+                covered_end = end
+        return totals, covered
+
+    def add(self, part: str, elapsed: float) -> None:
+        with self.lock:
+            self.totals[part] += elapsed
+
+    def _start(self, run_id, part: str) -> None:
+        with self.lock:
+            self.started[run_id] = (part, time.perf_counter())
+
+    def _end(self, run_id) -> None:
+        with self.lock:
+            started = self.started.pop(run_id, None)
+            if started is not None:
+                part, start = started
+                end = time.perf_counter()
+                self.totals[part] += end - start
+                if part in EXTERNAL_PARTS:
+                    self.external.append((start, end))
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        if str(kwargs.get("name") or "").endswith("PromptTemplate"):
+            self._start(run_id, "template")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, "tool")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def instrument(self, saver) -> None:
+        # the async checkpointer API goes through the sync one
+        def timed(part: str, func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(part, time.perf_counter() - start)
+            return wrapper
+
+        for name in ("get_tuple", "put", "put_writes"):
+            setattr(saver, name, timed("checkpoint", getattr(saver, name)))
+        for name in ("dumps_typed", "loads_typed"):
+            setattr(saver.serde, name,
+                    timed("serialize", getattr(saver.serde, name)))
+
+
+class NullSignal:
+    def emit(self, *args) -> None:
+        pass
+
+
+def build_graph(replay: ReplaySession, ckpt_db_path: Path, probe: TurnProbe):
+    from ai.cad_agent_release.agent_core.graph_core import graph_core
+    graph_app = graph_core(
+        NullSignal(),
+        NullSignal(),
+        NullSignal(),
+        ckpt_db_path=ckpt_db_path,
+        replay=replay
+    )
+    probe.instrument(graph_app.checkpointer)
+    return graph_app.with_config(callbacks=[probe])
+
+
+async def run_scenario(
+        graph_app,
+        turns: list[dict[str, Any]],
+        probe: TurnProbe
+) -> list[dict[str, float]]:
+    thread_id = uuid.uuid4().hex
+    timings = []
+    for user_input in turns:
+        probe.reset()
+        start = time.perf_counter()
+        async for event in astream_turn(graph_app, thread_id, user_input,
+                                        stream_tokens=False):
+            pass
+        wall = time.perf_counter() - start
+        parts, external = probe.reset()
+        timings.append({
+            "wall": wall,
+            "overhead": wall - external,
+            **{part: parts.get(part, 0.0) for part in PARTS}
+        })
+    return timings
+
+
+def report(results: dict[str, list[dict[str, float]]]) -> None:
+    columns = ("wall", "overhead") + PARTS
+    print(f"{'branch':<14} {'turns':>5} "
+          + " ".join(f"{column + '(ms)':>15}" for column in columns))
+    for name, timings in results.items():
+        cells = []
+        for column in columns:
+            values = [timing[column] * 1e3 for timing in timings]
+            cells.append(f"{statistics.median(values):>8.2f}"
+                         f"/{max(values):<6.1f}")
+        print(f"{name:<14} {len(timings):>5} " + " ".join(cells))
+    print("cells: median/max per turn")
+
+
+async def bench(args, scenarios: dict[str, list[dict[str, Any]]]) -> None:
+    record = args.command == "record"
+    replay = ReplaySession(args.recording, record=record).start()
+    probe = TurnProbe()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            graph_app = build_graph(
+                replay, Path(tmp_dir) / "ckpt.sqlite", probe)
+            results = defaultdict(list)
+            n_rounds = 1 if record else args.warmup + args.repeat
+            for idx in range(n_rounds):
+                for name, turns in scenarios.items():
+                    replay.recording.rewind()
+                    timings = await run_scenario(graph_app, turns, probe)
+                    if record or idx >= args.warmup:
+                        results[name].extend(timings)
+    finally:
+        replay.stop()
+    report(results)
+    print(f"recording {args.recording}: {replay.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("command", choices=("record", "run"))
+    parser.add_argument("--recording", type=Path, required=True)
+    parser.add_argument("--scenarios", type=Path, default=None)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios is not None:
+        scenarios = json.loads(args.scenarios.read_text(encoding="utf-8"))
+    asyncio.run(bench(args, scenarios))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Benchmark of the GUI token streaming: events posted to the UI thread by
+GUICallbackHandler (one signal per token, before) versus the coalescing
+BufferedGUICallbackHandler and AsyncBufferedGUICallbackHandler (after), at
+several decode speeds, through the sync and the async callback managers.
+The UI thread is simulated by a consumer spending --render-ms per event, as
+the GUI does re-rendering the markdown of the answer.
+
+usage: python -m ai.agent.bench.bench_stream [--rates 50 200 1000]
+                                             [--tokens 1000] [--render-ms 2]
+"""
+import argparse
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from langchain_core.callbacks import AsyncCallbackManager, CallbackManager
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from ai.cad_agent_release.agent_core.callbacks import (
+    AsyncBufferedGUICallbackHandler,
+    BufferedGUICallbackHandler,
+    GUICallbackHandler
+)
+
+HANDLERS = {
+    "per-token": GUICallbackHandler,
+    "buffered": BufferedGUICallbackHandler,
+    "async-buffered": AsyncBufferedGUICallbackHandler
+}
+# (handler, callback manager)
+MODES = (
+    ("per-token", "sync"),
+    ("buffered", "sync"),
+    ("per-token", "async"),
+    ("buffered", "async"),
+    ("async-buffered", "async")
+)
+
+
+class UIThread:
+    """
+    Stands in for the Qt event loop: emit() posts an event, the thread
+    handles them one by one and measures how late each text is shown.
+    """
+
+    def __init__(self, render_s: float):
+        self.render_s = render_s
+        self.events: queue.Queue = queue.Queue()
+        # (arrival time, chars) of the tokens not shown yet
+        self.arrivals: deque[list] = deque()
+        self.lock = threading.Lock()
+        self.n_events = 0
+        self.busy = 0.0
+        self.max_lag = 0.0
+        self.text: list[str] = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def token_arrived(self, token: str) -> None:
+        with self.lock:
+            self.arrivals.append([time.perf_counter(), len(token)])
+
+    def emit(self, text: str) -> None:
+        self.events.put(text)
+
+    def _shown(self, n_chars: int) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            while n_chars > 0 and self.arrivals:
+                first = self.arrivals[0]
+                self.max_lag = max(self.max_lag, now - first[0])
+                taken = min(n_chars, first[1])
+                first[1] -= taken
+                n_chars -= taken
+                if first[1] == 0:
+                    self.arrivals.popleft()
+
+    def _run(self) -> None:
+        while True:
+            text = self.events.get()
+            if text is None:
+                return
+            start = time.perf_counter()
+            self.n_events += 1
+            self.text.append(text)
+            time.sleep(self.render_s)
+            self._shown(len(text))
+            self.busy += time.perf_counter() - start
+
+    def close(self) -> None:
+        self.events.put(None)
+        self.thread.join()
+
+
+def gen_tokens(n_tokens: int) -> list[str]:
+    words = ("the", " pg_net", " check", " reported", " 12", " violations",
+             " on", " VDD", ",", " see", " the", " report", ".\n")
+    return [words[idx % len(words)] for idx in range(n_tokens)]
+
+
+def stream_sync(handler, ui: UIThread, tokens: list[str], rate: float):
+    manager = CallbackManager(handlers=[handler])
+    run = manager.on_chat_model_start({}, [[HumanMessage("hi")]])[0]
+    start = time.perf_counter()
+    for idx, token in enumerate(tokens):
+        delay = start + idx / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        ui.token_arrived(token)
+        run.on_llm_new_token(token)
+    run.on_llm_end(LLMResult(generations=[[ChatGeneration(
+        message=AIMessage("".join(tokens)))]]))
+
+
+async def stream_async(handler, ui: UIThread, tokens: list[str],
+                       rate: float):
+    manager = AsyncCallbackManager(handlers=[handler])
+    run = (await manager.on_chat_model_start(
+        {}, [[HumanMessage("hi")]]))[0]
+    start = time.perf_counter()
+    for idx, token in enumerate(tokens):
+        delay = start + idx / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        ui.token_arrived(token)
+        await run.on_llm_new_token(token)
+    await run.on_llm_end(LLMResult(generations=[[ChatGeneration(
+        message=AIMessage("".join(tokens)))]]))
+
+
+def run_bench(
+        handler_name: str,
+        manager: str,
+        tokens: list[str],
+        rate: float,
+        render_s: float
+) -> dict[str, float]:
+    ui = UIThread(render_s)
+    handler = HANDLERS[handler_name](ui)
+    start = time.perf_counter()
+    if manager == "sync":
+        stream_sync(handler, ui, tokens, rate)
+    else:
+        asyncio.run(stream_async(handler, ui, tokens, rate))
+    ui.close()
+    assert "".join(ui.text) == "".join(tokens), "streamed text differs"
+    return {
+        "events": ui.n_events,
+        "ui_busy": ui.busy,
+        "max_lag": ui.max_lag,
+        "wall": time.perf_counter() - start
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rates", type=float, nargs="+",
+                        default=[50, 200, 1000])
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--render-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    tokens = gen_tokens(args.tokens)
+    print(f"{'tok/s':>6} {'handler':<15} {'manager':<7} {'events':>7} "
+          f"{'ui busy(ms)':>12} {'max lag(ms)':>12} {'wall(s)':>8}")
+    for rate in args.rates:
+        for handler_name, manager in MODES:
+            result = run_bench(handler_name, manager, tokens, rate,
+                               args.render_ms / 1e3)
+            print(f"{rate:>6.0f} {handler_name:<15} {manager:<7} "
+                  f"{result['events']:>7} {result['ui_busy'] * 1e3:>12.1f} "
+                  f"{result['max_lag'] * 1e3:>12.1f} "
+                  f"{result['wall']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
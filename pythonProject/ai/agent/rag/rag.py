@@ -1,8 +1,11 @@
+import asyncio
 import os
 import nltk
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable
 from langchain_chroma import Chroma
-from langchain_core.tools import tool
+from langchain_core.tools import StructuredTool, tool
 from ai.agent.ai_config.config import gen_custom_embeddings
 from langchain_community.retrievers import BM25Retriever
 from langchain_classic.retrievers import EnsembleRetriever
@@ -10,6 +13,16 @@ from ai.agent.ai_config.config import gen_custom_reranker
 from langchain_classic.retrievers.document_compressors import CrossEncoderReranker
 from langchain_classic.retrievers import ContextualCompressionRetriever
 from langchain_core.documents import Document
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    Callbacks,
+    CallbackManagerForRetrieverRun
+)
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableConfig
+from ai.cad_agent_release.agent_core.tracing import trace_span
+from ai.cad_agent_release.agent_core.warmup import LazyComponent, Warmup
 
 os.environ["UNSTRUCTURED_DO_NOT_TRACK"] = "true"
 ai_root = Path(__file__).parent.parent.parent
@@ -99,39 +112,319 @@ def gen_retrieve_rag_info(retriever, tools_name: list[str] = None):
     return retrieve_rag_info
 
 
-def gen_retriever(srch_k: int, ):
-    embed_method = gen_custom_embeddings(max_len=6144)
-    vec_store = Chroma(
+class TracedCrossEncoderReranker(CrossEncoderReranker):
+    """
+    CrossEncoderReranker emits no callbacks, record its span directly.
+    """
+
+    def compress_documents(
+            self,
+            documents,
+            query: str,
+            callbacks: Callbacks | None = None
+    ):
+        with trace_span(
+                "retriever",
+                "CrossEncoderReranker",
+                parent_id=getattr(callbacks, "parent_run_id", None),
+                n_docs=len(documents)
+        ):
+            return super().compress_documents(documents, query, callbacks)
+
+    def rank_queries(
+            self,
+            docs_by_query: dict[str, list[Document]],
+            callbacks: Callbacks | None = None
+    ) -> dict[str, list[Document]]:
+        """
+        Rank the candidates of several queries in a single cross-encoder
+        batch, every document against the queries that retrieved it.
+        """
+        pairs = [(query, doc) for query, docs in docs_by_query.items()
+                 for doc in docs]
+        with trace_span(
+                "retriever",
+                "CrossEncoderReranker",
+                parent_id=getattr(callbacks, "parent_run_id", None),
+                n_docs=len(pairs),
+                n_queries=len(docs_by_query)
+        ):
+            scores = self.model.score(
+                [(query, doc.page_content) for query, doc in pairs]
+            ) if pairs else []
+        ranked = {query: [] for query in docs_by_query}
+        for (query, doc), score in sorted(
+                zip(pairs, scores), key=lambda item: item[1], reverse=True):
+            ranked[query].append(doc)
+        return ranked
+
+
+def gen_vec_store(embed_method: Embeddings) -> Chroma:
+    return Chroma(
         persist_directory=VEC_DB_PATH,
         embedding_function=embed_method,
         collection_name="deg_sop"
     )
 
-    vector_retriever = vec_store.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": srch_k, "fetch_k" : 10}
-    )
 
+def gen_bm25_retriever(vec_store: Chroma, srch_k: int) -> BM25Retriever:
     result = vec_store.get()
     documents = result["documents"]
     metadatas = result["metadatas"]
 
-    bm25_docs = [Document(page_content=doc, metadata=meta)
-                 for doc, meta in zip(documents, metadatas)]
+    # same ids as the vector search results, so the two dedupe
+    bm25_docs = [Document(id=doc_id, page_content=doc, metadata=meta)
+                 for doc_id, doc, meta in zip(
+                     result["ids"], documents, metadatas)]
+
+    return BM25Retriever.from_documents(documents=bm25_docs, k=srch_k)
 
-    bm25_retriever = (BM25Retriever.from_documents(documents=bm25_docs, k=srch_k))
+
+def assemble_retriever(
+        vec_store: Chroma,
+        bm25_retriever: BM25Retriever,
+        custom_reranker,
+        srch_k: int
+) -> ContextualCompressionRetriever:
+    vector_retriever = vec_store.as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": srch_k, "fetch_k" : 10}
+    )
 
     ensemble_retriever = EnsembleRetriever(
         retrievers=[vector_retriever, bm25_retriever],
         weights=[0.5, 0.5]
         )
 
-    custom_reranker = gen_custom_reranker()
-
-    reranker_compressor = CrossEncoderReranker(model=custom_reranker, top_n=3)
+    reranker_compressor = TracedCrossEncoderReranker(
+        model=custom_reranker,
+        top_n=3
+    )
 
     final_retriever = ContextualCompressionRetriever(
         base_retriever=ensemble_retriever,
         base_compressor=reranker_compressor,
     )
-    return final_retriever
\ No newline at end of file
+    return final_retriever
+
+
+def gen_retriever(srch_k: int, ):
+    embed_method = gen_custom_embeddings(max_len=6144)
+    vec_store = gen_vec_store(embed_method)
+    bm25_retriever = gen_bm25_retriever(vec_store, srch_k)
+    custom_reranker = gen_custom_reranker()
+    return assemble_retriever(
+        vec_store, bm25_retriever, custom_reranker, srch_k)
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Lets the vector store open before the embedding model is loaded, the
+    model is only needed by the first query.
+    """
+
+    def __init__(self, component: LazyComponent):
+        self.component = component
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.component.get().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.component.get().embed_query(text)
+
+
+class LazyRetriever(BaseRetriever):
+    """
+    Stands in for the retriever being warmed up, a query made before it is
+    ready waits for it.
+    """
+
+    component: LazyComponent
+
+    def _get_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.component.get().invoke(
+            query, {"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        retriever = await self.component.aget()
+        return await retriever.ainvoke(
+            query, {"callbacks": run_manager.get_child()})
+
+    def resolve(self) -> ContextualCompressionRetriever:
+        return self.component.get()
+
+    async def aresolve(self) -> ContextualCompressionRetriever:
+        return await self.component.aget()
+
+
+def gen_lazy_retriever(srch_k: int, warmup: Warmup) -> LazyRetriever:
+    """
+    The retriever of gen_retriever(), its models, vector store and BM25
+    corpus declared as components of warmup so they load in parallel.
+    """
+    embed_method = warmup.add(
+        "embeddings", lambda: gen_custom_embeddings(max_len=6144))
+    custom_reranker = warmup.add("reranker", gen_custom_reranker)
+    vec_store = warmup.add(
+        "vector_store", lambda: gen_vec_store(LazyEmbeddings(embed_method)))
+    bm25_retriever = warmup.add(
+        "bm25",
+        lambda store: gen_bm25_retriever(store, srch_k),
+        vec_store
+    )
+    retriever = warmup.add(
+        "retriever",
+        lambda embed, store, bm25, reranker: assemble_retriever(
+            store, bm25, reranker, srch_k),
+        embed_method,
+        vec_store,
+        bm25_retriever,
+        custom_reranker
+    )
+    return LazyRetriever(component=retriever)
+
+
+def doc_key(doc: Document) -> str:
+    return doc.id or doc.page_content
+
+
+class MultiQuerySearch:
+    """
+    The search of all the sub-queries of a question at once: their ensemble
+    searches run concurrently, the candidates go through one cross-encoder
+    batch, and the best chunks of each sub-query are taken in turn, each
+    chunk once, while the context fits in `token_budget`.
+    """
+
+    def __init__(
+            self,
+            retriever: ContextualCompressionRetriever | LazyRetriever,
+            count_tokens: Callable[[str], int],
+            token_budget: int,
+            top_n: int = 3,
+            max_workers: int = 4
+    ):
+        self.retriever = retriever
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.top_n = top_n
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="cad-agent-rtrv"
+        )
+
+    def _resolve(self) -> ContextualCompressionRetriever:
+        if isinstance(self.retriever, LazyRetriever):
+            return self.retriever.resolve()
+        return self.retriever
+
+    async def _aresolve(self) -> ContextualCompressionRetriever:
+        if isinstance(self.retriever, LazyRetriever):
+            return await self.retriever.aresolve()
+        return self.retriever
+
+    def select(self, ranked: dict[str, list[Document]]) -> list[Document]:
+        selected, seen, used = [], set(), 0
+        for rank in range(self.top_n):
+            for docs in ranked.values():
+                if rank >= len(docs) or doc_key(docs[rank]) in seen:
+                    continue
+                doc = docs[rank]
+                seen.add(doc_key(doc))
+                tokens = self.count_tokens(doc.page_content)
+                # the best chunk is kept even when it is over the budget
+                if selected and used + tokens > self.token_budget:
+                    continue
+                selected.append(doc)
+                used += tokens
+        return selected
+
+    def search(
+            self,
+            queries: list[str],
+            config: RunnableConfig | None = None
+    ) -> list[Document]:
+        retriever = self._resolve()
+        queries = list(dict.fromkeys(queries))
+        results = self.executor.map(
+            lambda query: retriever.base_retriever.invoke(query, config),
+            queries
+        )
+        ranked = retriever.base_compressor.rank_queries(
+            dict(zip(queries, results)),
+            callbacks=(config or {}).get("callbacks")
+        )
+        return self.select(ranked)
+
+    async def asearch(
+            self,
+            queries: list[str],
+            config: RunnableConfig | None = None
+    ) -> list[Document]:
+        retriever = await self._aresolve()
+        queries = list(dict.fromkeys(queries))
+        results = await asyncio.gather(*(
+            retriever.base_retriever.ainvoke(query, config)
+            for query in queries
+        ))
+        # the cross-encoder runs on the cpu, off the event loop
+        ranked = await asyncio.to_thread(
+            retriever.base_compressor.rank_queries,
+            dict(zip(queries, results)),
+            (config or {}).get("callbacks")
+        )
+        return self.select(ranked)
+
+
+def format_rag_info(queries: list[str], docs: list[Document]) -> str:
+    chinese = all(contain_chinese(query) for query in queries)
+    if not docs:
+        return "没有相关的中文搜索结果" if chinese else "No result found"
+    if chinese:
+        response = "检索到以下中文信息:\n"
+    else:
+        response = ("retrieve following English information from the"
+                    " SOP knowledge library:\n")
+    return response + "\n".join(doc.page_content for doc in docs)
+
+
+def gen_multi_retrieve_rag_info(multi_search: MultiQuerySearch):
+    """
+    Generate the tool running all the `retrieve_rag_info` queries of a
+    retrieval together, the LLM is bound to retrieve_rag_info itself.
+    """
+
+    def retrieve_rag_infos(
+            query_strs: list[str],
+            config: RunnableConfig
+    ) -> str:
+        """
+        Retrieve the SOP manual content relevant to all the query strings,
+        deduplicated and ranked together.
+
+        :param query_strs: The query_str of every retrieve_rag_info call.
+        """
+        return format_rag_info(
+            query_strs, multi_search.search(query_strs, config))
+
+    async def aretrieve_rag_infos(
+            query_strs: list[str],
+            config: RunnableConfig
+    ) -> str:
+        return format_rag_info(
+            query_strs, await multi_search.asearch(query_strs, config))
+
+    return StructuredTool.from_function(
+        func=retrieve_rag_infos,
+        coroutine=aretrieve_rag_infos
+    )
@@ -1,11 +1,16 @@
 import os
 import stat
 import shutil
+import threading
+import time
 import magic
 import chardet
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from langchain_core.tools import tool
 from pathlib import Path
-from typing import Literal
+from typing import Any, Callable, Iterator, Literal
 
 BINARY_FILE_EXTENTSIONS = {
     ".exe", ".dll", '.so', '.bin', '.zip', '.tar', '.gz', '.bz2',
@@ -20,6 +25,163 @@ CODE_FILE_EXTENTSIONS = {
 
 DEFAULT_MAX_FILE_SIZE = 200 * 1024
 
+# memo of the read-only tools, bounded by the size of the cached results
+FS_MEMO_MAX_BYTES = 64 * 1024 ** 2
+FS_MEMO_MAX_ENTRIES = 4096
+# files modified this recently aren't memoized, the mtime of NFS may be too
+# coarse to tell two writes in a row apart
+FS_MEMO_RACY_NS = 2 * 10 ** 9
+
+
+# working directory of the session whose tools run in this context, the
+# sessions of the server share the process so change_dir can't os.chdir()
+_work_dir: ContextVar[list[str] | None] = ContextVar(
+    "work_dir", default=None
+)
+
+
+@contextmanager
+def work_dir(holder: list[str]) -> Iterator[list[str]]:
+    """
+    Run the tools of the context in the directory holder[0], change_dir
+    updates holder in place so the next turns of the session keep it.
+    """
+    token = _work_dir.set(holder)
+    try:
+        yield holder
+    finally:
+        _work_dir.reset(token)
+
+
+def current_dir() -> str:
+    holder = _work_dir.get()
+    return holder[0] if holder is not None else os.getcwd()
+
+
+def resolve_path(path: str) -> str:
+    """
+    path made absolute against the working directory of the session.
+    """
+    return os.path.normpath(
+        os.path.join(current_dir(), os.path.expanduser(path)))
+
+
+def _fingerprint(path: str) -> tuple[int, ...] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # a chmod only changes st_mode (and st_ctime)
+    return st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode
+
+
+class FsMemo:
+    """
+    LRU memo of the results of the read-only file system tools. An entry is
+    keyed by the resolved path and its stat fingerprint, so a changed file
+    misses by itself and a hit costs one stat call. The write tools drop
+    the entries of the paths they touch.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = FS_MEMO_MAX_BYTES,
+            max_entries: int = FS_MEMO_MAX_ENTRIES,
+            racy_ns: int = FS_MEMO_RACY_NS
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.racy_ns = racy_ns
+        self.lock = threading.Lock()
+        # key -> (result, size)
+        self.entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+        # resolved path -> keys of its entries
+        self.by_path: dict[str, set[tuple]] = {}
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0,
+                      "invalidations": 0}
+
+    def _drop(self, key: tuple) -> None:
+        _, size = self.entries.pop(key)
+        self.size -= size
+        keys = self.by_path.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_path[key[1]]
+
+    def get_or_compute(
+            self,
+            kind: str,
+            path: str,
+            args: tuple,
+            compute: Callable[[], Any]
+    ) -> Any:
+        real_path = os.path.realpath(path)
+        fingerprint = _fingerprint(real_path)
+        # the results quote the path as given
+        key = (kind, real_path, fingerprint, path, args)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[0]
+            self.stats["misses"] += 1
+
+        result = compute()
+        if fingerprint is None or (
+                time.time_ns() - fingerprint[0] < self.racy_ns):
+            return result
+        size = len(result) if isinstance(result, str) else 64
+        if size > self.max_bytes:
+            return result
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (result, size)
+            self.by_path.setdefault(real_path, set()).add(key)
+            self.size += size
+            while (self.size > self.max_bytes
+                   or len(self.entries) > self.max_entries):
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+        return result
+
+    def invalidate(self, path: str, subtree: bool = False) -> None:
+        """
+        Drop the entries of path and of its parent directory listing, with
+        subtree also those of everything below path.
+        """
+        real_path = os.path.realpath(path)
+        paths = {real_path, os.path.dirname(real_path)}
+        with self.lock:
+            if subtree:
+                prefix = real_path.rstrip(os.sep) + os.sep
+                paths.update(one for one in self.by_path
+                             if one.startswith(prefix))
+            for one in paths:
+                for key in list(self.by_path.get(one, ())):
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.by_path.clear()
+            self.size = 0
+
+
+_fs_memo = FsMemo()
+
+
+def _invalidate_dest(src_path: str, dest_path: str) -> None:
+    # copying or moving into a directory creates dest_path/<name>
+    if os.path.isdir(dest_path):
+        _fs_memo.invalidate(
+            os.path.join(dest_path, os.path.basename(src_path)), subtree=True)
+    _fs_memo.invalidate(dest_path, subtree=True)
+
 
 def _is_binary_file(file_path: str) -> bool:
     path_p = Path(file_path)
@@ -90,7 +252,7 @@ def get_current_dir() -> str:
     """
     Get the current working directory.
     """
-    return str(Path.cwd())
+    return current_dir()
 
 
 @tool
@@ -106,9 +268,21 @@ def change_dir(path: str) -> str:
       >>> change_dir('/home/barwellg')
       "Changed directory to /home/barwellg"
     """
+    holder = _work_dir.get()
     try:
-        os.chdir(path)
-        return f"Changed directory to {Path.cwd()}."
+        if holder is None:
+            os.chdir(path)
+            return f"Changed directory to {Path.cwd()}."
+        new_dir = resolve_path(path)
+        # the checks of os.chdir()
+        if not os.path.exists(new_dir):
+            raise FileNotFoundError(new_dir)
+        if not os.path.isdir(new_dir):
+            raise NotADirectoryError(f"Not a directory: '{new_dir}'")
+        if not os.access(new_dir, os.X_OK):
+            raise PermissionError(new_dir)
+        holder[0] = new_dir
+        return f"Changed directory to {new_dir}."
     except FileNotFoundError:
         return f"Error: Directory '{path}' does not exist"
     except PermissionError:
@@ -135,6 +309,16 @@ def list_directory(
       str: A formatted string listing the contents or an error message.
 
     """
+    path = resolve_path(path)
+    return _fs_memo.get_or_compute(
+        "list_directory", path, (content_type,),
+        lambda: _list_directory(path, content_type))
+
+
+def _list_directory(
+        path: str,
+        content_type: Literal["all", "files", "dirs"]
+) -> str:
     try:
         entries = os.listdir(path)
         if content_type == "files":
@@ -166,8 +350,11 @@ def copy_file(src_path: str, dest_path: str) -> str:
     Returns:
       str: A message indicating success or failure.
     """
+    src_path = resolve_path(src_path)
+    dest_path = resolve_path(dest_path)
     try:
         shutil.copy2(src_path, dest_path)
+        _invalidate_dest(src_path, dest_path)
         return f"File successfully copied from `{src_path}` to `{dest_path}"
     except FileNotFoundError:
         return (f"Error: Source file `{src_path}` or destination `{dest_path}`"
@@ -189,8 +376,12 @@ def move_file(src_path: str, dest_path: str) -> str:
     Returns:
       str: A message indicating success or failure.
     """
+    src_path = resolve_path(src_path)
+    dest_path = resolve_path(dest_path)
     try:
         shutil.move(src_path, dest_path)
+        _fs_memo.invalidate(src_path, subtree=True)
+        _invalidate_dest(src_path, dest_path)
         return f"File successfully moved from `{src_path}` to ``{dest_path}"
     except FileNotFoundError:
         return (f"Error: Source file `{src_path}` or destination `{dest_path}`"
@@ -213,8 +404,10 @@ def create_dir(path: str) -> str:
     Example:
 
     """
+    path = resolve_path(path)
     try:
         os.makedirs(path, exist_ok=True)
+        _fs_memo.invalidate(path)
         return f"Directory created successfully at `{path}`"
     except PermissionError:
         return f"Error: PermissionDenied to create directory '{path}'"
@@ -231,12 +424,15 @@ def delete_file_dir(path: str) -> str:
     Returns:
       str: A message indicating success or failure
     """
+    path = resolve_path(path)
     try:
         if os.path.isfile(path):
             os.remove(path)
+            _fs_memo.invalidate(path)
             return f"File deleted successfully at `{path}`"
         elif os.path.isdir(path):
             shutil.rmtree(path)
+            _fs_memo.invalidate(path, subtree=True)
             return f"Directory deleted successfully at `{path}`"
         else:
             return (f"Error: Path `{path}` does not exist or is not a file "
@@ -257,6 +453,13 @@ def check_exist(path: str) -> str:
       str: A message indicating whether the path exists and its type.
 
     """
+    path = resolve_path(path)
+    return _fs_memo.get_or_compute(
+        "check_exist", path, (),
+        lambda: _check_exist(path))
+
+
+def _check_exist(path: str) -> str:
     try:
         if os.path.exists(path):
             if os.path.isfile(path):
@@ -279,6 +482,13 @@ def get_permissions(path: str) -> str:
            write; Group: read; Others: read") or an error message.
 
     """
+    path = resolve_path(path)
+    return _fs_memo.get_or_compute(
+        "get_permissions", path, (),
+        lambda: _get_permissions(path))
+
+
+def _get_permissions(path: str) -> str:
     try:
         st = os.stat(path)
         file_type = "directory" if os.path.isdir(path) else "file"
@@ -365,6 +575,18 @@ def read_tool(
     - Possible errors include: file not found, insufficient permissions, path
       errors, etc., with corresponding error messages returned
     """
+    file_path = resolve_path(file_path)
+    return _fs_memo.get_or_compute(
+        "read_tool", file_path, (max_size, start_pos, encoding),
+        lambda: _read_tool(file_path, max_size, start_pos, encoding))
+
+
+def _read_tool(
+        file_path: str,
+        max_size: int,
+        start_pos: int,
+        encoding: str | None
+) -> str:
     try:
         file_p = Path(file_path)
         if not os.path.exists(file_path):
@@ -376,7 +598,10 @@ def read_tool(
         file_size = os.path.getsize(file_path)
         file_ext = file_p.suffix.lower()
 
-        if _is_binary_file(file_path):
+        # magic and chardet only run again when the file changed
+        if _fs_memo.get_or_compute(
+                "is_binary", file_path, (),
+                lambda: _is_binary_file(file_path)):
             return (f"read_tool ERROR: {file_path} is a binary file, This tool "
                     f"can not read such binary file.")
 
@@ -393,7 +618,9 @@ def read_tool(
 
         if not encoding:
             try:
-                encoding = detect_file_encoding(file_path)
+                encoding = _fs_memo.get_or_compute(
+                    "encoding", file_path, (),
+                    lambda: detect_file_encoding(file_path))
             except Exception as e:
                 return (f"read_tool ERROR: Failed to detect file encoding, "
                         f"please specify manually. Error: {e}")
@@ -460,6 +687,7 @@ def write_file(file_path: str, content: str) -> str:
         str: A success message if the file was written successfully, or an error message
              detailing the issue (e.g., directory not found, permission denied).
     """
+    file_path = resolve_path(file_path)
     directory = os.path.dirname(file_path)
 
     # Check if a directory path is specified and if it exists.
@@ -474,6 +702,7 @@ def write_file(file_path: str, content: str) -> str:
         # Specify encoding for wider compatibility, especially with LLM generated content.
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(content)
+        _fs_memo.invalidate(file_path)
         return f"Successfully wrote content to '{file_path}'."
     except PermissionError:
         return (f"Error: Permission denied when trying to write to '{file_path}'. "
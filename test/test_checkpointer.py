@@ -0,0 +1,130 @@
+import pytest
+from langgraph.checkpoint.base import ERROR, empty_checkpoint
+from ai.cad_agent_release.agent_core.checkpointer import CompactSqliteSaver
+
+THREAD = {"configurable": {"thread_id": "t1", "checkpoint_ns": ""}}
+
+
+@pytest.fixture
+def saver(tmp_path):
+    saver = CompactSqliteSaver(tmp_path / "ckpt.sqlite", keep_last=3)
+    yield saver
+    saver.close()
+
+
+def make_checkpoint(step: int, values: dict, versions: dict) -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["id"] = f"{step:04d}"
+    checkpoint["channel_values"] = dict(values)
+    checkpoint["channel_versions"] = dict(versions)
+    return checkpoint
+
+
+def put_step(saver, config, step, values, versions, new_versions):
+    return saver.put(
+        config,
+        make_checkpoint(step, values, versions),
+        {"step": step},
+        new_versions
+    )
+
+
+def blob_versions(saver, channel: str) -> list[str]:
+    return sorted(version for version, in saver.conn.execute(
+        "SELECT version FROM blobs WHERE channel=?", (channel,)))
+
+
+def test_put_get_list_round_trip(saver):
+    config = THREAD
+    history = "x" * 2048  # large enough to be compressed
+    for step in range(1, 4):
+        config = put_step(
+            saver, config, step,
+            {"agent_input": f"q{step}", "chat_history": [history]},
+            {"agent_input": step, "chat_history": 1},
+            {"agent_input": step, "chat_history": 1} if step == 1
+            else {"agent_input": step}
+        )
+
+    latest = saver.get_tuple(THREAD)
+    assert latest.config["configurable"]["checkpoint_id"] == "0003"
+    assert latest.checkpoint["channel_values"] == {
+        "agent_input": "q3", "chat_history": [history]}
+    assert latest.metadata == {"step": 3}
+    assert latest.parent_config["configurable"]["checkpoint_id"] == "0002"
+
+    first = saver.get_tuple({"configurable": {
+        "thread_id": "t1", "checkpoint_ns": "", "checkpoint_id": "0001"}})
+    assert first.checkpoint["channel_values"]["agent_input"] == "q1"
+    assert first.parent_config is None
+
+    assert [one.config["configurable"]["checkpoint_id"]
+            for one in saver.list(THREAD)] == ["0003", "0002", "0001"]
+    before = saver.list(THREAD, before=latest.config, limit=1)
+    assert [one.config["configurable"]["checkpoint_id"]
+            for one in before] == ["0002"]
+    assert [one.metadata["step"]
+            for one in saver.list(THREAD, filter={"step": 1})] == [1]
+    assert saver.get_tuple({"configurable": {"thread_id": "t2"}}) is None
+
+
+def test_pending_writes(saver):
+    config = put_step(saver, THREAD, 1, {"agent_input": "q"},
+                      {"agent_input": 1}, {"agent_input": 1})
+    saver.put_writes(config, [("tool_call_list", [1]), ("chat_history", "a")],
+                     "task-1")
+    # a retried task doesn't overwrite the writes of a regular channel
+    saver.put_writes(config, [("tool_call_list", [2])], "task-1")
+    saver.put_writes(config, [(ERROR, "first")], "task-2")
+    # special channels are overwritten
+    saver.put_writes(config, [(ERROR, "second")], "task-2")
+
+    writes = saver.get_tuple(config).pending_writes
+    assert writes == [
+        ("task-1", "tool_call_list", [1]),
+        ("task-1", "chat_history", "a"),
+        ("task-2", ERROR, "second"),
+    ]
+
+
+def test_prune_keeps_referenced_blobs(saver):
+    config = THREAD
+    # chat_history is written once and stays referenced by every
+    # checkpoint, agent_input gets a new version each step
+    for step in range(1, 7):
+        config = put_step(
+            saver, config, step,
+            {"agent_input": f"q{step}", "chat_history": ["h"]},
+            {"agent_input": step, "chat_history": 1},
+            {"agent_input": step, "chat_history": 1} if step == 1
+            else {"agent_input": step}
+        )
+        saver.put_writes(config, [("tool_call_list", [step])], "task")
+
+    kept = [one.config["configurable"]["checkpoint_id"]
+            for one in saver.list(THREAD)]
+    assert kept == ["0006", "0005", "0004"]
+    assert blob_versions(saver, "chat_history") == ["1"]
+    assert blob_versions(saver, "agent_input") == ["4", "5", "6"]
+    oldest = saver.get_tuple({"configurable": {
+        "thread_id": "t1", "checkpoint_ns": "", "checkpoint_id": "0004"}})
+    assert oldest.checkpoint["channel_values"] == {
+        "agent_input": "q4", "chat_history": ["h"]}
+    assert oldest.pending_writes == [("task", "tool_call_list", [4])]
+    n_writes, = saver.conn.execute("SELECT COUNT(*) FROM writes").fetchone()
+    assert n_writes == 3
+
+
+def test_threads_are_pruned_separately(saver):
+    other = {"configurable": {"thread_id": "t2", "checkpoint_ns": ""}}
+    for step in range(1, 5):
+        put_step(saver, THREAD, step, {"agent_input": "a"},
+                 {"agent_input": step}, {"agent_input": step})
+    put_step(saver, other, 1, {"agent_input": "b"},
+             {"agent_input": 1}, {"agent_input": 1})
+    assert len(list(saver.list(THREAD))) == 3
+    assert saver.get_tuple(other).checkpoint["channel_values"] == {
+        "agent_input": "b"}
+    saver.delete_thread("t1")
+    assert saver.get_tuple(THREAD) is None
+    assert saver.get_tuple(other) is not None
@@ -0,0 +1,67 @@
+import pytest
+from ai.cad_agent_release.agent_core.intent import ConfirmIntentClassifier
+
+
+@pytest.mark.parametrize("reply, decision", [
+    ("yes", "confirm"),
+    ("sure", "confirm"),
+    ("OK, run it!", "confirm"),
+    ("yes, go ahead", "confirm"),
+    ("go ahead and run it please", "confirm"),
+    ("好的，开始吧", "confirm"),
+    ("确认执行", "confirm"),
+    ("no", "deny"),
+    ("cancel", "deny"),
+    ("don't run it", "deny"),
+    ("不要", "deny"),
+    ("no no", "deny"),
+    ("no, thanks", "deny"),
+    ("stop it", "deny"),
+    ("取消吧", "deny"),
+])
+def test_plain_replies_decided_locally(reply, decision):
+    result = ConfirmIntentClassifier().classify(reply)
+    assert result == {
+        "decision": decision,
+        "clarification_needed": False,
+        "clarification_query": None
+    }
+
+
+@pytest.mark.parametrize("reply", [
+    # adds an instruction or a condition to the confirmation
+    "ok run it tomorrow",
+    "go ahead and delete it",
+    "run it on block b",
+    "yes but skip step 2",
+    "ok, only the lvs check",
+    # asks something
+    "why?",
+    "what does step 2 do",
+    "可以吗",
+    # two deny words may cancel out
+    "don't cancel",
+    "do not stop",
+    "never stop",
+    "no, don't stop",
+    "不要停",
+    "别停",
+    "别取消",
+    "不要取消",
+    # mixes confirm and deny words, or neither
+    "no, run it",
+    "yesterday",
+    "looks good to me",
+    "",
+    None,
+    "yes " * 20,
+])
+def test_other_replies_go_to_the_llm(reply):
+    assert ConfirmIntentClassifier().classify(reply) is None
+
+
+def test_stats():
+    classifier = ConfirmIntentClassifier()
+    for reply in ("yes", "no", "ok run it tomorrow"):
+        classifier.classify(reply)
+    assert classifier.stats == {"lexicon": 2, "llm": 1}
@@ -0,0 +1,46 @@
+import json
+import pytest
+from ai.cad_agent_release.agent_core.json_stream import JsonFieldStream
+
+
+def stream_field(text: str, chunk_size: int, field: str = "flow_plan"):
+    field_stream = JsonFieldStream(field)
+    deltas = [field_stream.feed(text[pos:pos + chunk_size])
+              for pos in range(0, len(text), chunk_size)]
+    return "".join(deltas), field_stream
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 10000])
+@pytest.mark.parametrize("answer", [
+    {"flow_plan": "1. run lvs\n2. read the \"report\"", "flow_results": "ok"},
+    {"flow_results": "success", "flow_plan": "tab\there, back\\slash"},
+    {"flow_plan": "unicode: 版图验证 é \U0001F600"},
+    # the key in another string or in a nested object isn't the field
+    {"note": "\"flow_plan\": \"no\"", "flow_plan": "yes"},
+    {"meta": {"flow_plan": "inner"}, "flow_plan": "outer"},
+    {"steps": [{"flow_plan": "inner"}], "flow_plan": "outer"},
+])
+def test_field_value(answer, chunk_size):
+    for ensure_ascii in (True, False):
+        text = json.dumps(answer, ensure_ascii=ensure_ascii, indent=1)
+        value, field_stream = stream_field(text, chunk_size)
+        assert value == answer["flow_plan"]
+        assert field_stream.text == value
+        assert field_stream.done
+
+
+def test_missing_field():
+    value, field_stream = stream_field(
+        json.dumps({"meta": {"flow_plan": "inner"}, "other": "x"}), 3)
+    assert value == ""
+    assert not field_stream.done
+
+
+def test_streams_while_generated():
+    field_stream = JsonFieldStream("flow_plan")
+    assert field_stream.feed('{"flow_pl') == ""
+    assert field_stream.feed('an": "1. ru') == "1. ru"
+    assert field_stream.feed('n lvs\\') == "n lvs"
+    assert field_stream.feed('n2. done", "flow_results": "x"}') == (
+        "\n2. done")
+    assert field_stream.feed("more") == ""
@@ -0,0 +1,122 @@
+import asyncio
+import pytest
+from langchain_core.language_models.fake_chat_models import (
+    GenericFakeChatModel
+)
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.outputs import ChatGeneration, ChatResult
+from ai.cad_agent_release.agent_core.output_budget import (
+    OutputBudget,
+    retry_truncated
+)
+
+BUDGETS = {
+    "proc_confirm": {"tokens": 1024, "thinking": 0},
+    "plan_run": {"tokens": 4096, "thinking": 512},
+}
+
+
+class BudgetedLLM(GenericFakeChatModel):
+    """
+    Answers in full with at least `needed` max_tokens, cut off below.
+    """
+    max_tokens: int | None = None
+    needed: int = 1024
+    calls: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(self.max_tokens)
+        if self.max_tokens < self.needed:
+            text, reason, tokens = '{"decision": "con', "length", 300
+        else:
+            text, reason, tokens = '{"decision": "confirm"}', "stop", 8
+        message = AIMessage(text, usage_metadata={
+            "input_tokens": 10, "output_tokens": tokens,
+            "total_tokens": 10 + tokens})
+        return ChatResult(generations=[ChatGeneration(
+            message=message, generation_info={"finish_reason": reason})])
+
+
+def feed(budget: OutputBudget, node: str, tokens: int, n: int) -> None:
+    for _ in range(n):
+        budget.observe(node, tokens, False)
+
+
+def test_limit_follows_the_answers():
+    budget = OutputBudget(BUDGETS, min_samples=5)
+    assert budget.limit("proc_confirm") == 1024
+    feed(budget, "proc_confirm", 100, 4)
+    assert budget.limit("proc_confirm") == 1024
+    feed(budget, "proc_confirm", 100, 1)
+    # 100 * 1.5 rounded up to a power of two, but not below the floor
+    assert budget.limit("proc_confirm") == 256
+    feed(budget, "proc_confirm", 300, 5)
+    assert budget.limit("proc_confirm") == 512
+    # the floor leaves room for the thinking budget
+    feed(budget, "plan_run", 10, 5)
+    assert budget.limit("plan_run") == 256 + 512
+    assert budget.limit("unknown") is None
+
+
+def test_truncation_goes_back_to_the_maximum():
+    budget = OutputBudget(BUDGETS, min_samples=5)
+    feed(budget, "proc_confirm", 100, 5)
+    assert budget.observe("proc_confirm", 256, True)
+    assert budget.limit("proc_confirm") == 1024
+    # cut off at the declared maximum: nothing to retry
+    assert not budget.observe("proc_confirm", 1024, True)
+    assert budget.stats["proc_confirm"]["truncated"] == 2
+
+
+def test_only_adaptive_nodes_adapt():
+    budget = OutputBudget(BUDGETS, min_samples=5, adaptive={"plan_run"})
+    feed(budget, "proc_confirm", 100, 5)
+    feed(budget, "plan_run", 100, 5)
+    assert budget.limit("proc_confirm") == 1024
+    assert budget.limit("plan_run") == 768
+
+
+def test_attach_and_reload(tmp_path):
+    path = tmp_path / "budget.json"
+    budget = OutputBudget(BUDGETS, path=path, min_samples=5)
+    llm = BudgetedLLM(messages=iter([]))
+    budget.attach("proc_confirm", llm, None)
+    assert llm.max_tokens == 1024
+    feed(budget, "proc_confirm", 100, 5)
+    assert llm.max_tokens == 256
+
+    reloaded = OutputBudget(BUDGETS, path=path, min_samples=5)
+    other = BudgetedLLM(messages=iter([]))
+    reloaded.attach("proc_confirm", other)
+    assert other.max_tokens == 256
+    assert reloaded.llm_kwargs("proc_confirm") == {
+        "tokens": 256, "thk_en": False}
+    assert reloaded.llm_kwargs("plan_run") == {
+        "tokens": 4096, "thk_budget": 512}
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_retry_truncated(use_async):
+    budget = OutputBudget(BUDGETS, min_samples=5)
+    feed(budget, "proc_confirm", 100, 5)
+    llm = BudgetedLLM(messages=iter([]), calls=[],
+                      callbacks=[budget.callback("proc_confirm")])
+    budget.attach("proc_confirm", llm)
+    chain = retry_truncated(llm | JsonOutputParser())
+
+    result = (asyncio.run(chain.ainvoke("hi")) if use_async
+              else chain.invoke("hi"))
+    assert result == {"decision": "confirm"}
+    assert llm.calls == [256, 1024]
+
+
+def test_no_retry_at_the_maximum():
+    budget = OutputBudget(BUDGETS, min_samples=5)
+    llm = BudgetedLLM(messages=iter([]), calls=[], needed=2048,
+                      callbacks=[budget.callback("proc_confirm")])
+    budget.attach("proc_confirm", llm)
+    chain = retry_truncated(llm | JsonOutputParser())
+    # the parser accepts the partial JSON of the cut off answer
+    assert chain.invoke("hi") == {"decision": "con"}
+    assert llm.calls == [1024]
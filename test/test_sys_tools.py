@@ -0,0 +1,140 @@
+import os
+import pytest
+from ai.cad_agent_release.tools import sys_tools
+from ai.cad_agent_release.tools.sys_tools import FsMemo
+
+
+@pytest.fixture
+def memo(monkeypatch):
+    # racy_ns=0: files written by the test are memoized right away
+    memo = FsMemo(racy_ns=0)
+    monkeypatch.setattr(sys_tools, "_fs_memo", memo)
+    return memo
+
+
+def backdate(path, seconds: int = 10) -> None:
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 10 ** 9))
+
+
+def test_hit_and_changed_file(tmp_path):
+    memo = FsMemo(racy_ns=0)
+    path = tmp_path / "a.txt"
+    path.write_text("one")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return path.read_text()
+
+    assert memo.get_or_compute("read", str(path), (), compute) == "one"
+    assert memo.get_or_compute("read", str(path), (), compute) == "one"
+    assert len(calls) == 1
+    path.write_text("two!")
+    assert memo.get_or_compute("read", str(path), (), compute) == "two!"
+    assert len(calls) == 2
+    assert memo.stats["hits"] == 1 and memo.stats["misses"] == 2
+
+
+def test_racy_files_are_not_memoized(tmp_path):
+    memo = FsMemo()
+    path = tmp_path / "a.txt"
+    path.write_text("one")
+    memo.get_or_compute("read", str(path), (), path.read_text)
+    assert not memo.entries
+    backdate(path)
+    memo.get_or_compute("read", str(path), (), path.read_text)
+    assert len(memo.entries) == 1
+
+
+def test_invalidate(tmp_path):
+    memo = FsMemo(racy_ns=0)
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    (sub / "x.txt").write_text("x")
+    for path in (tmp_path, sub, sub / "x.txt"):
+        memo.get_or_compute("check", str(path), (), lambda: "cached")
+    # the entry of the path and the listing of its parent
+    memo.invalidate(str(sub / "x.txt"))
+    assert set(memo.by_path) == {str(tmp_path)}
+    memo.get_or_compute("check", str(sub / "x.txt"), (), lambda: "cached")
+    memo.invalidate(str(tmp_path), subtree=True)
+    assert not memo.entries and not memo.by_path and memo.size == 0
+
+
+def test_bounded(tmp_path):
+    memo = FsMemo(max_bytes=10, max_entries=2, racy_ns=0)
+    paths = [tmp_path / f"{idx}.txt" for idx in range(3)]
+    for path in paths:
+        path.write_text("x")
+        memo.get_or_compute("read", str(path), (), lambda: "abcd")
+    assert len(memo.entries) == 2
+    assert memo.stats["evictions"] == 1
+    assert str(paths[0]) not in memo.by_path
+    # larger than the whole memo
+    memo.get_or_compute("read", str(paths[0]), (), lambda: "x" * 11)
+    assert len(memo.entries) == 2
+
+
+def test_write_tools_invalidate(memo, tmp_path):
+    target = tmp_path / "out.txt"
+    target.write_text("old")
+    backdate(target)
+    mtime = os.stat(target).st_mtime_ns
+    read = {"file_path": str(target), "encoding": "utf-8"}
+    assert "old" in sys_tools.read_tool.invoke(read)
+
+    # same size and mtime: only the invalidation tells the change apart
+    sys_tools.write_file.invoke({"file_path": str(target), "content": "new"})
+    os.utime(target, ns=(mtime, mtime))
+    assert "new" in sys_tools.read_tool.invoke(read)
+    assert memo.stats["invalidations"] >= 1
+
+
+def test_listing_after_file_changes(memo, tmp_path):
+    src = tmp_path / "src"
+    dest = tmp_path / "dest"
+    src.mkdir()
+    dest.mkdir()
+    (src / "a.v").write_text("module a;")
+
+    def listing(path):
+        return sys_tools.list_directory.invoke({"path": str(path)})
+
+    assert "a.v" in listing(src)
+    assert "No all found" in listing(dest)
+    sys_tools.copy_file.invoke({"src_path": str(src / "a.v"),
+                                "dest_path": str(dest)})
+    assert "a.v" in listing(dest)
+    sys_tools.delete_file_dir.invoke({"path": str(src / "a.v")})
+    assert "No all found" in listing(src)
+    sys_tools.move_file.invoke({"src_path": str(dest / "a.v"),
+                                "dest_path": str(src / "b.v")})
+    assert "b.v" in listing(src)
+    assert "No all found" in listing(dest)
+    sys_tools.create_dir.invoke({"path": str(dest / "sub")})
+    assert "sub" in listing(dest)
+
+
+def test_work_dir_per_session(memo, tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "x.v").write_text("module x;")
+    start = os.getcwd()
+    session_a, session_b = [str(tmp_path)], [str(tmp_path)]
+
+    with sys_tools.work_dir(session_a):
+        assert "Changed directory" in sys_tools.change_dir.invoke(
+            {"path": "a"})
+    with sys_tools.work_dir(session_b):
+        sys_tools.change_dir.invoke({"path": str(tmp_path / "b")})
+        assert "File exists" in sys_tools.check_exist.invoke(
+            {"path": "x.v"})
+        assert "Error" in sys_tools.change_dir.invoke({"path": "x.v"})
+        assert "Error" in sys_tools.change_dir.invoke({"path": "nope"})
+    with sys_tools.work_dir(session_a):
+        assert sys_tools.get_current_dir.invoke({}) == str(tmp_path / "a")
+        assert "does not exist" in sys_tools.check_exist.invoke(
+            {"path": "x.v"})
+    assert session_b == [str(tmp_path / "b")]
+    assert os.getcwd() == start
@@ -0,0 +1,70 @@
+import pytest
+from ai.cad_agent_release.agent_core.tool_exec import (
+    build_tool_dag,
+    ready_tool_calls
+)
+
+
+def call(name: str, step: int, **args) -> dict:
+    return {"name": name, "args": args, "id": f"call_{step}"}
+
+
+@pytest.mark.parametrize("tool_calls, dag", [
+    # read-only calls never wait for each other
+    ([call("read_tool", 1, file_path="/a/x"),
+      call("list_directory", 2, path="/a")],
+     [set(), set()]),
+    # a writer and a reader of the same tree are ordered
+    ([call("run_lvs", 1, out_dir="/work/out"),
+      call("read_tool", 2, file_path="/work/out/lvs.rpt")],
+     [set(), {0}]),
+    ([call("write_file", 1, file_path="/a/x", content="hi"),
+      call("read_tool", 2, file_path="/a/x")],
+     [set(), {0}]),
+    # writers on disjoint absolute paths run together
+    ([call("run_lvs", 1, out_dir="/a"), call("run_drc", 2, out_dir="/b")],
+     [set(), set()]),
+    ([call("run_lvs", 1, out_dir="~/w"), call("run_drc", 2, out_dir="~/w/x")],
+     [set(), {0}]),
+    # relative paths depend on the working directory at run time
+    ([call("run_lvs", 1, out_dir="out/lvs"),
+      call("read_tool", 2, file_path="/b/x")],
+     [set(), {0}]),
+    ([call("run_lvs", 1, out_dir="/a"), call("read_tool", 2, file_path="x.v")],
+     [set(), {0}]),
+    # a writer without any path arg writes where it runs
+    ([call("run_lvs", 1, mode="fast"),
+      call("read_tool", 2, file_path="/b/x")],
+     [set(), {0}]),
+    # numbers and words are not paths
+    ([call("run_lvs", 1, out_dir="/a", corner="0.5", tag="v1.2"),
+      call("read_tool", 2, file_path="/b/x")],
+     [set(), set()]),
+    # nothing runs beside change_dir
+    ([call("list_directory", 1, path="/a"), call("change_dir", 2, path="/b"),
+      call("list_directory", 3, path="/c")],
+     [set(), {0}, {1}]),
+])
+def test_build_tool_dag(tool_calls, dag):
+    assert build_tool_dag(tool_calls) == dag
+
+
+def test_build_tool_dag_step_refs():
+    tool_calls = [
+        call("run_lvs", 1, out_dir="/a"),
+        call("run_drc", 2, out_dir="/b"),
+        call("run_report", 3, src="[content from step 1]", out_dir="/c"),
+        call("run_report", 4, src="{previous_tool_output}", out_dir="/d"),
+    ]
+    assert build_tool_dag(tool_calls) == [set(), set(), {0}, {0, 1, 2}]
+
+
+def test_ready_tool_calls():
+    tool_calls = [
+        call("run_lvs", 1, out_dir="/a"),
+        call("run_drc", 2, out_dir="/b"),
+        call("read_tool", 3, file_path="/a/lvs.rpt"),
+        call("run_report", 4, src="[content from step 2]", out_dir="/c"),
+    ]
+    assert ready_tool_calls(tool_calls) == [0, 1]
+    assert ready_tool_calls([]) == []
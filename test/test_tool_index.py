@@ -0,0 +1,46 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import StructuredTool
+from ai.cad_agent_release.agent_core.tool_index import ToolIndex
+from ai.cad_agent_release.agent_core.tool_registry import ToolRegistry
+
+
+def gen_tool(name: str) -> StructuredTool:
+    return StructuredTool.from_function(
+        lambda cell: cell, name=name, description=f"{name} of a cell")
+
+
+TOOLS = [gen_tool(f"check_{idx}") for idx in range(20)]
+
+
+class LengthEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [1.0, float(len(text))]
+
+
+def test_subset_chains_are_bounded():
+    tool_reg = ToolRegistry(loader=lambda: (TOOLS, []))
+    tool_index = ToolIndex(tool_reg, LengthEmbeddings(),
+                           top_k=1, min_tools=4, max_subsets=2)
+    builds = []
+
+    def build(tools, escalate):
+        builds.append(len(tools))
+        return RunnableLambda(lambda inputs: len(tools))
+
+    def chain(name):
+        return tool_index.chain("plan_run", build, lambda result: None,
+                                "check", name)
+
+    first = chain("check_1")
+    assert chain("check_1") is first
+    assert builds == [20, 2]
+    chain("check_2")
+    chain("check_3")
+    assert len(tool_index.subset_chains) == 2
+    # the least recently used subset was dropped and is built again
+    assert chain("check_1") is not first
+    assert builds == [20, 2, 2, 2, 2]
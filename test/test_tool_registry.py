@@ -0,0 +1,36 @@
+from langchain_core.tools import tool
+from ai.cad_agent_release.agent_core.tool_registry import ToolRegistry
+
+
+@tool
+def run_drc(cell: str) -> str:
+    """Run the DRC check of a cell."""
+    return cell
+
+
+@tool
+def run_lvs(cell: str) -> str:
+    """Run the LVS check of a cell."""
+    return cell
+
+
+def test_refresh_rebuilds_on_a_new_tool_set():
+    loaded = [[run_drc]]
+    tool_reg = ToolRegistry(loader=lambda: (loaded[0], ["run_drc"]))
+    version = tool_reg.version
+    builds = []
+
+    def build():
+        builds.append(1)
+        return [one_tool.name for one_tool in tool_reg.tools]
+
+    assert tool_reg.cached("names", build) == ["run_drc"]
+    assert not tool_reg.refresh()
+    assert tool_reg.cached("names", build) == ["run_drc"]
+    assert builds == [1]
+
+    loaded[0] = [run_drc, run_lvs]
+    assert tool_reg.refresh()
+    assert tool_reg.version != version
+    assert tool_reg.cached("names", build) == ["run_drc", "run_lvs"]
+    assert set(tool_reg.tools_map) == {"run_drc", "run_lvs"}
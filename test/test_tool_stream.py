@@ -0,0 +1,53 @@
+import time
+import pytest
+
+# the annotations of the module are evaluated against the real PyQt5
+pytest.importorskip("PyQt5.QtCore")
+
+from ai.cad_agent_release.agent_core.tool_stream import (  # noqa: E402
+    ToolOutputStream,
+    current_tool_output
+)
+
+
+class Signal:
+    def __init__(self):
+        self.payloads = []
+
+    def emit(self, payload):
+        self.payloads.append(payload)
+
+    @property
+    def messages(self):
+        return [payload["message"] for payload in self.payloads]
+
+
+def test_pending_output_is_sent_when_due(tmp_path):
+    signal = Signal()
+    stream = ToolOutputStream("run_lvs", signal, spool_dir=tmp_path,
+                              interval=0.1)
+    with stream:
+        assert current_tool_output() is stream
+        stream.write("a\n")
+        # within the interval of the first chunk, then nothing more
+        stream.write("b\n")
+        assert signal.messages == ["a\n"]
+        time.sleep(0.3)
+        assert signal.messages == ["a\n", "b\n"]
+        stream.write("c\n")
+    assert current_tool_output() is None
+    time.sleep(0.2)
+    assert signal.messages == ["a\n", "b\n", "c\n"]
+    assert stream.summary() == "a\nb\nc\n"
+
+
+def test_long_output_keeps_head_and_tail(tmp_path):
+    stream = ToolOutputStream("run_drc", spool_dir=tmp_path, head_chars=10,
+                              tail_chars=10)
+    with stream:
+        for idx in range(100):
+            stream.write(f"line {idx}\n")
+    summary = stream.summary()
+    assert summary.startswith("line 0\nlin")
+    assert summary.endswith("line 99\n")
+    assert stream.spool_path.read_text().count("\n") == 100
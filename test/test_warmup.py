@@ -0,0 +1,43 @@
+import threading
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from ai.cad_agent_release.agent_core.history import HistoryManager
+from ai.cad_agent_release.agent_core.warmup import Warmup, resolve
+
+
+def test_components_build_in_the_background():
+    release = threading.Event()
+    done = []
+    warmup = Warmup(max_workers=2, on_done=done.append)
+    slow = warmup.add("slow", lambda: release.wait(5) and "model")
+    derived = warmup.add("derived", lambda model: f"{model}+index", slow)
+    warmup.start()
+    assert not derived.ready
+    release.set()
+    assert derived.get() == "model+index"
+    assert slow.get() == "model"
+    assert [row["name"] for row in warmup.report()] == ["slow", "derived"]
+    assert done == [warmup]
+
+
+def test_unstarted_component_builds_on_first_use():
+    calls = []
+    warmup = Warmup()
+    tokenizer = warmup.add("tokenizer", lambda: calls.append(1) or "tok")
+    assert calls == []
+    assert resolve(tokenizer) == "tok"
+    assert resolve(tokenizer) == "tok"
+    assert calls == [1]
+    assert resolve("plain") == "plain"
+
+
+def test_history_manager_resolves_a_lazy_tokenizer():
+    class Tokenizer:
+        def encode(self, text, add_special_tokens=False):
+            return text.split()
+
+    tokenizer = Warmup().add("tokenizer", Tokenizer)
+    history_mgr = HistoryManager(FakeListChatModel(responses=["s"]),
+                                 tokenizer)
+    assert not tokenizer.ready
+    assert history_mgr.count_text_tokens("three tokens here") == 3
+    assert tokenizer.ready